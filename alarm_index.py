@@ -0,0 +1,72 @@
+from typing import Iterable, List, Optional, Tuple
+from array import array
+from bisect import bisect_left, bisect_right
+from ticker_alarm import Condition
+
+
+class ThresholdIndex:
+    def __init__(self) -> None:
+        # targets are kept sorted, alarm ids are kept in the same order as their targets
+        self.greater_than_targets = array("d")
+        self.greater_than_alarm_ids: List[str] = []
+        self.less_than_targets = array("d")
+        self.less_than_alarm_ids: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.greater_than_alarm_ids) + len(self.less_than_alarm_ids)
+
+    def _get_side(self, condition: Condition) -> Tuple[array, List[str]]:
+        if condition == Condition.GREATER_THAN:
+            return self.greater_than_targets, self.greater_than_alarm_ids
+        elif condition == Condition.LESS_THAN:
+            return self.less_than_targets, self.less_than_alarm_ids
+        else:
+            raise ValueError(f"Unknown condition {condition}")
+
+    def insert(self, alarm_id: str, condition: Condition, target: float) -> None:
+        targets, alarm_ids = self._get_side(condition)
+        i = bisect_right(targets, target)
+        targets.insert(i, target)
+        alarm_ids.insert(i, alarm_id)
+
+    def insert_many(self, entries: Iterable[Tuple[str, Condition, float]]) -> None:
+        # one sort per side instead of one array shift per alarm
+        new_entries = {condition: [] for condition in Condition}
+        for alarm_id, condition, target in entries:
+            new_entries[condition].append((target, alarm_id))
+        for condition, pairs in new_entries.items():
+            if len(pairs) == 0:
+                continue
+            targets, alarm_ids = self._get_side(condition)
+            pairs = sorted(list(zip(targets, alarm_ids)) + pairs, key=lambda pair: pair[0])
+            targets[:] = array("d", [target for target, _ in pairs])
+            alarm_ids[:] = [alarm_id for _, alarm_id in pairs]
+
+    def remove(self, alarm_id: str, condition: Condition, target: float) -> bool:
+        targets, alarm_ids = self._get_side(condition)
+        for i in range(bisect_left(targets, target), bisect_right(targets, target)):
+            if alarm_ids[i] == alarm_id:
+                del targets[i]
+                del alarm_ids[i]
+                return True
+        return False
+
+    def alarm_ids(self) -> List[str]:
+        return self.greater_than_alarm_ids + self.less_than_alarm_ids
+
+    def find_crossed(self, price: float) -> List[str]:
+        # '>' alarms crossed have target < price, '<' alarms crossed have target > price
+        crossed = self.greater_than_alarm_ids[:bisect_left(self.greater_than_targets, price)]
+        crossed += self.less_than_alarm_ids[bisect_right(self.less_than_targets, price):]
+        return crossed
+
+    def get_nearest_distance(self, price: float) -> Optional[float]:
+        # distance from price to the closest target not crossed yet
+        distances = []
+        i = bisect_left(self.greater_than_targets, price)
+        if i < len(self.greater_than_targets):
+            distances.append(self.greater_than_targets[i] - price)
+        j = bisect_right(self.less_than_targets, price)
+        if j > 0:
+            distances.append(price - self.less_than_targets[j - 1])
+        return min(distances) if len(distances) > 0 else None
@@ -0,0 +1,72 @@
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from ticker_alarm import ExpressionAlarm, TickerAlarm, WindowAlarm
+
+
+Alarm = Union[TickerAlarm, ExpressionAlarm, WindowAlarm]
+
+
+class AlarmRegistry:
+    # the subscribed alarms by alarm_id, user and ticker, so that a user's alarms are found without going through
+    # everyone's; not thread safe, the poller holds its lock around every call
+    def __init__(self) -> None:
+        # alarm_id -> (user_id, alarm)
+        self.by_id: Dict[str, Tuple[int, Alarm]] = {}
+        # user_id / ticker -> alarm ids in the order they were set, an expression alarm is under each of its tickers
+        self.by_user: Dict[int, Dict[str, None]] = {}
+        self.by_ticker: Dict[str, Dict[str, None]] = {}
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __contains__(self, alarm_id: str) -> bool:
+        return alarm_id in self.by_id
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.by_id)
+
+    def __getitem__(self, alarm_id: str) -> Tuple[int, Alarm]:
+        return self.by_id[alarm_id]
+
+    @staticmethod
+    def get_tickers(alarm: Alarm) -> List[str]:
+        return alarm.tickers if isinstance(alarm, ExpressionAlarm) else [alarm.ticker]
+
+    def add(self, user_id: int, alarm: Alarm) -> None:
+        if alarm.alarm_id in self.by_id:
+            self.remove(alarm.alarm_id)
+        self.by_id[alarm.alarm_id] = (user_id, alarm)
+        self.by_user.setdefault(user_id, {})[alarm.alarm_id] = None
+        for ticker in self.get_tickers(alarm):
+            self.by_ticker.setdefault(ticker, {})[alarm.alarm_id] = None
+
+    def remove(self, alarm_id: str) -> Optional[Tuple[int, Alarm]]:
+        entry = self.by_id.pop(alarm_id, None)
+        if entry is None:
+            return None
+        user_id, alarm = entry
+        user_alarm_ids = self.by_user[user_id]
+        del user_alarm_ids[alarm_id]
+        if len(user_alarm_ids) == 0:
+            del self.by_user[user_id]
+        for ticker in self.get_tickers(alarm):
+            ticker_alarm_ids = self.by_ticker[ticker]
+            del ticker_alarm_ids[alarm_id]
+            if len(ticker_alarm_ids) == 0:
+                del self.by_ticker[ticker]
+        return entry
+
+    def get_user_id(self, alarm_id: str) -> Optional[int]:
+        entry = self.by_id.get(alarm_id)
+        return entry[0] if entry is not None else None
+
+    def alarm_ids_of_user(self, user_id: int) -> List[str]:
+        return list(self.by_user.get(user_id, ()))
+
+    def alarms_of_user(self, user_id: int) -> List[Alarm]:
+        return [self.by_id[alarm_id][1] for alarm_id in self.by_user.get(user_id, ())]
+
+    def has_ticker(self, ticker: str) -> bool:
+        return ticker in self.by_ticker
+
+    def alarm_ids_of_ticker(self, ticker: str) -> List[str]:
+        return list(self.by_ticker.get(ticker, ()))
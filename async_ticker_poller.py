@@ -0,0 +1,84 @@
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import threading
+import time
+from telegram.ext import JobQueue
+from db import Database
+from notifier import Notifier, Priority
+from price import QuoteCache
+from ticker_alarm import TickerAlarm
+from ticker_poller import TickerPoller
+
+
+class AsyncTickerPoller(TickerPoller):
+    IO_WORKERS = 32
+
+    def __init__(self, db: Database, quote_cache: QuoteCache, notifier: Notifier, interval: float = TickerPoller.POLL_INTERVAL, io_workers: int = IO_WORKERS) -> None:
+        super().__init__(db, quote_cache, notifier, interval)
+        # requests and pymongo only have blocking clients, they are awaited on this pool
+        self.io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="async_ticker_poller")
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.tasks: Set[asyncio.Task] = set()
+
+    def start(self, job_queue: Optional[JobQueue] = None) -> None:
+        # job_queue is not used, ticks are scheduled on the event loop
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async_ticker_poller", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.run_ticks(), self.loop)
+
+    def stop(self) -> None:
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.cancel_tasks(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.io_executor.shutdown(wait=True)
+        self.loop = None
+
+    async def cancel_tasks(self) -> None:
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run_blocking(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        return await self.loop.run_in_executor(self.io_executor, partial(func, *args, **kwargs))
+
+    def create_task(self, coroutine: Any) -> None:
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_ticks(self) -> None:
+        next_tick_at = time.monotonic()
+        while True:
+            next_tick_at += self.TICK_INTERVAL
+            await asyncio.sleep(max(0.0, next_tick_at - time.monotonic()))
+            tickers = self.get_due_tickers(time.monotonic())
+            if len(tickers) > 0:
+                # a slow fetch must not delay the following ticks
+                self.create_task(self.poll_async(tickers))
+
+    async def poll_async(self, tickers: List[str]) -> None:
+        price_dicts = await self.run_blocking(self.quote_cache.get_many, tickers, allow_stale=False)
+        coroutines = []
+        for ticker, price_dict in zip(tickers, price_dicts):
+            for user_id, alarm in self.process_quote(ticker, price_dict):
+                coroutines.append(self.run_alarm_async(user_id, alarm, price_dict))
+
+        for result in await asyncio.gather(*coroutines, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(result)
+
+    async def run_alarm_async(self, user_id: int, alarm: TickerAlarm, price_dict: Optional[Dict[str, Any]]) -> None:
+        # process_quote has already removed the alarms the quote ends
+        text, modification = alarm.evaluate(price_dict)
+        if text is not None:
+            # only queues the message, the notifier sends it within Telegram's rate limits
+            self.notifier.send(user_id, text, priority=Priority.INFO if modification == "error" else Priority.TRIGGER)
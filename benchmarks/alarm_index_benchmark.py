@@ -0,0 +1,67 @@
+import random
+import time
+from alarm_index import ThresholdIndex
+from ticker_alarm import TickerAlarm
+
+
+NUM_ALARMS = 100_000
+NUM_EVALUATIONS = 1_000
+
+
+def make_alarms(num_alarms: int) -> list:
+    # '>' targets above and '<' targets below the current price of 100, as users set them
+    rng = random.Random(0)
+    alarms = []
+    for i in range(num_alarms):
+        condition = rng.choice([">", "<"])
+        target = rng.uniform(100, 150) if condition == ">" else rng.uniform(50, 100)
+        alarms.append(TickerAlarm(f"{i}-{i}", "THYAO.IS", condition, round(target, 2), "repeat"))
+    return alarms
+
+
+def check_find_crossed(alarms: list, index: ThresholdIndex, prices: list) -> None:
+    # the index returns the same alarms as checking each one, also at prices equal to a target
+    for price in prices:
+        price_dict = {"current_price": price}
+        expected = {alarm.alarm_id for alarm in alarms if alarm.check_alarm_condition(price_dict)}
+        crossed = index.find_crossed(price)
+        assert len(crossed) == len(set(crossed)) and set(crossed) == expected, price
+
+
+def benchmark_linear_scan(alarms: list, prices: list) -> float:
+    start = time.perf_counter()
+    for price in prices:
+        price_dict = {"current_price": price}
+        [alarm.alarm_id for alarm in alarms if alarm.check_alarm_condition(price_dict)]
+    return (time.perf_counter() - start) / len(prices)
+
+
+def benchmark_index(index: ThresholdIndex, prices: list) -> float:
+    start = time.perf_counter()
+    for price in prices:
+        index.find_crossed(price)
+    return (time.perf_counter() - start) / len(prices)
+
+
+if __name__ == "__main__":
+    alarms = make_alarms(NUM_ALARMS)
+
+    start = time.perf_counter()
+    index = ThresholdIndex()
+    for alarm in alarms:
+        index.insert(alarm.alarm_id, alarm.condition, alarm.target)
+    build_time = time.perf_counter() - start
+
+    rng = random.Random(1)
+    prices = [rng.gauss(100, 1) for _ in range(NUM_EVALUATIONS)]
+    check_find_crossed(alarms, index, prices[:NUM_EVALUATIONS // 20] + [alarm.target for alarm in alarms[:10]])
+    print("checks passed: find_crossed matches the linear scan")
+    linear_time = benchmark_linear_scan(alarms, prices[:NUM_EVALUATIONS // 100])
+    index_time = benchmark_index(index, prices)
+    mean_crossed = sum(len(index.find_crossed(price)) for price in prices) / len(prices)
+
+    print(f"alarms = {NUM_ALARMS}, evaluations = {NUM_EVALUATIONS}")
+    print(f"index build: {build_time:.3f} s ({1e6 * build_time / NUM_ALARMS:.2f} us/insert)")
+    print(f"mean crossed alarms per evaluation: {mean_crossed:.1f}")
+    print(f"linear scan: {1e3 * linear_time:.3f} ms/evaluation")
+    print(f"threshold index: {1e3 * index_time:.3f} ms/evaluation")
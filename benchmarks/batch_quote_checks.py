@@ -0,0 +1,112 @@
+from typing import Any, Dict, List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import threading
+import price
+from price import PriceProviderChain, YahooQuoteProvider, fetch_quote_ticker_infos
+
+
+def make_quote(symbol: str, current_price: float) -> Dict[str, Any]:
+    return {"symbol": symbol, "regularMarketPrice": current_price, "regularMarketPreviousClose": current_price - 1, "regularMarketTime": 1_700_000_000, "exchangeTimezoneName": "America/New_York"}
+
+
+class CannedQuoteServer:
+    # serves the v7 quote response with the same quote of each symbol on every request, and records the symbols of
+    # every request
+    def __init__(self, quotes: Dict[str, Dict[str, Any]]) -> None:
+        self.quotes = quotes
+        self.lock = threading.Lock()
+        self.requests: List[List[str]] = []
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v7/finance/quote"
+
+    def start(self) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="canned_quotes", daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                symbols = [symbol.upper() for symbol in parse_qs(urlparse(self.path).query).get("symbols", [""])[0].split(",") if symbol]
+                with server.lock:
+                    server.requests.append(symbols)
+                quotes = [server.quotes[symbol] for symbol in symbols if symbol in server.quotes]
+                content = json.dumps({"quoteResponse": {"result": quotes, "error": None}}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
+
+
+def check_chunking(server: CannedQuoteServer, symbols: List[str]) -> None:
+    # more symbols than one request takes are split into requests of at most YAHOO_QUOTE_MAX_SYMBOLS, each asked once
+    server.requests.clear()
+    infos = price.get_current_ticker_infos(symbols)
+    assert [info["current_price"] for info in infos] == [server.quotes[symbol]["regularMarketPrice"] for symbol in symbols]
+    sizes = sorted((len(request) for request in server.requests), reverse=True)
+    num_full, rest = divmod(len(symbols), price.YAHOO_QUOTE_MAX_SYMBOLS)
+    assert sizes == [price.YAHOO_QUOTE_MAX_SYMBOLS] * num_full + ([rest] if rest > 0 else []), sizes
+    assert sorted(symbol for request in server.requests for symbol in request) == sorted(symbols)
+
+
+def check_duplicates_and_case(server: CannedQuoteServer) -> None:
+    # a ticker asked several times or in another case is requested once and answered at each of its positions
+    server.requests.clear()
+    infos = price.get_current_ticker_infos(["thyao.is", "AAPL", "THYAO.IS", "Thyao.Is"])
+    assert server.requests == [["THYAO.IS", "AAPL"]], server.requests
+    assert [info["current_price"] for info in infos] == [40.0, 190.0, 40.0, 40.0]
+
+
+def check_missing_symbols(server: CannedQuoteServer) -> None:
+    # symbols Yahoo leaves out of the response are None, the others keep their positions
+    infos = price.get_current_ticker_infos(["UNKNOWN1", "AAPL", "UNKNOWN2"])
+    assert infos[0] is None and infos[2] is None and infos[1]["current_price"] == 190.0
+    assert set(fetch_quote_ticker_infos(["UNKNOWN1", "AAPL"])) == {"AAPL"}
+
+
+def check_malformed_quote(server: CannedQuoteServer) -> None:
+    # a quote missing a field only loses its own symbol, the rest of the batch is parsed
+    infos = price.get_current_ticker_infos(["AAPL", "BROKEN", "THYAO.IS"])
+    assert infos[1] is None and infos[0]["current_price"] == 190.0 and infos[2]["current_price"] == 40.0
+    assert set(fetch_quote_ticker_infos(["AAPL", "BROKEN", "THYAO.IS"])) == {"AAPL", "THYAO.IS"}
+
+
+if __name__ == "__main__":
+    symbols = [f"T{i}.IS" for i in range(2 * price.YAHOO_QUOTE_MAX_SYMBOLS + 20)]
+    quotes = {symbol: make_quote(symbol, 10.0 + i) for i, symbol in enumerate(symbols)}
+    quotes.update({"THYAO.IS": make_quote("THYAO.IS", 40.0), "AAPL": make_quote("AAPL", 190.0)})
+    broken = make_quote("BROKEN", 1.0)
+    del broken["regularMarketPrice"]
+    quotes["BROKEN"] = broken
+
+    server = CannedQuoteServer(quotes)
+    server.start()
+    price.YAHOO_QUOTE_URL = server.url
+    # only the batched quote endpoint, the fallback providers would ask the real Yahoo for the symbols it left out
+    price.price_provider_chain = PriceProviderChain([YahooQuoteProvider()], hedge_percentile=None)
+    try:
+        check_chunking(server, symbols)
+        check_chunking(server, symbols[:price.YAHOO_QUOTE_MAX_SYMBOLS])
+        check_duplicates_and_case(server)
+        check_missing_symbols(server)
+        check_malformed_quote(server)
+    finally:
+        server.stop()
+    print(f"checks passed: chunks of {price.YAHOO_QUOTE_MAX_SYMBOLS} symbols, duplicate and mixed-case tickers, symbols missing from the response, a malformed quote in a batch")
@@ -0,0 +1,92 @@
+from typing import Any, Dict, List, Optional, Tuple
+import datetime as dt
+import json
+import pytz
+from bot import Bot
+from expression import CompiledExpression, ExpressionError
+from ticker_alarm import ExpressionAlarm, TickerAlarm
+from ticker_poller import TickerPoller
+
+
+class FakeDatabase:
+    def __init__(self) -> None:
+        self.updates: List[Tuple[str, str]] = []
+
+    def update_alarm(self, alarm_id: str, modification: str) -> None:
+        self.updates.append((alarm_id, modification))
+
+    def update_alarm_state(self, *args: Any) -> None:
+        pass
+
+
+class FakeNotifier:
+    def __init__(self) -> None:
+        self.messages: List[Tuple[int, str]] = []
+
+    def send(self, chat_id: int, text: str, **kwargs: Any) -> None:
+        self.messages.append((chat_id, text))
+
+
+def make_price_dict(current_price: float) -> Dict[str, Any]:
+    return {"current_price": current_price, "absolute_price_change": 0.0, "percentage_price_change": 0.0, "last_update_datetime": dt.datetime.now(pytz.utc)}
+
+
+def check_compile() -> None:
+    # postfix programs in the usual precedence, tickers upper-cased and listed once, malformed expressions rejected
+    expression = CompiledExpression.compile("2.07 * krdmdm.is + 1")
+    assert expression.program == [("const", 2.07), ("ticker", "KRDMDM.IS"), ("op", "*"), ("const", 1.0), ("op", "+")], expression.program
+    assert expression.tickers == ["KRDMDM.IS"] and str(expression) == "2.07 * KRDMDM.IS + 1"
+    assert CompiledExpression.compile("BTC-USD - ETH-USD / (btc-usd)").tickers == ["BTC-USD", "ETH-USD"]
+    assert CompiledExpression.compile("-(1 + 2)").is_constant
+    for text in ("", "A +", "(A", "A $ B", "A B", "* A"):
+        try:
+            CompiledExpression.compile(text)
+        except ExpressionError:
+            continue
+        raise AssertionError(f"{text!r} compiled")
+
+
+def check_evaluate() -> None:
+    # None while a ticker has no price or on division by zero
+    prices = {"A": 10.0, "B": 4.0, "Z": 0.0}
+    cases: List[Tuple[str, Optional[float]]] = [("1 + 2 * 3", 7.0), ("(1 + 2) * 3", 9.0), ("-A + B", -6.0), ("A - B - 1", 5.0), ("A / B / 2", 1.25), ("2.07 * A", 20.7), ("A / Z", None), ("A + C", None)]
+    for text, expected in cases:
+        value = CompiledExpression.compile(text).evaluate(prices)
+        assert value == expected or (value is not None and expected is not None and abs(value - expected) < 1e-9), (text, value, expected)
+
+
+def check_round_trip() -> None:
+    # an expression alarm comes back from its stored document, through JSON like Mongo, with the same program and state
+    alarm = ExpressionAlarm("1-1", "eregl.is", ">", "2.07 * krdmdm.is", "repeat", hysteresis=0.1, cooldown=60.0, armed=False, last_triggered_at=1_700_000_000.0)
+    restored = TickerAlarm.deserialize(json.loads(json.dumps(alarm.serialize())))
+    assert isinstance(restored, ExpressionAlarm)
+    assert restored.serialize() == alarm.serialize() and str(restored) == str(alarm)
+    assert restored.left.program == alarm.left.program and restored.right.program == alarm.right.program
+    assert restored.tickers == ["EREGL.IS", "KRDMDM.IS"] and not restored.armed
+
+    # a ticker against a number stays a plain alarm, with the ticker upper-cased like the index keys
+    plain = Bot.make_alarm("1-2", "aapl", ">", "100", "once", 0.0, 0.0)
+    assert isinstance(plain, TickerAlarm) and plain.ticker == "AAPL" and plain.target == 100.0, str(plain)
+    assert isinstance(TickerAlarm.deserialize(plain.serialize()), TickerAlarm)
+
+
+def check_poller() -> None:
+    # an expression triggers once every ticker has a price and its condition holds, a once alarm is then removed
+    db, notifier = FakeDatabase(), FakeNotifier()
+    poller = TickerPoller(db, None, notifier)
+    poller.subscribe(1, Bot.make_alarm("1-1", "A", ">", "2 * B", "once", 0.0, 0.0))
+    poller.dispatch("A", make_price_dict(10.0))
+    assert notifier.messages == []
+    poller.dispatch("B", make_price_dict(6.0))
+    assert notifier.messages == []
+    poller.dispatch("B", make_price_dict(4.0))
+    assert len(notifier.messages) == 1 and notifier.messages[0][0] == 1, notifier.messages
+    assert db.updates == [("1-1", "trigger")] and poller.alarm_ids() == []
+
+
+if __name__ == "__main__":
+    check_compile()
+    check_evaluate()
+    check_round_trip()
+    check_poller()
+    print("checks passed: compiling, evaluating, storing and restoring expressions, and triggering them in the poller")
@@ -0,0 +1,200 @@
+from typing import Dict, List, Optional, Set
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+import time
+from benchmarks.fake_yahoo import PricePath
+
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode_yahoo_tick(symbol: str, price: float, change: float, change_percent: float, timestamp: float) -> str:
+    # the PricingData fields the bot decodes: id, price, time (sint64 ms), changePercent and change
+    symbol_bytes = symbol.encode()
+    time_ms = int(timestamp * 1000)
+    data = b"\x0a" + encode_varint(len(symbol_bytes)) + symbol_bytes
+    data += b"\x15" + struct.pack("<f", price)
+    data += b"\x18" + encode_varint((time_ms << 1) ^ (time_ms >> 63))
+    data += b"\x45" + struct.pack("<f", change_percent)
+    data += b"\x65" + struct.pack("<f", change)
+    return base64.b64encode(data).decode()
+
+
+def encode_json_tick(symbol: str, price: float, change: float, change_percent: float, timestamp: float) -> str:
+    return json.dumps({"symbol": symbol, "price": price, "change": change, "change_percent": change_percent, "time": timestamp})
+
+
+class FakeStreamConnection:
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.symbols: Set[str] = set()
+        self.closed = False
+
+    def send_text(self, text: str) -> None:
+        payload = text.encode()
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x81, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack("!BBH", 0x81, 126, len(payload))
+        else:
+            header = struct.pack("!BBQ", 0x81, 127, len(payload))
+        self.send_frame(header + payload)
+
+    def send_frame(self, frame: bytes) -> None:
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def recv_exactly(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed")
+            data += chunk
+        return data
+
+    def recv_frame(self) -> tuple:
+        first, second = self.recv_exactly(2)
+        opcode, length = first & 0x0F, second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self.recv_exactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self.recv_exactly(8))[0]
+        # frames from clients are always masked
+        mask = self.recv_exactly(4) if second & 0x80 else b"\x00\x00\x00\x00"
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.recv_exactly(length)))
+        return opcode, payload
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class FakeStreamServer:
+    # a websocket price feed speaking the subscribe/unsubscribe protocol of Yahoo's streamer, in either message format
+    def __init__(self, price_paths: Dict[str, PricePath], stream_format: str = "yahoo", tick_interval: float = 0.1) -> None:
+        self.price_paths = price_paths
+        self.encode = encode_yahoo_tick if stream_format == "yahoo" else encode_json_tick
+        self.tick_interval = tick_interval
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.connections: List[FakeStreamConnection] = []
+        self.accepting = True
+        self.stopped = threading.Event()
+        self.sent_ticks = 0
+        self.connects = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(64)
+
+    @property
+    def url(self) -> str:
+        return f"ws://127.0.0.1:{self.sock.getsockname()[1]}/"
+
+    def start(self) -> None:
+        threading.Thread(target=self.run_acceptor, name="fake_stream_acceptor", daemon=True).start()
+        threading.Thread(target=self.run_ticker, name="fake_stream_ticker", daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.drop_connections()
+        self.sock.close()
+
+    def get_subscribed_symbols(self) -> Set[str]:
+        with self.lock:
+            return set().union(*(connection.symbols for connection in self.connections))
+
+    def drop_connections(self) -> None:
+        # closes the sockets without a close frame, like a network failure would
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+
+    def run_acceptor(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            if not self.accepting:
+                sock.close()
+                continue
+            threading.Thread(target=self.run_connection, args=(sock,), daemon=True).start()
+
+    def handshake(self, sock: socket.socket) -> None:
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("connection closed during handshake")
+            request += chunk
+        headers = dict(line.split(": ", 1) for line in request.decode().split("\r\n")[1:] if ": " in line)
+        key = {name.lower(): value for name, value in headers.items()}["sec-websocket-key"]
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        sock.sendall(f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {accept}\r\n\r\n".encode())
+
+    def run_connection(self, sock: socket.socket) -> None:
+        connection = FakeStreamConnection(sock)
+        try:
+            self.handshake(sock)
+            with self.lock:
+                self.connections.append(connection)
+                self.connects += 1
+            while not connection.closed:
+                opcode, payload = connection.recv_frame()
+                if opcode == 0x1:
+                    message = json.loads(payload)
+                    with self.lock:
+                        connection.symbols.update(symbol.upper() for symbol in message.get("subscribe", []))
+                        connection.symbols.difference_update(symbol.upper() for symbol in message.get("unsubscribe", []))
+                elif opcode == 0x9:
+                    connection.send_frame(struct.pack("!BB", 0x8A, len(payload)) + payload)
+                elif opcode == 0x8:
+                    connection.send_frame(struct.pack("!BB", 0x88, 0))
+                    break
+        except (ConnectionError, OSError, ValueError):
+            pass
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        connection.close()
+
+    def run_ticker(self) -> None:
+        while not self.stopped.wait(self.tick_interval):
+            elapsed, now = time.monotonic() - self.started_at, time.time()
+            with self.lock:
+                connections = [(connection, list(connection.symbols)) for connection in self.connections]
+            for connection, symbols in connections:
+                for symbol in symbols:
+                    path = self.price_paths.get(symbol)
+                    if path is None:
+                        continue
+                    price = path.get_price(elapsed)
+                    try:
+                        connection.send_text(self.encode(symbol, price, price - path.base, 100 * (price - path.base) / path.base, now))
+                    except OSError:
+                        break
+                    self.sent_ticks += 1
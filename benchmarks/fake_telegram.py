@@ -0,0 +1,42 @@
+from typing import Dict, List, Tuple
+from collections import deque
+import threading
+import time
+from telegram.error import RetryAfter
+
+
+class FakeTelegramBot:
+    # enforces limits like Telegram does: a sliding one second window per bot and per chat
+    def __init__(self, global_limit: int = 30, chat_limit: int = 1, latency: float = 0.05, retry_after: float = 1.0) -> None:
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.latency = latency
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.global_window = deque()
+        self.chat_windows: Dict[int, deque] = {}
+        self.messages: List[Tuple[float, int, str]] = []
+        self.rejected = 0
+        # the next this many messages are answered with a 429 whatever the limits
+        self.forced_rejections = 0
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> None:
+        # limits are checked on arrival, the response takes the latency
+        with self.lock:
+            now = time.monotonic()
+            chat_window = self.chat_windows.setdefault(chat_id, deque())
+            for window in (self.global_window, chat_window):
+                while len(window) > 0 and window[0] <= now - 1:
+                    window.popleft()
+            rejected = self.forced_rejections > 0 or len(self.global_window) >= self.global_limit or len(chat_window) >= self.chat_limit
+            if rejected:
+                self.forced_rejections = max(self.forced_rejections - 1, 0)
+                self.rejected += 1
+            else:
+                self.global_window.append(now)
+                chat_window.append(now)
+                self.messages.append((now, chat_id, text))
+
+        time.sleep(self.latency)
+        if rejected:
+            raise RetryAfter(self.retry_after)
@@ -0,0 +1,106 @@
+from typing import Any, Dict, List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import math
+import random
+import threading
+import time
+
+
+class PricePath:
+    # a sine wave around the base price, so that targets near the base are crossed back and forth
+    def __init__(self, base: float, amplitude: float, period: float, phase: float) -> None:
+        self.base = base
+        self.amplitude = amplitude
+        self.period = period
+        self.phase = phase
+
+    def get_price(self, elapsed: float) -> float:
+        return round(self.base * (1 + self.amplitude * math.sin(2 * math.pi * elapsed / self.period + self.phase)), 4)
+
+
+def make_price_paths(tickers: List[str], seed: int = 0) -> Dict[str, PricePath]:
+    rng = random.Random(seed)
+    return {ticker: PricePath(rng.uniform(5, 500), rng.uniform(0.005, 0.03), rng.uniform(60, 300), rng.uniform(0, 2 * math.pi)) for ticker in tickers}
+
+
+class FakeYahooServer:
+    # serves the v8 chart and v7 quote shapes price.py parses, quotes follow scripted price paths
+    def __init__(self, price_paths: Dict[str, PricePath], latency: float = 0.0, time_zone_name: str = "UTC") -> None:
+        self.price_paths = price_paths
+        self.latency = latency
+        self.time_zone_name = time_zone_name
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {"chart": 0, "quote": 0}
+        self.quoted_symbols = 0
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake_yahoo", daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_price(self, symbol: str) -> Optional[float]:
+        path = self.price_paths.get(symbol)
+        return None if path is None else path.get_price(time.monotonic() - self.started_at)
+
+    def get_quote(self, symbol: str) -> Optional[Dict[str, Any]]:
+        price = self.get_price(symbol)
+        if price is None:
+            return None
+        return {"symbol": symbol, "regularMarketPrice": price, "regularMarketPreviousClose": self.price_paths[symbol].base, "regularMarketTime": int(time.time()), "exchangeTimezoneName": self.time_zone_name}
+
+    def get_chart_response(self, symbol: str) -> Dict[str, Any]:
+        quote = self.get_quote(symbol)
+        if quote is None:
+            return {"chart": {"result": None, "error": {"code": "Not Found", "description": "No data found, symbol may be delisted"}}}
+        meta = {"symbol": symbol, "regularMarketPrice": quote["regularMarketPrice"], "previousClose": quote["regularMarketPreviousClose"], "regularMarketTime": quote["regularMarketTime"], "exchangeTimezoneName": self.time_zone_name}
+        return {"chart": {"result": [{"meta": meta}], "error": None}}
+
+    def get_quote_response(self, symbols: List[str]) -> Dict[str, Any]:
+        quotes = [self.get_quote(symbol) for symbol in symbols]
+        return {"quoteResponse": {"result": [quote for quote in quotes if quote is not None], "error": None}}
+
+    def make_handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                if url.path.startswith("/v8/finance/chart/"):
+                    symbol = url.path.rsplit("/", 1)[1].upper()
+                    endpoint, body, num_symbols = "chart", server.get_chart_response(symbol), 1
+                    status = 200 if body["chart"]["result"] is not None else 404
+                elif url.path == "/v7/finance/quote":
+                    symbols = [symbol.upper() for symbol in parse_qs(url.query).get("symbols", [""])[0].split(",") if symbol]
+                    endpoint, body, num_symbols, status = "quote", server.get_quote_response(symbols), len(symbols), 200
+                else:
+                    self.send_error(404)
+                    return
+
+                with server.lock:
+                    server.requests[endpoint] += 1
+                    server.quoted_symbols += num_symbols
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
@@ -0,0 +1,64 @@
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List
+from handler_executor import FairExecutor
+
+
+class LatencyRecorder:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies: List[float] = []
+
+    def make_handler(self, duration: float, record: bool) -> Callable[[float], None]:
+        # stands in for a command handler doing duration seconds of I/O
+        def handler(submitted_at: float) -> None:
+            time.sleep(duration)
+            if record:
+                with self.lock:
+                    self.latencies.append(time.monotonic() - submitted_at)
+        return handler
+
+
+def get_percentile(values: List[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+
+def run(submit: Callable[[int, Callable, Any], Any], recorder: LatencyRecorder, args: argparse.Namespace) -> None:
+    # one user sends slow /prices commands in a burst, the others send quick commands at a steady rate
+    heavy = recorder.make_handler(args.heavy_duration, record=False)
+    light = recorder.make_handler(args.light_duration, record=True)
+    for _ in range(args.heavy_commands):
+        submit(0, heavy, time.monotonic())
+    for i in range(args.light_commands):
+        submit(1 + i % args.users, light, time.monotonic())
+        time.sleep(1 / args.light_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--heavy-commands", type=int, default=20)
+    parser.add_argument("--heavy-duration", type=float, default=2.0)
+    parser.add_argument("--light-commands", type=int, default=200)
+    parser.add_argument("--light-duration", type=float, default=0.01)
+    parser.add_argument("--light-rate", type=float, default=50.0)
+    args = parser.parse_args()
+
+    # dispatcher workers taking commands first come first served, like handlers run inline or with run_async
+    recorder = LatencyRecorder()
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+    run(lambda user_id, func, *func_args: pool.submit(func, *func_args), recorder, args)
+    pool.shutdown(wait=True)
+    print(f"first come first served: other users' commands p50 = {1000 * statistics.median(recorder.latencies):.0f} ms, p99 = {1000 * get_percentile(recorder.latencies, 99):.0f} ms")
+
+    recorder = LatencyRecorder()
+    executor = FairExecutor(workers=args.workers, max_pending_per_user=args.heavy_commands)
+    executor.start()
+    run(executor.submit, recorder, args)
+    executor.stop()
+    print(f"FairExecutor: other users' commands p50 = {1000 * statistics.median(recorder.latencies):.0f} ms, p99 = {1000 * get_percentile(recorder.latencies, 99):.0f} ms")
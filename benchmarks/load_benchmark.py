@@ -0,0 +1,265 @@
+from typing import Any, Dict, List, Optional, Tuple
+from collections import deque
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import threading
+import time
+import mongomock
+import pymongo
+import metrics
+import price
+from benchmarks.fake_telegram import FakeTelegramBot
+from benchmarks.fake_yahoo import FakeYahooServer, make_price_paths
+from bot import Bot
+from db import Database
+
+
+TRIGGERED_ALARM_ID_PATTERN = re.compile(r"alarm triggered\n\[alarm_id = ([^,]+),")
+
+
+class MeasuredDatabase(Database):
+    # counts the documents written to Mongo; with mongomock the alarm and quote updates are skipped and counted apart:
+    # it does not accept the UpdateOne of recent pymongo versions in bulk_write, and without real indexes each update
+    # would scan the whole collection
+    def __init__(self, client: pymongo.MongoClient) -> None:
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.skipped_writes = 0
+        super().__init__(client=client)
+
+    def count_writes(self, num_writes: int, skipped: bool = False) -> None:
+        with self.lock:
+            if skipped:
+                self.skipped_writes += num_writes
+            else:
+                self.writes += num_writes
+
+    def is_mongomock(self) -> bool:
+        return isinstance(self.client, mongomock.MongoClient)
+
+    def insert_ticker_alarm(self, *args: Any) -> None:
+        super().insert_ticker_alarm(*args)
+        self.count_writes(1)
+
+    def flush_ticker_queries(self, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        failed = super().flush_ticker_queries(docs)
+        self.count_writes(len(docs) - len(failed))
+        return failed
+
+    def flush_alarm_updates(self, updates: List[pymongo.UpdateOne]) -> List[pymongo.UpdateOne]:
+        if self.is_mongomock():
+            self.count_writes(len(updates), skipped=True)
+            return []
+        failed = super().flush_alarm_updates(updates)
+        self.count_writes(len(updates) - len(failed))
+        return failed
+
+    def flush_quote_updates(self, updates: List[pymongo.UpdateOne]) -> None:
+        if self.is_mongomock():
+            self.count_writes(len(updates), skipped=True)
+            return
+        super().flush_quote_updates(updates)
+        self.count_writes(len(updates))
+
+
+class FakeChat:
+    def __init__(self, chat_id: int) -> None:
+        self.id = chat_id
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int, message_id: int) -> None:
+        self.chat = FakeChat(chat_id)
+        self.message_id = message_id
+        self.replies: List[str] = []
+
+    def reply_text(self, text: str, **kwargs: Any) -> "FakeMessage":
+        self.replies.append(text)
+        return self
+
+    def edit_text(self, text: str, **kwargs: Any) -> None:
+        # only acknowledgments are edited, they are the last reply
+        self.replies[-1] = text
+
+
+class FakeUpdate:
+    # the parts of telegram.Update the handlers read
+    def __init__(self, chat_id: int, message_id: int) -> None:
+        self.message = FakeMessage(chat_id, message_id)
+        self.callback_query = None
+        self.poll = None
+
+
+class FakeContext:
+    def __init__(self, args: List[str]) -> None:
+        self.args = args
+        self.bot_data: Dict[str, Any] = {}
+
+
+class TriggerRecorder:
+    # remembers when the poller decided to notify each alarm, to be matched with the message the fake bot receives
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.triggered_at: Dict[str, deque] = {}
+        self.num_triggers = 0
+
+    def wrap(self, process_quote: Any) -> Any:
+        def timed_process_quote(ticker: str, price_dict: Optional[Dict[str, Any]]) -> List[Tuple[int, Any]]:
+            subscriptions = process_quote(ticker, price_dict)
+            now = time.monotonic()
+            with self.lock:
+                for _, alarm in subscriptions:
+                    self.triggered_at.setdefault(alarm.alarm_id, deque()).append(now)
+                    self.num_triggers += 1
+            return subscriptions
+        return timed_process_quote
+
+    def get_latencies(self, messages: List[Tuple[float, int, str]]) -> List[float]:
+        latencies = []
+        with self.lock:
+            for sent_at, _, text in messages:
+                for alarm_id in TRIGGERED_ALARM_ID_PATTERN.findall(text):
+                    if len(self.triggered_at.get(alarm_id, ())) > 0:
+                        latencies.append(sent_at - self.triggered_at[alarm_id].popleft())
+        return latencies
+
+
+def make_bot_info(alarm_engine: str) -> Dict[str, Any]:
+    return {
+        "name": "load_benchmark",
+        "handle": "load_benchmark_bot",
+        "description": "load benchmark",
+        "token": "123456:LOAD-BENCHMARK",
+        "github_repo_link": "https://github.com",
+        "config": {"mode": "polling", "alarm_engine": alarm_engine},
+    }
+
+
+def get_percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    if len(values) == 0:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    percentiles = {f"p{p}": round(values[min(int(len(values) * p / 100), len(values) - 1)], 4) for p in (50, 90, 99)}
+    percentiles["max"] = round(values[-1], 4)
+    return percentiles
+
+
+def get_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def get_rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def set_alarms(bot: Bot, server: FakeYahooServer, tickers: List[str], num_users: int, num_alarms: int, seed: int) -> None:
+    rng = random.Random(seed)
+    for i in range(num_alarms):
+        ticker = rng.choice(tickers)
+        current_price = server.get_price(ticker)
+        # targets within the swing of the price path, on the side the price has not crossed yet
+        condition = rng.choice([">", "<"])
+        distance = rng.uniform(0.001, 1.5 * server.price_paths[ticker].amplitude)
+        target = round(current_price * (1 + distance if condition == ">" else 1 - distance), 4)
+        args = [ticker, condition, str(target)] + (["repeat", str(round(current_price * 0.002, 4)), "30"] if rng.random() < 0.2 else [])
+        bot.set_ticker_alarm(FakeUpdate(i % num_users, i), FakeContext(args))
+
+
+def run_queries(bot: Bot, tickers: List[str], num_users: int, rate: float, stop_event: threading.Event, seed: int) -> None:
+    rng = random.Random(seed)
+    message_id = 0
+    while not stop_event.wait(1 / rate):
+        message_id += 1
+        if rng.random() < 0.5:
+            bot.get_ticker_price(FakeUpdate(rng.randrange(num_users), message_id), FakeContext([rng.choice(tickers)]))
+        else:
+            bot.get_ticker_prices(FakeUpdate(rng.randrange(num_users), message_id), FakeContext(rng.sample(tickers, 5)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--alarms", type=int, default=50_000)
+    parser.add_argument("--tickers", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--alarm-engine", type=str, default="asyncio", choices=["job_queue", "asyncio"])
+    parser.add_argument("--query-rate", type=float, default=10.0, help="/price and /prices commands per second")
+    parser.add_argument("--quote-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-global-limit", type=int, default=30)
+    parser.add_argument("--mongo-uri", type=str, default=None)
+    parser.add_argument("--output", type=str, default=None, help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    tickers = [f"T{i}" for i in range(args.tickers)]
+    server = FakeYahooServer(make_price_paths(tickers), latency=args.quote_latency)
+    server.start()
+    price.YAHOO_CHART_URL = f"{server.url}/v8/finance/chart"
+    price.YAHOO_QUOTE_URL = f"{server.url}/v7/finance/quote"
+
+    # mongomock by default, a real mongod gives representative write rates
+    client = mongomock.MongoClient() if args.mongo_uri is None else pymongo.MongoClient(args.mongo_uri)
+    client.drop_database(Database.DB_NAME)
+    db = MeasuredDatabase(client)
+    fake_telegram_bot = FakeTelegramBot(global_limit=args.telegram_global_limit)
+    bot = Bot(make_bot_info(args.alarm_engine), db=db)
+    bot.notifier.bot = fake_telegram_bot
+    recorder = TriggerRecorder()
+    bot.poller.process_quote = recorder.wrap(bot.poller.process_quote)
+    if args.alarm_engine == "job_queue":
+        bot.updater.job_queue.start()
+
+    start = time.monotonic()
+    set_alarms(bot, server, tickers, args.users, args.alarms, seed=0)
+    set_alarms_time = time.monotonic() - start
+
+    stop_event = threading.Event()
+    query_thread = threading.Thread(target=run_queries, args=(bot, tickers, args.users, args.query_rate, stop_event, 1), daemon=True)
+    writes_before, skipped_writes_before, requests_before, symbols_before = db.writes, db.skipped_writes, dict(server.requests), server.quoted_symbols
+    cpu_before, start = get_cpu_seconds(), time.monotonic()
+    query_thread.start()
+    time.sleep(args.duration)
+    stop_event.set()
+    query_thread.join()
+    bot.poller.stop()
+    # pending writes are flushed before the write rate is taken
+    db.close()
+    elapsed, cpu_seconds = time.monotonic() - start, get_cpu_seconds() - cpu_before
+
+    messages = list(fake_telegram_bot.messages)
+    latencies = recorder.get_latencies(messages)
+    num_requests = sum(server.requests.values()) - sum(requests_before.values())
+    results = {
+        "config": vars(args),
+        "set_alarms_per_second": round(args.alarms / set_alarms_time, 1),
+        "quote_requests_per_second": round(num_requests / elapsed, 2),
+        "quote_requests": {endpoint: count - requests_before[endpoint] for endpoint, count in server.requests.items()},
+        "quoted_symbols_per_second": round((server.quoted_symbols - symbols_before) / elapsed, 2),
+        "triggers": recorder.num_triggers,
+        "trigger_to_notification_seconds": get_percentiles(latencies),
+        "notifications_received": len(latencies),
+        "telegram_messages": len(messages),
+        "telegram_429_responses": fake_telegram_bot.rejected,
+        "notifier": bot.notifier.get_stats(),
+        "quote_cache": bot.quote_cache.get_stats(),
+        # only the writes that reached Mongo, the alarm and quote updates only with --mongo-uri
+        "mongo_writes_per_second": round((db.writes - writes_before) / elapsed, 2),
+        "mongo_skipped_writes_per_second": round((db.skipped_writes - skipped_writes_before) / elapsed, 2) if db.is_mongomock() else None,
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_utilization": round(cpu_seconds / elapsed, 3),
+        "rss_bytes": get_rss_bytes(),
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "metrics": metrics.registry.summarize().splitlines(),
+    }
+    server.stop()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output)
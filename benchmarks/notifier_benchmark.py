@@ -0,0 +1,79 @@
+import argparse
+import random
+import time
+from benchmarks.fake_telegram import FakeTelegramBot
+from notifier import Notifier, Priority
+
+
+def check_priority() -> None:
+    # a trigger queued after an info message is still sent first
+    bot = FakeTelegramBot(latency=0.0)
+    notifier = Notifier(bot, workers=1)
+    notifier.send(1, "info", priority=Priority.INFO)
+    notifier.send(2, "alarm triggered", priority=Priority.TRIGGER)
+    notifier.start()
+    notifier.stop()
+    assert [text for _, _, text in bot.messages] == ["alarm triggered", "info"], bot.messages
+
+
+def check_coalescing() -> None:
+    # the queued triggers of a user go out as one message, the ones of other users apart
+    bot = FakeTelegramBot(latency=0.0)
+    notifier = Notifier(bot)
+    for i in range(3):
+        notifier.send(1, f"alarm triggered {i}", priority=Priority.TRIGGER)
+    notifier.send(2, "alarm triggered 3", priority=Priority.TRIGGER)
+    notifier.start()
+    notifier.stop()
+    texts = {chat_id: text for _, chat_id, text in bot.messages}
+    assert len(bot.messages) == 2 and texts == {1: "alarm triggered 0\n\nalarm triggered 1\n\nalarm triggered 2", 2: "alarm triggered 3"}, bot.messages
+    assert notifier.get_stats()["coalesced"] == 2
+
+
+def check_retry_after() -> None:
+    # a message answered with a 429 is sent again once retry_after has passed
+    bot = FakeTelegramBot(latency=0.0, retry_after=0.2)
+    bot.forced_rejections = 1
+    notifier = Notifier(bot)
+    start = time.monotonic()
+    notifier.send(1, "alarm triggered", priority=Priority.TRIGGER)
+    notifier.start()
+    notifier.stop()
+    assert bot.rejected == 1 and [text for _, _, text in bot.messages] == ["alarm triggered"], bot.messages
+    assert bot.messages[0][0] - start >= bot.retry_after
+    stats = notifier.get_stats()
+    assert stats["retried"] == 1 and stats["sent"] == 1 and stats["failed"] == 0, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--triggers", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--infos", type=int, default=100)
+    args = parser.parse_args()
+
+    check_priority()
+    check_coalescing()
+    check_retry_after()
+    print("checks passed: triggers before info messages, per-user coalescing, retry after a 429")
+
+    bot = FakeTelegramBot()
+    notifier = Notifier(bot)
+    rng = random.Random(0)
+
+    # a sharp market move: informational messages already queued, then a burst of triggers
+    start = time.monotonic()
+    for i in range(args.infos):
+        notifier.send(rng.randrange(args.users), f"info {i}", priority=Priority.INFO)
+    for i in range(args.triggers):
+        notifier.send(rng.randrange(args.users), f"alarm triggered {i}", priority=Priority.TRIGGER)
+    notifier.start()
+    notifier.stop()
+    elapsed = time.monotonic() - start
+
+    first_info_at = min(sent_at for sent_at, _, text in bot.messages if text.startswith("info"))
+    triggers_before_first_info = sum(1 for sent_at, _, text in bot.messages if sent_at < first_info_at and text.startswith("alarm"))
+    print(f"triggers = {args.triggers}, infos = {args.infos}, users = {args.users}")
+    print(f"messages sent = {len(bot.messages)}, 429 responses = {bot.rejected}, drain time = {elapsed:.1f} s")
+    print(f"messages sent before the first info message = {triggers_before_first_info}")
+    print(f"notifier stats = {notifier.get_stats()}")
@@ -0,0 +1,142 @@
+import argparse
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+from benchmarks.fake_stream import FakeStreamServer
+from benchmarks.fake_yahoo import make_price_paths
+from price_stream import PriceStream
+from ticker_alarm import TickerAlarm
+from ticker_poller import TickerPoller
+
+
+class TickRecorder:
+    # stands in for alarm evaluation, optionally slower than the feed to show conflation
+    def __init__(self, evaluation_time: float = 0.0) -> None:
+        self.evaluation_time = evaluation_time
+        self.lock = threading.Lock()
+        self.latencies: List[float] = []
+
+    def on_tick(self, ticker: str, price_dict: Dict[str, Any]) -> None:
+        if self.evaluation_time > 0:
+            time.sleep(self.evaluation_time)
+        with self.lock:
+            self.latencies.append(time.time() - price_dict["last_update_datetime"].timestamp())
+
+
+class FakeDatabase:
+    def update_alarm(self, *args: Any) -> None:
+        pass
+
+    def update_alarm_state(self, *args: Any) -> None:
+        pass
+
+
+def wait_until(condition: Any, timeout: float) -> float:
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            return float("inf")
+        time.sleep(0.01)
+    return time.monotonic() - start
+
+
+def get_percentile(values: List[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+
+def start_poller_stream(server: FakeStreamServer, stream_format: str) -> Tuple[TickerPoller, PriceStream]:
+    # a stream subscribed to the tickers of a poller's alarms
+    poller = TickerPoller(FakeDatabase(), None, None)
+    stream = PriceStream(poller.dispatch, url=server.url, stream_format=stream_format)
+    poller.add_ticker_listener(stream.on_tickers_changed)
+    stream.MIN_RECONNECT_DELAY = 0.1
+    stream.start()
+    return poller, stream
+
+
+def check_conflation(server: FakeStreamServer, tickers: List[str], stream_format: str) -> None:
+    # a consumer slower than the feed only evaluates the latest tick of a ticker, the ticks in between are conflated
+    recorder = TickRecorder(evaluation_time=0.01)
+    stream = PriceStream(recorder.on_tick, url=server.url, stream_format=stream_format)
+    stream.on_tickers_changed(tickers, [])
+    stream.start()
+    assert wait_until(lambda: stream.queue.conflated > 0, 10.0) < float("inf"), "no tick was conflated"
+    stream.stop()
+    assert len(recorder.latencies) < server.sent_ticks, (len(recorder.latencies), server.sent_ticks)
+
+
+def check_subscriptions(server: FakeStreamServer, tickers: List[str], stream_format: str) -> None:
+    # the server subscriptions follow the alarms set and unset, and are made again on a second connection after the
+    # server drops the first one
+    poller, stream = start_poller_stream(server, stream_format)
+    for i, ticker in enumerate(tickers[:10]):
+        poller.subscribe(i, TickerAlarm(f"{i}-{i}", ticker, ">", 1e9, "once"))
+    assert wait_until(lambda: server.get_subscribed_symbols() == set(tickers[:10]), 5.0) < float("inf"), server.get_subscribed_symbols()
+    for i in range(5):
+        poller.unsubscribe(f"{i}-{i}")
+    assert wait_until(lambda: server.get_subscribed_symbols() == set(tickers[5:10]), 5.0) < float("inf"), server.get_subscribed_symbols()
+    server.drop_connections()
+    assert wait_until(lambda: server.connects == 2 and server.get_subscribed_symbols() == set(tickers[5:10]), 10.0) < float("inf"), (server.connects, server.get_subscribed_symbols())
+    stream.stop()
+    assert server.connects == 2, server.connects
+
+
+def run_stream(server: FakeStreamServer, tickers: List[str], stream_format: str, evaluation_time: float, duration: float) -> None:
+    recorder = TickRecorder(evaluation_time)
+    stream = PriceStream(recorder.on_tick, url=server.url, stream_format=stream_format)
+    stream.on_tickers_changed(tickers, [])
+    stream.start()
+    time.sleep(duration)
+    stream.stop()
+    latencies = recorder.latencies
+    print(f"evaluation time = {1000 * evaluation_time:.1f} ms: ticks sent = {server.sent_ticks}, evaluated = {len(latencies)}, conflated = {stream.queue.conflated}, "
+          f"tick to evaluation p50 = {1000 * statistics.median(latencies):.1f} ms, p99 = {1000 * get_percentile(latencies, 99):.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tickers", type=int, default=200)
+    parser.add_argument("--tick-interval", type=float, default=0.1, help="seconds between two ticks of a ticker")
+    parser.add_argument("--format", type=str, default="yahoo", choices=["yahoo", "json"])
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+    tickers = [f"T{i}" for i in range(args.tickers)]
+    price_paths = make_price_paths(tickers)
+
+    for check in (check_conflation, check_subscriptions):
+        server = FakeStreamServer(price_paths, stream_format=args.format, tick_interval=args.tick_interval)
+        server.start()
+        check(server, tickers, args.format)
+        server.stop()
+    print("checks passed: ticks conflated behind a slow consumer, subscriptions follow set and unset, resubscribed on a second connect")
+
+    # throughput, then a consumer slower than the feed, where ticks are conflated instead of queued
+    for evaluation_time in (0.0, 0.001):
+        server = FakeStreamServer(price_paths, stream_format=args.format, tick_interval=args.tick_interval)
+        server.start()
+        run_stream(server, tickers, args.format, evaluation_time, args.duration)
+        server.stop()
+
+    # subscriptions follow the alarms of a poller
+    server = FakeStreamServer(price_paths, stream_format=args.format, tick_interval=args.tick_interval)
+    server.start()
+    poller, stream = start_poller_stream(server, args.format)
+    for i, ticker in enumerate(tickers[:10]):
+        poller.subscribe(i, TickerAlarm(f"{i}-{i}", ticker, ">", 1e9, "once"))
+    subscribe_time = wait_until(lambda: server.get_subscribed_symbols() == set(tickers[:10]), 5.0)
+    for i in range(5):
+        poller.unsubscribe(f"{i}-{i}")
+    unsubscribe_time = wait_until(lambda: server.get_subscribed_symbols() == set(tickers[5:10]), 5.0)
+    print(f"server subscriptions follow set in {1000 * subscribe_time:.1f} ms and unset in {1000 * unsubscribe_time:.1f} ms")
+
+    # the server drops every connection, the stream reconnects and subscribes again
+    server.drop_connections()
+    start = time.monotonic()
+    resubscribe_time = wait_until(lambda: server.get_subscribed_symbols() == set(tickers[5:10]), 10.0)
+    ticks_before = server.sent_ticks
+    resume_time = wait_until(lambda: server.sent_ticks > ticks_before, 10.0)
+    print(f"after dropped connections: resubscribed in {1000 * resubscribe_time:.1f} ms, ticks flowing again in {1000 * (resubscribe_time + resume_time):.1f} ms, connects = {server.connects}")
+    stream.stop()
+    server.stop()
@@ -0,0 +1,175 @@
+import argparse
+import datetime as dt
+import random
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import pytz
+from price import CircuitBreaker, PriceProvider, PriceProviderChain
+
+
+class StandInProvider(PriceProvider):
+    # answers after a random latency with a slow tail, and fails while an outage is switched on
+    def __init__(self, name: str, latency: float, slow_latency: float, slow_probability: float, seed: int) -> None:
+        self.name = name
+        super().__init__(CircuitBreaker(failure_threshold=5, reset_timeout=1.0))
+        self.latency = latency
+        self.slow_latency = slow_latency
+        self.slow_probability = slow_probability
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.outage = False
+        self.calls = 0
+
+    def fetch(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        with self.rng_lock:
+            self.calls += 1
+            latency = self.slow_latency if self.rng.random() < self.slow_probability else self.latency
+        if self.outage:
+            time.sleep(self.latency)
+            raise ConnectionError(f"{self.name} is down")
+        time.sleep(latency)
+        return {symbol: {"current_price": 100.0, "absolute_price_change": 0.0, "percentage_price_change": 0.0, "last_update_datetime": dt.datetime.now(pytz.utc)} for symbol in symbols}
+
+
+class ScriptedProvider(PriceProvider):
+    # answers after a fixed latency with the quotes of the symbols it knows (every symbol when None), or fails, and
+    # records the symbols and start time of every call
+    def __init__(self, name: str, latency: float = 0.0, known_symbols: Optional[List[str]] = None, breaker: Optional[CircuitBreaker] = None) -> None:
+        self.name = name
+        super().__init__(breaker)
+        self.latency = latency
+        self.known_symbols = known_symbols
+        self.failing = False
+        self.calls: List[Tuple[List[str], float]] = []
+
+    def fetch(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        self.calls.append((symbols, time.monotonic()))
+        time.sleep(self.latency)
+        if self.failing:
+            raise ConnectionError(f"{self.name} is down")
+        # the price tells which provider answered
+        return {symbol: {"current_price": float(len(self.name)), "provider": self.name} for symbol in symbols if self.known_symbols is None or symbol in self.known_symbols}
+
+
+def check_breaker() -> None:
+    # opens after failure_threshold failures in a row, lets a single trial through once reset_timeout has passed,
+    # closes when it succeeds and opens again when it fails
+    primary = ScriptedProvider("primary", breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.2))
+    secondary = ScriptedProvider("secondary")
+    chain = PriceProviderChain([primary, secondary], hedge_percentile=None)
+    primary.failing = True
+    for _ in range(3):
+        assert chain.get_ticker_infos(["A"])[0]["provider"] == "secondary"
+    assert primary.breaker.state == "open" and len(primary.calls) == 3
+    chain.get_ticker_infos(["A"])
+    assert len(primary.calls) == 3 and chain.get_stats()["short_circuited"] == 1
+
+    time.sleep(0.2)
+    assert primary.breaker.state == "half_open"
+    chain.get_ticker_infos(["A"])
+    assert len(primary.calls) == 4 and primary.breaker.state == "open"
+    time.sleep(0.2)
+    assert primary.breaker.allow_request() and not primary.breaker.allow_request()
+    primary.breaker.record_failure()
+
+    time.sleep(0.2)
+    primary.failing = False
+    assert chain.get_ticker_infos(["A"])[0]["provider"] == "primary"
+    assert len(primary.calls) == 5 and primary.breaker.state == "closed"
+
+
+def check_hedge() -> None:
+    # a request slower than the hedge percentile of the provider's latencies is sent to the next provider as well,
+    # not before that percentile and not before enough latencies are known
+    primary, secondary = ScriptedProvider("primary", latency=0.02), ScriptedProvider("secondary", latency=0.02)
+    chain = PriceProviderChain([primary, secondary], hedge_percentile=90.0)
+    primary.latency = 0.5
+    start = time.monotonic()
+    assert chain.get_ticker_infos(["A"])[0]["provider"] == "primary"
+    assert time.monotonic() - start >= 0.5 and len(secondary.calls) == 0
+
+    primary.latency = 0.02
+    for _ in range(PriceProvider.MIN_LATENCY_SAMPLES):
+        chain.get_ticker_infos(["A"])
+    assert len(secondary.calls) == 0 and chain.get_stats()["hedged"] == 0
+    primary.latency = 0.5
+    start = time.monotonic()
+    assert chain.get_ticker_infos(["A"])[0]["provider"] == "secondary"
+    elapsed, (_, primary_started_at), (_, hedge_started_at) = time.monotonic() - start, primary.calls[-1], secondary.calls[-1]
+    hedge_after = hedge_started_at - primary_started_at
+    assert primary.get_latency_percentile(90.0) <= hedge_after < 0.1 and elapsed < 0.2
+    assert chain.get_stats()["hedged"] == 1 and chain.get_stats()["hedge_wins"] == 1
+
+
+def check_fallback_order() -> None:
+    # each provider is only asked for the symbols the ones before it did not answer, tickers are matched
+    # case-insensitively and asked for once; a failing provider passes all of its symbols on
+    first, second, third = ScriptedProvider("first", known_symbols=["A"]), ScriptedProvider("second", known_symbols=["B"]), ScriptedProvider("third", known_symbols=["C"])
+    chain = PriceProviderChain([first, second, third], hedge_percentile=None)
+    infos = chain.get_ticker_infos(["a", "B", "c", "A", "D"])
+    assert [info["provider"] if info is not None else None for info in infos] == ["first", "second", "third", "first", None]
+    assert [calls[-1][0] for calls in (first.calls, second.calls, third.calls)] == [["A", "B", "C", "D"], ["B", "C", "D"], ["C", "D"]]
+
+    first.failing = True
+    infos = chain.get_ticker_infos(["A", "B"])
+    assert infos[0] is None and infos[1]["provider"] == "second" and second.calls[-1][0] == ["A", "B"]
+    assert chain.get_stats()["failed"] == 1
+
+
+def make_chain(hedge_percentile: Optional[float]) -> PriceProviderChain:
+    primary = StandInProvider("primary", latency=0.02, slow_latency=0.5, slow_probability=0.05, seed=0)
+    secondary = StandInProvider("secondary", latency=0.04, slow_latency=0.5, slow_probability=0.01, seed=1)
+    return PriceProviderChain([primary, secondary], hedge_percentile=hedge_percentile)
+
+
+def measure_latencies(chain: PriceProviderChain, num_requests: int, symbols: List[str]) -> List[float]:
+    latencies = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        chain.get_ticker_infos(symbols)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def get_percentile(values: List[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--tickers", type=int, default=20)
+    args = parser.parse_args()
+    symbols = [f"T{i}" for i in range(args.tickers)]
+
+    check_breaker()
+    check_hedge()
+    check_fallback_order()
+    print("checks passed: breaker open/half-open/close, hedge timing, fallback order")
+
+    for name, hedge_percentile in (("without hedging", None), ("with hedging at p90", 90.0)):
+        chain = make_chain(hedge_percentile)
+        latencies = measure_latencies(chain, args.requests, symbols)
+        stats = chain.get_stats()
+        print(f"{name}: p50 = {1000 * statistics.median(latencies):.1f} ms, p99 = {1000 * get_percentile(latencies, 99):.1f} ms, max = {1000 * max(latencies):.1f} ms, hedged = {stats['hedged']}, hedge wins = {stats['hedge_wins']}")
+
+    # the primary goes down for two seconds, its breaker keeps most requests away from it
+    chain = make_chain(90.0)
+    primary, secondary = chain.providers
+    measure_latencies(chain, 50, symbols)
+    primary_calls, secondary_calls = primary.calls, secondary.calls
+    primary.outage = True
+    outage_ends_at = time.monotonic() + 2.0
+    num_requests, num_answered = 0, 0
+    while time.monotonic() < outage_ends_at:
+        num_requests += 1
+        num_answered += all(info is not None for info in chain.get_ticker_infos(symbols))
+    primary.outage = False
+    outage_primary_calls = primary.calls - primary_calls
+    time.sleep(primary.breaker.reset_timeout)
+    measure_latencies(chain, 10, symbols)
+    print(f"outage: requests = {num_requests}, answered = {num_answered}, calls to the primary = {outage_primary_calls}, calls to the secondary = {secondary.calls - secondary_calls}")
+    print(f"after the outage: primary breaker = {primary.breaker.state}, stats = {chain.get_stats()}")
@@ -0,0 +1,65 @@
+import argparse
+import datetime
+import random
+import time
+import mongomock
+import pymongo
+from db import Database
+from price import QuoteCache
+from ticker_alarm import TickerAlarm
+from ticker_poller import TickerPoller
+
+
+def make_database(mongo_uri: str) -> Database:
+    # mongomock by default, a real mongod gives representative cursor timings
+    client = mongomock.MongoClient() if mongo_uri is None else pymongo.MongoClient(mongo_uri)
+    client.drop_database(Database.DB_NAME)
+    return Database(client=client)
+
+
+def insert_alarms(db: Database, num_alarms: int, num_tickers: int) -> int:
+    # returns the number of active alarms inserted
+    rng = random.Random(0)
+    docs = []
+    for i in range(num_alarms):
+        alarm = TickerAlarm(f"{i}-{i}", f"T{i % num_tickers}", rng.choice([">", "<"]), round(rng.uniform(1, 200), 2), rng.choice(["once", "repeat"]))
+        # a tenth of the stored alarms are no longer active
+        docs.append({"created_at": datetime.datetime.utcnow(), "user_id": i % 1000, "alarm": alarm.serialize(), "active": rng.random() >= 0.1})
+    db.db[Database.TICKER_ALARM_COLLECTION_NAME].insert_many(docs)
+    return sum(doc["active"] for doc in docs)
+
+
+def check_rehydration(poller: TickerPoller, num_rehydrated: int, num_active: int, num_tickers: int) -> None:
+    # every active alarm and none of the inactive ones is subscribed, each ticker gets its index
+    assert num_rehydrated == num_active, (num_rehydrated, num_active)
+    assert len(poller.indexes) == num_tickers, (len(poller.indexes), num_tickers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alarms", type=int, default=50_000)
+    parser.add_argument("--tickers", type=int, default=200)
+    parser.add_argument("--mongo-uri", type=str, default=None)
+    args = parser.parse_args()
+
+    db = make_database(args.mongo_uri)
+    num_active = insert_alarms(db, args.alarms, args.tickers)
+
+    start = time.perf_counter()
+    docs = list(db.find_active_ticker_alarms())
+    cursor_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    TickerPoller(db, QuoteCache(), None).subscribe_many((doc["user_id"], TickerAlarm.deserialize(doc["alarm"])) for doc in docs)
+    registration_time = time.perf_counter() - start
+
+    poller = TickerPoller(db, QuoteCache(), None)
+    start = time.perf_counter()
+    num_rehydrated = poller.rehydrate()
+    time_to_ready = time.perf_counter() - start
+
+    check_rehydration(poller, num_rehydrated, num_active, args.tickers)
+    print("checks passed: every active alarm is rehydrated, every ticker has its index")
+    print(f"stored alarms = {args.alarms}, rehydrated alarms = {num_rehydrated}, tickers = {len(poller.indexes)}")
+    print(f"cursor pass: {cursor_time:.3f} s, deserializing and registering: {registration_time:.3f} s")
+    print(f"time to ready: {time_to_ready:.3f} s")
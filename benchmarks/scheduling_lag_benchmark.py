@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import datetime as dt
+import logging
+import random
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.schedulers.background import BackgroundScheduler
+import pytz
+from async_ticker_poller import AsyncTickerPoller
+from ticker_alarm import TickerAlarm
+
+
+FETCH_LATENCY = 0.05
+SEND_LATENCY = 0.02
+
+
+class FakeQuoteCache:
+    def __init__(self, prices: Dict[str, float]) -> None:
+        self.prices = prices
+
+    def get_many(self, tickers: List[str], allow_stale: bool = True) -> List[Optional[Dict[str, Any]]]:
+        time.sleep(FETCH_LATENCY)
+        now = dt.datetime.now(pytz.utc)
+        return [{"current_price": self.prices[ticker], "last_update_datetime": now} for ticker in tickers]
+
+
+class FakeNotifier:
+    def send(self, user_id: int, text: str, priority: Any = None) -> None:
+        pass
+
+
+class FakeDatabase:
+    def update_alarm(self, alarm_id: str, modification: str) -> None:
+        pass
+
+    def update_alarm_state(self, alarm_id: str, armed: bool, last_triggered_at: Optional[float]) -> None:
+        pass
+
+
+class MeasuredAsyncTickerPoller(AsyncTickerPoller):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.scheduled_at: Dict[str, float] = {}
+        self.lags: List[float] = []
+
+    def get_due_tickers(self, now: float) -> List[str]:
+        with self.lock:
+            self.scheduled_at.update((ticker, poll_at) for ticker, poll_at in self.next_poll_at.items() if poll_at <= now + self.TICK_INTERVAL / 2)
+        return super().get_due_tickers(now)
+
+    async def poll_async(self, tickers: List[str]) -> None:
+        price_dicts = await self.run_blocking(self.quote_cache.get_many, tickers, allow_stale=False)
+        coroutines = []
+        for ticker, price_dict in zip(tickers, price_dicts):
+            subscriptions = self.process_quote(ticker, price_dict)
+            # every alarm of the ticker has been evaluated at this point
+            self.lags.extend([time.monotonic() - self.scheduled_at[ticker]] * len(self.indexes[ticker]))
+            coroutines.extend(self.run_alarm_async(user_id, alarm, price_dict) for user_id, alarm in subscriptions)
+        await asyncio.gather(*coroutines)
+
+
+def make_alarms(num_alarms: int, num_tickers: int) -> List[TickerAlarm]:
+    # about 1% of the alarms are crossed on each check
+    rng = random.Random(0)
+    alarms = []
+    for i in range(num_alarms):
+        condition = rng.choice([">", "<"])
+        target = rng.uniform(99, 200) if condition == ">" else rng.uniform(1, 101)
+        alarms.append(TickerAlarm(f"{i}-{i}", f"T{i % num_tickers}", condition, target, "repeat"))
+    return alarms
+
+
+def benchmark_job_queue(alarms: List[TickerAlarm], interval: float, duration: float) -> Dict[str, Any]:
+    # one APScheduler job per alarm, as telegram.ext.JobQueue ran them before TickerPoller
+    scheduler = BackgroundScheduler(timezone=pytz.utc)
+    # missed runs are counted below instead of being logged one by one
+    logging.getLogger("apscheduler").setLevel(logging.ERROR)
+    lags, missed = [], [0]
+    lock = threading.Lock()
+
+    def alarm_job(alarm: TickerAlarm) -> float:
+        time.sleep(FETCH_LATENCY)
+        if alarm.check_alarm_condition({"current_price": 100.0}):
+            time.sleep(SEND_LATENCY)
+        return time.time()
+
+    def listener(event: Any) -> None:
+        with lock:
+            if event.code == EVENT_JOB_EXECUTED:
+                lags.append(event.retval - event.scheduled_run_time.timestamp() - FETCH_LATENCY)
+            else:
+                missed[0] += 1
+
+    scheduler.add_listener(listener, EVENT_JOB_EXECUTED | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+    scheduler.start()
+    for alarm in alarms:
+        scheduler.add_job(alarm_job, "interval", args=[alarm], seconds=interval)
+    time.sleep(duration)
+    scheduler.shutdown(wait=False)
+    return summarize(lags, missed[0])
+
+
+def benchmark_asyncio(alarms: List[TickerAlarm], interval: float, duration: float) -> Dict[str, Any]:
+    tickers = {alarm.ticker for alarm in alarms}
+    poller = MeasuredAsyncTickerPoller(FakeDatabase(), FakeQuoteCache({ticker: 100.0 for ticker in tickers}), FakeNotifier(), interval=interval)
+    for alarm in alarms:
+        poller.subscribe(0, alarm)
+    poller.start()
+    time.sleep(duration)
+    poller.stop()
+    # fetch latency is not scheduling lag
+    return summarize([lag - FETCH_LATENCY for lag in poller.lags], 0)
+
+
+def summarize(lags: List[float], missed: int) -> Dict[str, Any]:
+    if len(lags) < 2:
+        return {"evaluations": len(lags), "missed": missed}
+    quantiles = statistics.quantiles(lags, n=100)
+    return {
+        "evaluations": len(lags),
+        "missed": missed,
+        "lag_p50": quantiles[49],
+        "lag_p99": quantiles[98],
+        "lag_max": max(lags),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alarms", type=int, default=10_000)
+    parser.add_argument("--tickers", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    alarms = make_alarms(args.alarms, args.tickers)
+    for name, benchmark in [("job_queue", benchmark_job_queue), ("asyncio", benchmark_asyncio)]:
+        result = benchmark(alarms, args.interval, args.duration)
+        print(name, ", ".join(f"{key} = {value:.3f}" if isinstance(value, float) else f"{key} = {value}" for key, value in result.items()))
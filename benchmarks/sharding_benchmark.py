@@ -0,0 +1,160 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import random
+import time
+from typing import Any, List
+import mongomock
+import pymongo
+from benchmarks.fake_yahoo import make_price_paths
+from db import Database
+from sharding import ShardCoordinator
+from ticker_alarm import TickerAlarm
+from ticker_poller import TickerPoller
+
+
+class FakeDatabase:
+    def update_alarm(self, *args: Any) -> None:
+        pass
+
+    def update_alarm_state(self, *args: Any) -> None:
+        pass
+
+
+def make_database(mongo_uri: str) -> Database:
+    # mongomock by default, shared by the coordinators running as threads of this process
+    client = mongomock.MongoClient() if mongo_uri is None else pymongo.MongoClient(mongo_uri)
+    client.drop_database(Database.DB_NAME)
+    return Database(client=client)
+
+
+def make_alarms(num_alarms: int, num_tickers: int) -> List[TickerAlarm]:
+    rng = random.Random(0)
+    return [TickerAlarm(f"{i}-{i}", f"T{i % num_tickers}", rng.choice([">", "<"]), round(rng.uniform(1, 200), 2), "repeat", hysteresis=1.0) for i in range(num_alarms)]
+
+
+def insert_alarms(db: Database, alarms: List[TickerAlarm]) -> None:
+    # stored without a partition, like alarms set before partitioning, the coordinators assign them on start
+    docs = [{"created_at": datetime.datetime.utcnow(), "user_id": i % 1000, "alarm": alarm.serialize(), "active": True} for i, alarm in enumerate(alarms)]
+    db.db[Database.TICKER_ALARM_COLLECTION_NAME].insert_many(docs)
+
+
+def get_subscribed_alarm_ids(pollers: List[TickerPoller]) -> List[str]:
+    return [alarm_id for poller in pollers for alarm_id in poller.alarm_ids()]
+
+
+def wait_until(condition: Any, timeout: float) -> float:
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            return float("inf")
+        time.sleep(0.05)
+    return time.monotonic() - start
+
+
+def get_shares(coordinators: List[ShardCoordinator]) -> List[int]:
+    return [len(coordinator.partitions) for coordinator in coordinators]
+
+
+def is_even(shares: List[int]) -> bool:
+    # every partition owned, and the shares within one of each other
+    return sum(shares) == Database.NUM_PARTITIONS and max(shares) - min(shares) <= 1
+
+
+def run_coordination(db: Database, num_alarms: int, num_workers: int, lease_ttl: float) -> None:
+    pollers = [TickerPoller(FakeDatabase(), None, None) for _ in range(num_workers)]
+    coordinators = [ShardCoordinator(db, poller, worker_id=f"worker-{i}", lease_ttl=lease_ttl, renew_interval=lease_ttl / 3, sync_interval=0.2) for i, poller in enumerate(pollers)]
+    for coordinator in coordinators:
+        coordinator.start()
+
+    # every alarm is evaluated by exactly one worker once the shares settle
+    all_alarm_ids = sorted(f"{i}-{i}" for i in range(num_alarms))
+    is_balanced = lambda: sorted(get_subscribed_alarm_ids(pollers)) == all_alarm_ids and is_even(get_shares(coordinators))
+    balance_time = wait_until(is_balanced, 10 * lease_ttl)
+    assert balance_time < float("inf"), f"shares {get_shares(coordinators)} did not settle"
+    print(f"{num_workers} workers own {get_shares(coordinators)} of {Database.NUM_PARTITIONS} partitions, every alarm subscribed once after {balance_time:.2f} s")
+
+    # an alarm set and unset through the bot process reaches the owning worker on its next sync
+    alarm = TickerAlarm("new-1", "NEW", ">", 100.0, "once")
+    db.insert_ticker_alarm(1, alarm)
+    set_time = wait_until(lambda: "new-1" in get_subscribed_alarm_ids(pollers), 10.0)
+    db.db[Database.TICKER_ALARM_COLLECTION_NAME].update_one({"alarm.alarm_id": "new-1"}, {"$set": {"active": False, "modification": "unset", "modified_at": datetime.datetime.utcnow()}})
+    unset_time = wait_until(lambda: "new-1" not in get_subscribed_alarm_ids(pollers), 10.0)
+    assert set_time < float("inf") and unset_time < float("inf"), (set_time, unset_time)
+    print(f"alarm set picked up in {set_time:.2f} s, unset in {unset_time:.2f} s")
+
+    if num_workers < 2:
+        coordinators[0].stop()
+        return
+
+    # a crashed worker neither renews nor releases its leases, the others take over once they expire
+    crashed = coordinators[0]
+    crashed.stopped.set()
+    crashed.thread.join()
+    orphaned = sorted(crashed.partitions)
+    for partition in orphaned:
+        crashed.drop_partition(partition)
+    start = time.monotonic()
+    db.remove_worker(crashed.worker_id)
+    is_covered = lambda: sorted(get_subscribed_alarm_ids(pollers[1:])) == all_alarm_ids
+    takeover_time = wait_until(is_covered, 10 * lease_ttl)
+    assert takeover_time < 2 * lease_ttl, f"takeover took {takeover_time:.2f} s, lease ttl = {lease_ttl} s"
+    assert wait_until(lambda: is_even(get_shares(coordinators[1:])), 10 * lease_ttl) < float("inf"), f"shares {get_shares(coordinators[1:])} did not settle"
+    print(f"after a worker crashed, its {len(orphaned)} partitions were taken over in {takeover_time:.2f} s (lease ttl = {lease_ttl} s), shares {get_shares(coordinators[1:])}")
+
+    for coordinator in coordinators[1:]:
+        coordinator.stop()
+
+
+def evaluate_partitions(worker: int, num_workers: int, num_alarms: int, num_tickers: int, duration: float, results: multiprocessing.Queue) -> None:
+    # a worker process evaluating quotes of the tickers in its share of the partitions as fast as it can
+    alarms = [alarm for alarm in make_alarms(num_alarms, num_tickers) if Database.get_partition(alarm) % num_workers == worker]
+    poller = TickerPoller(FakeDatabase(), None, None)
+    poller.subscribe_many((0, alarm) for alarm in alarms)
+    price_paths = make_price_paths([f"T{i}" for i in range(num_tickers)])
+    tickers = list(poller.next_poll_at)
+    num_quotes, start = 0, time.monotonic()
+    while time.monotonic() - start < duration:
+        elapsed = time.monotonic() - start
+        for ticker in tickers:
+            poller.process_quote(ticker, {"current_price": price_paths[ticker].get_price(elapsed), "absolute_price_change": 0.0, "percentage_price_change": 0.0, "last_update_datetime": datetime.datetime.now(datetime.timezone.utc)})
+        num_quotes += len(tickers)
+    results.put(num_quotes / (time.monotonic() - start))
+
+
+def run_throughput(num_alarms: int, num_tickers: int, num_workers: int, duration: float) -> float:
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=evaluate_partitions, args=(worker, num_workers, num_alarms, num_tickers, duration, results)) for worker in range(num_workers)]
+    for process in processes:
+        process.start()
+    throughput = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return throughput
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alarms", type=int, default=20_000)
+    parser.add_argument("--tickers", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--lease-ttl", type=float, default=3.0)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--mongo-uri", type=str, default=None)
+    args = parser.parse_args()
+
+    db = make_database(args.mongo_uri)
+    insert_alarms(db, make_alarms(args.alarms, args.tickers))
+    run_coordination(db, args.alarms, args.workers, args.lease_ttl)
+    db.close()
+    print("checks passed: shares within one of each other, alarms set and unset picked up, takeover within 2x the lease ttl")
+
+    # quotes evaluated per second by 1, 2, 4, ... worker processes splitting the partitions
+    print(f"cpus = {os.cpu_count()}")
+    num_workers, baseline = 1, None
+    while num_workers <= args.workers:
+        throughput = run_throughput(args.alarms, args.tickers, num_workers, args.duration)
+        baseline = throughput if baseline is None else baseline
+        print(f"{num_workers} worker processes: {throughput:,.0f} quotes/s, {throughput / baseline:.2f}x")
+        num_workers *= 2
@@ -0,0 +1,111 @@
+import argparse
+import datetime
+import random
+import time
+from typing import Any, Dict, List
+from price import QuoteCache
+from ticker_query import TickerQuery
+from watchlist import ROWS_RENDERED, TABLE_CACHE_HITS, TableCache
+
+
+def make_quote(rng: random.Random, price: float) -> Dict[str, Any]:
+    change = rng.uniform(-2, 2)
+    return {"current_price": price, "absolute_price_change": change, "percentage_price_change": 100 * change / price, "last_update_datetime": datetime.datetime.now(datetime.timezone.utc)}
+
+
+def make_watchlists(num_users: int, num_tickers: int, watchlist_size: int) -> List[List[str]]:
+    # users watch overlapping tickers, the popular ones more often
+    rng = random.Random(0)
+    tickers = [f"T{i}.IS" for i in range(num_tickers)]
+    weights = [1 / (i + 1) for i in range(num_tickers)]
+    watchlists = []
+    for _ in range(num_users):
+        watchlist = []
+        while len(watchlist) < watchlist_size:
+            ticker = rng.choices(tickers, weights)[0]
+            if ticker not in watchlist:
+                watchlist.append(ticker)
+        watchlists.append(watchlist)
+    return watchlists
+
+
+def check_table_cache(watchlists: List[List[str]], num_tickers: int, num_requests: int, changed_per_request: float) -> None:
+    # every table is the one PrettyTable renders, and a row is rendered once for each quote of a ticker that is shown:
+    # once for its first quote and once more for each quote change that a later table shows
+    rng = random.Random(2)
+    prices = {f"T{i}.IS": rng.uniform(10, 500) for i in range(num_tickers)}
+    quote_cache = QuoteCache(ttl=3600, stale_ttl=0, max_size=2 * num_tickers, fetch_func=lambda tickers: [make_quote(rng, prices[ticker]) for ticker in tickers])
+    table_cache = TableCache()
+    rows_rendered = ROWS_RENDERED.value
+    tickers, changes, shown, expected_rows, mismatches = list(prices), 0.0, set(), 0, 0
+    for _ in range(num_requests):
+        changes += changed_per_request
+        while changes >= 1:
+            ticker = rng.choice(tickers)
+            prices[ticker] *= rng.uniform(0.99, 1.01)
+            quote_cache.put(ticker, make_quote(rng, prices[ticker]))
+            shown.discard(ticker)
+            changes -= 1
+
+        watchlist = rng.choice(watchlists)
+        price_dicts = quote_cache.get_many(watchlist)
+        reply = table_cache.get_table_reply(watchlist, price_dicts, quote_cache.get_versions(watchlist, price_dicts), "MARKDOWN_V2")
+        mismatches += reply != TickerQuery.get_table_reply(watchlist, price_dicts, "MARKDOWN_V2")
+        expected_rows += len(set(watchlist) - shown)
+        shown.update(watchlist)
+    assert mismatches == 0, mismatches
+    assert ROWS_RENDERED.value - rows_rendered == expected_rows, (ROWS_RENDERED.value - rows_rendered, expected_rows)
+
+
+def run(watchlists: List[List[str]], num_tickers: int, num_requests: int, changed_per_request: float, use_cache: bool) -> Dict[str, float]:
+    # every request is a /watch of a random user, in between a few quotes change as they would during trading hours
+    rng = random.Random(1)
+    prices = {f"T{i}.IS": rng.uniform(10, 500) for i in range(num_tickers)}
+    quote_cache = QuoteCache(ttl=3600, stale_ttl=0, max_size=2 * num_tickers, fetch_func=lambda tickers: [make_quote(rng, prices[ticker]) for ticker in tickers])
+    table_cache = TableCache()
+    rows_rendered, table_hits = ROWS_RENDERED.value, TABLE_CACHE_HITS.value
+    tickers, changes, render_seconds = list(prices), 0.0, []
+    for _ in range(num_requests):
+        changes += changed_per_request
+        while changes >= 1:
+            ticker = rng.choice(tickers)
+            prices[ticker] *= rng.uniform(0.99, 1.01)
+            quote_cache.put(ticker, make_quote(rng, prices[ticker]))
+            changes -= 1
+
+        watchlist = rng.choice(watchlists)
+        price_dicts = quote_cache.get_many(watchlist)
+        start = time.perf_counter()
+        if use_cache:
+            table_cache.get_table_reply(watchlist, price_dicts, quote_cache.get_versions(watchlist, price_dicts), "MARKDOWN_V2")
+        else:
+            TickerQuery.get_table_reply(watchlist, price_dicts, "MARKDOWN_V2")
+        render_seconds.append(time.perf_counter() - start)
+
+    render_seconds.sort()
+    return {
+        "mean_ms": 1e3 * sum(render_seconds) / len(render_seconds),
+        "p99_ms": 1e3 * render_seconds[int(0.99 * len(render_seconds))],
+        "rows_rendered": ROWS_RENDERED.value - rows_rendered,
+        "table_hits": TABLE_CACHE_HITS.value - table_hits,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tickers", type=int, default=300)
+    parser.add_argument("--watchlist-size", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--changed-per-request", type=float, default=1.0)
+    args = parser.parse_args()
+
+    watchlists = make_watchlists(args.users, args.tickers, args.watchlist_size)
+    # few enough requests that no row is evicted from the cache, so that each quote shown is rendered once
+    check_table_cache(watchlists, args.tickers, min(args.requests, 500), args.changed_per_request)
+    print("checks passed: TableCache renders the same tables as PrettyTable, and one row per quote shown")
+    print(f"users = {args.users}, tickers = {args.tickers}, watchlist size = {args.watchlist_size}, requests = {args.requests}, quotes changed per request = {args.changed_per_request}")
+    for use_cache in (False, True):
+        result = run(watchlists, args.tickers, args.requests, args.changed_per_request, use_cache)
+        name = "TableCache" if use_cache else "PrettyTable per request"
+        print(f"{name}: {result['mean_ms']:.3f} ms/table (p99 {result['p99_ms']:.3f} ms)" + (f", tables served from the cache = {result['table_hits']:.0f}, rows rendered = {result['rows_rendered']:.0f} of {args.requests * args.watchlist_size}" if use_cache else ""))
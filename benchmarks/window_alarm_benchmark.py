@@ -0,0 +1,140 @@
+import argparse
+import math
+import random
+import time
+from bisect import bisect_left, bisect_right
+from typing import List, Optional, Tuple
+from ticker_alarm import AlarmType, Condition, Signal, WindowAlarm
+from window_index import WindowIndex
+
+
+WINDOWS = [60, 300, 900, 1800, 3600, 4 * 3600, 86400]
+
+
+def make_alarms(num_alarms: int) -> List[WindowAlarm]:
+    rng = random.Random(0)
+    alarms = []
+    for i in range(num_alarms):
+        signal, condition = rng.choice(list(Signal)), rng.choice([">", "<"])
+        window = rng.choice(WINDOWS[:-1])
+        if signal == Signal.MOVE:
+            threshold = rng.uniform(0.2, 3.0) * (1 if condition == ">" else -1)
+            alarm = WindowAlarm(f"{i}-{i}", "THYAO.IS", signal, condition, round(threshold, 2), window, None, "repeat", hysteresis=0.1)
+        elif signal == Signal.CROSS:
+            long_window = rng.choice([w for w in WINDOWS if w > window])
+            alarm = WindowAlarm(f"{i}-{i}", "THYAO.IS", signal, condition, 0.0, window, long_window, "repeat", hysteresis=0.05)
+        else:
+            alarm = WindowAlarm(f"{i}-{i}", "THYAO.IS", signal, condition, 0.0, window, None, "repeat", hysteresis=0.2)
+        alarms.append(alarm)
+    return alarms
+
+
+def make_quotes(num_quotes: int, interval: float) -> List[Tuple[float, float]]:
+    # a random walk with a few percent of volatility a day
+    rng = random.Random(1)
+    price, quotes = 100.0, []
+    for i in range(num_quotes):
+        price *= math.exp(rng.gauss(0, 0.0004))
+        quotes.append((1_700_000_000 + i * interval, price))
+    return quotes
+
+
+def get_value(alarm: WindowAlarm, times: List[float], prices: List[float]) -> Optional[float]:
+    # one alarm at a time over the same samples, the reference for the index
+    time, price = times[-1], prices[-1]
+    start = bisect_right(times, time - alarm.window) - 1
+    if alarm.signal == Signal.MOVE:
+        return (price / prices[start] - 1) * 100 if start >= 0 else None
+    elif alarm.signal == Signal.CROSS:
+        if bisect_right(times, time - alarm.long_window) - 1 < 0:
+            return None
+        short = prices[bisect_left(times, time - alarm.window):]
+        long = prices[bisect_left(times, time - alarm.long_window):]
+        return (sum(short) / len(short) / (sum(long) / len(long)) - 1) * 100
+    if start < 0:
+        return None
+    extreme = max(prices[start:-1]) if alarm.condition == Condition.GREATER_THAN else min(prices[start:-1])
+    return (price / extreme - 1) * 100
+
+
+def evaluate_loop(alarms: List[WindowAlarm], times: List[float], prices: List[float], now: float) -> List[str]:
+    triggered = []
+    for alarm in alarms:
+        value = get_value(alarm, times, prices)
+        if value is None:
+            continue
+        distance = (value - alarm.threshold) * (1 if alarm.condition == Condition.GREATER_THAN else -1)
+        if not alarm.armed:
+            if distance < -alarm.hysteresis:
+                alarm.armed = True
+            continue
+        if distance > 0 and not (alarm.alarm_type == AlarmType.REPEAT and alarm.is_cooling_down(now)):
+            alarm.armed = False
+            alarm.last_triggered_at = now
+            triggered.append(alarm.alarm_id)
+    return triggered
+
+
+def make_index(alarms: List[WindowAlarm], quotes: List[Tuple[float, float]]) -> Tuple[WindowIndex, List[float], List[float]]:
+    # the index after the quotes, and lists of the samples its ring buffer holds for the per-alarm loop
+    index = WindowIndex()
+    index.insert_many(alarms)
+    for quote_time, price in quotes:
+        index.add_sample(quote_time, price)
+    capacity = index.buffer.capacity
+    return index, [quote_time for quote_time, _ in quotes][-capacity:], [price for _, price in quotes][-capacity:]
+
+
+def check_triggers(num_alarms: int, warmup_quotes: List[Tuple[float, float]], quotes: List[Tuple[float, float]]) -> None:
+    # the index triggers the same alarms as the per-alarm loop on every quote, and some of them do trigger
+    index, times, prices = make_index(make_alarms(num_alarms), warmup_quotes)
+    loop_alarms, capacity = make_alarms(num_alarms), index.buffer.capacity
+    num_triggered, mismatches = 0, 0
+    for i, (quote_time, price) in enumerate(quotes):
+        index.add_sample(quote_time, price)
+        triggered, _ = index.evaluate(float(i))
+        times, prices = (times + [quote_time])[-capacity:], (prices + [price])[-capacity:]
+        expected = evaluate_loop(loop_alarms, times, prices, float(i))
+        num_triggered += len(triggered)
+        mismatches += len(set(expected) ^ {alarm.alarm_id for alarm in triggered})
+    assert mismatches == 0, mismatches
+    assert num_triggered > 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alarms", type=int, default=30_000)
+    parser.add_argument("--quotes", type=int, default=200)
+    parser.add_argument("--loop-quotes", type=int, default=10)
+    args = parser.parse_args()
+
+    # a day of quotes every 10 s before the measured ones, so that every window is covered
+    warmup = 86400 // int(WindowIndex.RESOLUTION)
+    quotes = make_quotes(warmup + args.quotes, WindowIndex.RESOLUTION)
+    check_triggers(args.alarms, quotes[:warmup], quotes[warmup:warmup + args.loop_quotes])
+    print(f"checks passed: the window index triggers the same alarms as the per-alarm loop over {args.loop_quotes} quotes")
+
+    index, times, prices = make_index(make_alarms(args.alarms), quotes[:warmup])
+    capacity = index.buffer.capacity
+    print(f"alarms = {args.alarms} on one ticker, ring buffer of {capacity} samples")
+
+    index_seconds, num_triggered = [], 0
+    for i, (quote_time, price) in enumerate(quotes[warmup:]):
+        start = time.perf_counter()
+        index.add_sample(quote_time, price)
+        triggered, _ = index.evaluate(float(i))
+        index_seconds.append(time.perf_counter() - start)
+        num_triggered += len(triggered)
+
+    loop_seconds, loop_alarms = [], make_alarms(args.alarms)
+    for i, (quote_time, price) in enumerate(quotes[warmup:warmup + args.loop_quotes]):
+        # the loop keeps a list of the same samples the ring buffer holds
+        times, prices = (times + [quote_time])[-capacity:], (prices + [price])[-capacity:]
+        start = time.perf_counter()
+        evaluate_loop(loop_alarms, times, prices, float(i))
+        loop_seconds.append(time.perf_counter() - start)
+
+    index_seconds.sort()
+    print(f"triggers = {num_triggered} over {args.quotes} quotes")
+    print(f"per-alarm loop: {1e3 * sum(loop_seconds) / len(loop_seconds):.2f} ms/quote")
+    print(f"window index: {1e3 * sum(index_seconds) / len(index_seconds):.2f} ms/quote (p50 {1e3 * index_seconds[len(index_seconds) // 2]:.2f}, p99 {1e3 * index_seconds[int(len(index_seconds) * 0.99)]:.2f})")
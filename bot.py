@@ -1,6 +1,8 @@
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from enum import Enum
-from functools import partial
+import re
+import signal
+import threading
 from telegram import Update
 from telegram.ext import (
     CallbackContext,
@@ -9,8 +11,20 @@ from telegram.ext import (
 )
 from telegram.parsemode import ParseMode
 from db import Database
-from ticker_alarm import TickerAlarm
+from expression import CompiledExpression, ExpressionError
+from handler_executor import FairExecutor
+from metrics import MetricsLogger, MetricsServer
+from notifier import Notifier
+from price import QuoteCache
+from price_stream import PriceStream
+from quote_store import QuoteStore
+from async_ticker_poller import AsyncTickerPoller
+from sharding import RemotePoller, ShardCoordinator
+from ticker_alarm import ExpressionAlarm, Signal, TickerAlarm, WindowAlarm
+from ticker_poller import TickerPoller
 from ticker_query import TickerQuery
+from watchlist import TableCache
+from window_index import np
 
 
 ABOUT_COMMAND = "about"
@@ -20,14 +34,14 @@ HELP_COMMAND = "help"
 HELP_USAGE = f"/{HELP_COMMAND}"
 HELP_DESCRIPTION = "list of all commands, their usage and description"
 SET_TICKER_ALARM_COMMAND = "set"
-SET_TICKER_ALARM_USAGE = f"/{SET_TICKER_ALARM_COMMAND} <ticker: str> <condition: ['<', '>']>  <target: float> (<type: ['once', 'repeat']; default = 'once'>)"
-SET_TICKER_ALARM_DESCRIPTION = "set an alarm for ticker with condition and target to get notified"
+SET_TICKER_ALARM_USAGE = f"/{SET_TICKER_ALARM_COMMAND} <ticker_or_expression: str> <condition: ['<', '>']>  <target_or_expression: float | str> (<type: ['once', 'repeat']; default = 'once'>) (<hysteresis: float; default = 0>) (<cooldown_seconds: float; default = 0>)"
+SET_TICKER_ALARM_DESCRIPTION = "set an alarm for ticker with condition and target to get notified, both sides can be expressions of tickers (e.g. EREGL.IS > 2.07 * KRDMDM.IS), or a signal over a window of recent quotes: <ticker> move <condition> <percent> <window>, <ticker> cross <condition> <short_window> <long_window> for moving averages, <ticker> breakout <condition> <window> for the high or low (e.g. AAPL move > 5 1h, AAPL cross > 20m 1h, AAPL breakout < 1d)"
 UNSET_TICKER_ALARM_COMMAND = "unset"
 UNSET_TICKER_ALARM_USAGE = f"/{UNSET_TICKER_ALARM_COMMAND} <alarm_id: str>"
 UNSET_TICKER_ALARM_DESCRIPTION = "unset an alarm"
 UNSET_ALL_TICKER_ALARMS_COMMAND = "unset_all"
 UNSET_ALL_TICKER_ALARMS_USAGE = f"/{UNSET_ALL_TICKER_ALARMS_COMMAND}"
-UNSET_ALL_TICKER_ALARMS_DESCRIPTION = "unset all alarms"
+UNSET_ALL_TICKER_ALARMS_DESCRIPTION = "unset all your alarms"
 LIST_TICKER_ALARMS_COMMAND = "list"
 LIST_TICKER_ALARMS_USAGE = f"/{LIST_TICKER_ALARMS_COMMAND}"
 LIST_TICKER_ALARMS_DESCRIPTION = "list all alarms"
@@ -37,6 +51,17 @@ GET_TICKER_PRICE_DESCRIPTION = "get price of ticker"
 GET_TICKER_PRICES_COMMAND = "prices"
 GET_TICKER_PRICES_USAGE = f"/{GET_TICKER_PRICES_COMMAND} <ticker1: str> <ticker2: str> <ticker3: str> ..."
 GET_TICKER_PRICES_DESCRIPTION = "get price of multiple tickers"
+WATCH_COMMAND = "watch"
+WATCH_USAGE = f"/{WATCH_COMMAND} (add <name: str> <ticker1: str> <ticker2: str> ... | remove <name: str> (<ticker1: str> <ticker2: str> ...) | <name: str>)"
+WATCH_DESCRIPTION = "add tickers to or remove them from a named watchlist, or get the prices of a watchlist; without arguments lists your watchlists"
+
+# /prices with at least this many tickers is acknowledged at once, the acknowledgment is edited into the reply
+LONG_QUERY_MIN_TICKERS = 5
+# a watchlist table longer than this would not fit in a message
+MAX_WATCHLIST_TICKERS = 50
+
+# splits the arguments of /set on the first condition, expressions may or may not have spaces around it
+ALARM_CONDITION_PATTERN = re.compile(r"\s*([<>])\s*")
 
 
 class BotMode(Enum):
@@ -44,16 +69,57 @@ class BotMode(Enum):
     WEBHOOK = "webhook"
 
 
+class AlarmEngine(Enum):
+    JOB_QUEUE = "job_queue"
+    ASYNCIO = "asyncio"
+
+
+class Role(Enum):
+    # a bot process handles commands, worker processes evaluate the alarms of their partitions, all does both
+    ALL = "all"
+    BOT = "bot"
+    WORKER = "worker"
+
+
 class Bot:
-    def __init__(self, bot_info: Dict[str, Any]) -> None:
+    UPDATER_WORKERS = 4
+    WEBHOOK_LISTEN = "0.0.0.0"
+    WEBHOOK_PORT = 8443
+
+    def __init__(self, bot_info: Dict[str, Any], db: Optional[Database] = None) -> None:
         self.name = bot_info["name"]
         self.handle = bot_info["handle"]
         self.description = bot_info["description"]
         self.token = bot_info["token"]
         self.github_repo_link = bot_info["github_repo_link"]
         self.mode = self._make_mode(bot_info["config"]["mode"])
-        self.updater = self._make_updater(bot_info["token"])
-        self.db = Database()
+        self.alarm_engine = self._make_alarm_engine(bot_info["config"].get("alarm_engine", AlarmEngine.JOB_QUEUE.value))
+        self.role = self._make_role(bot_info["config"].get("role", Role.ALL.value))
+        self.webhook = bot_info["config"].get("webhook", {})
+        self.handler_executor = FairExecutor(**bot_info["config"].get("handler_executor", {}))
+        self.handler_executor.start()
+        self.updater = self._make_updater(bot_info["token"], bot_info["config"].get("updater_workers", self.UPDATER_WORKERS))
+        self.db = Database() if db is None else db
+        self.quote_cache = QuoteCache(**bot_info["config"].get("quote_cache", {}))
+        self.quote_store = QuoteStore(self.db, **bot_info["config"].get("quote_store", {}))
+        self.quote_cache.add_quote_listener(self.quote_store.add)
+        self.quote_store.start()
+        self.table_cache = TableCache(**bot_info["config"].get("watchlist_table_cache", {}))
+        self.notifier = Notifier(self.updater.bot, **bot_info["config"].get("notifier", {}))
+        self.notifier.start()
+        self.poller = self._make_poller(self.alarm_engine) if self.role != Role.BOT else RemotePoller(self.db)
+        if self.role != Role.BOT:
+            # window alarms start with the quotes stored before they were set or before a restart
+            self.poller.set_quote_history(self.quote_store.get_quotes)
+        self.shard_coordinator = None
+        if self.role == Role.WORKER:
+            self.shard_coordinator = ShardCoordinator(self.db, self.poller, **bot_info["config"].get("sharding", {}))
+            self.shard_coordinator.start()
+        else:
+            self.poller.rehydrate()
+        self.poller.start(self.updater.job_queue)
+        self.price_stream = self._make_price_stream(bot_info["config"].get("price_stream")) if self.role != Role.BOT else None
+        self.metrics_server, self.metrics_logger = self._make_metrics(bot_info["config"].get("metrics", {}))
         self.reply_mode = "MARKDOWN_V2"
 
     def _make_mode(self, mode: str) -> BotMode:
@@ -63,18 +129,72 @@ class Bot:
             raise ValueError(f"mode = f{mode} is unknown, expected BotMode.")
         return bot_mode
 
-    def _make_updater(self, token: str) -> None:
-        updater = Updater(token)
+    def _make_alarm_engine(self, alarm_engine: str) -> AlarmEngine:
+        try:
+            engine = AlarmEngine(alarm_engine)
+        except ValueError:
+            raise ValueError(f"alarm_engine = {alarm_engine} is unknown, expected AlarmEngine.")
+        return engine
+
+    def _make_role(self, role: str) -> Role:
+        try:
+            bot_role = Role(role)
+        except ValueError:
+            raise ValueError(f"role = {role} is unknown, expected Role.")
+        return bot_role
+
+    def _make_poller(self, alarm_engine: AlarmEngine) -> TickerPoller:
+        if alarm_engine == AlarmEngine.JOB_QUEUE:
+            return TickerPoller(self.db, self.quote_cache, self.notifier)
+        elif alarm_engine == AlarmEngine.ASYNCIO:
+            return AsyncTickerPoller(self.db, self.quote_cache, self.notifier)
+        else:
+            raise ValueError("Unknown alarm_engine attribute.")
+
+    def _make_price_stream(self, price_stream_config: Optional[Dict[str, Any]]) -> Optional[PriceStream]:
+        # ticks are evaluated as they arrive, polling stays on for tickers the stream is silent about
+        if price_stream_config is None:
+            return None
+        price_stream = PriceStream(self.on_price_tick, **price_stream_config)
+        self.poller.add_ticker_listener(price_stream.on_tickers_changed)
+        price_stream.start()
+        return price_stream
+
+    def on_price_tick(self, ticker: str, price_dict: Dict[str, Any]) -> None:
+        self.quote_cache.put(ticker, price_dict)
+        self.poller.dispatch(ticker, price_dict)
+
+    def _make_metrics(self, metrics_config: Dict[str, Any]) -> Tuple[Optional[MetricsServer], Optional[MetricsLogger]]:
+        # the Prometheus endpoint is served when a port is given, the log dump when an interval is given
+        metrics_server, metrics_logger = None, None
+        if metrics_config.get("port") is not None:
+            metrics_server = MetricsServer(host=metrics_config.get("host", "0.0.0.0"), port=metrics_config["port"])
+            metrics_server.start()
+        if metrics_config.get("log_interval"):
+            metrics_logger = MetricsLogger(metrics_config["log_interval"])
+            metrics_logger.start()
+        return metrics_server, metrics_logger
+
+    def _make_updater(self, token: str, workers: int) -> Updater:
+        # workers are the dispatcher threads taking updates, handlers doing I/O only queue the command on them
+        updater = Updater(token, workers=workers)
         updater.dispatcher.add_handler(CommandHandler(ABOUT_COMMAND, self.about))
         updater.dispatcher.add_handler(CommandHandler(HELP_COMMAND, self.help))
-        updater.dispatcher.add_handler(CommandHandler(SET_TICKER_ALARM_COMMAND, self.set_ticker_alarm))
-        updater.dispatcher.add_handler(CommandHandler(UNSET_TICKER_ALARM_COMMAND, self.unset_ticker_alarm))
-        updater.dispatcher.add_handler(CommandHandler(UNSET_ALL_TICKER_ALARMS_COMMAND, self.unset_all_ticker_alarms))
-        updater.dispatcher.add_handler(CommandHandler(LIST_TICKER_ALARMS_COMMAND, self.list_ticker_alarms))
-        updater.dispatcher.add_handler(CommandHandler(GET_TICKER_PRICE_COMMAND, self.get_ticker_price))
-        updater.dispatcher.add_handler(CommandHandler(GET_TICKER_PRICES_COMMAND, self.get_ticker_prices))
+        updater.dispatcher.add_handler(CommandHandler(SET_TICKER_ALARM_COMMAND, self.offload(self.set_ticker_alarm)))
+        updater.dispatcher.add_handler(CommandHandler(UNSET_TICKER_ALARM_COMMAND, self.offload(self.unset_ticker_alarm)))
+        updater.dispatcher.add_handler(CommandHandler(UNSET_ALL_TICKER_ALARMS_COMMAND, self.offload(self.unset_all_ticker_alarms)))
+        updater.dispatcher.add_handler(CommandHandler(LIST_TICKER_ALARMS_COMMAND, self.offload(self.list_ticker_alarms)))
+        updater.dispatcher.add_handler(CommandHandler(GET_TICKER_PRICE_COMMAND, self.offload(self.get_ticker_price)))
+        updater.dispatcher.add_handler(CommandHandler(GET_TICKER_PRICES_COMMAND, self.offload(self.get_ticker_prices)))
+        updater.dispatcher.add_handler(CommandHandler(WATCH_COMMAND, self.offload(self.watch)))
         return updater
 
+    def offload(self, handler: Callable[[Update, CallbackContext], None]) -> Callable[[Update, CallbackContext], None]:
+        def submit(update: Update, context: CallbackContext) -> None:
+            if not self.handler_executor.submit(self.get_user_id(update, context), handler, update, context):
+                update.message.reply_text("too many commands in progress, please wait for them to finish")
+        return submit
+
     def get_user_id(self, update: Update, context: CallbackContext) -> int:
         if update.message is not None:
             # text message
@@ -107,14 +227,47 @@ class Bot:
         return message_id
 
     def run(self) -> None:
-        if self.mode == BotMode.POLLING:
+        if self.role == Role.WORKER:
+            # no commands are handled, only the job queue runs for the poller
+            self.updater.job_queue.start()
+            self.idle()
+            self.updater.job_queue.stop()
+            self.stop()
+        elif self.mode == BotMode.POLLING:
             self.updater.start_polling()
             self.updater.idle()
+            self.stop()
         elif self.mode == BotMode.WEBHOOK:
-            self.updater.start_webhook(listen="0.0.0.0", port=8443, url_path=self.token, webhook_url=f"https://{self.name}.herokuapp.com/{self.token}")
+            url = self.webhook.get("url", f"https://{self.name}.herokuapp.com")
+            self.updater.start_webhook(listen=self.webhook.get("listen", self.WEBHOOK_LISTEN), port=self.webhook.get("port", self.WEBHOOK_PORT), url_path=self.token, webhook_url=f"{url}/{self.token}")
+            self.updater.idle()
+            self.stop()
         else:
             raise ValueError("Unknow mode attribute.")
 
+    def idle(self) -> None:
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stopped.set())
+        while not stopped.wait(1):
+            pass
+
+    def stop(self) -> None:
+        # the leases are released first, so that the other workers take over while this one shuts down
+        self.handler_executor.stop()
+        if self.shard_coordinator is not None:
+            self.shard_coordinator.stop()
+        if self.price_stream is not None:
+            self.price_stream.stop()
+        self.poller.stop()
+        self.notifier.stop()
+        self.quote_store.stop()
+        self.db.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.metrics_logger is not None:
+            self.metrics_logger.stop()
+
     def about(self, update: Update, context: CallbackContext) -> None:
         update.message.reply_text(f"Please see the GitHub repo [here]({self.github_repo_link})", parse_mode=ParseMode.MARKDOWN_V2)
 
@@ -132,42 +285,67 @@ class Bot:
         query_str = "Query\n"
         query_str += f"/{GET_TICKER_PRICE_COMMAND}\n{GET_TICKER_PRICE_DESCRIPTION}\nusage = {GET_TICKER_PRICE_USAGE}\n\n"
         query_str += f"/{GET_TICKER_PRICES_COMMAND}\n{GET_TICKER_PRICES_DESCRIPTION}\nusage = {GET_TICKER_PRICES_USAGE}\n\n"
+        query_str += f"/{WATCH_COMMAND}\n{WATCH_DESCRIPTION}\nusage = {WATCH_USAGE}\n\n"
 
         reply = "\n\n".join([misc_str, alarm_str, query_str])
         update.message.reply_text(reply)
 
     def set_ticker_alarm(self, update: Update, context: CallbackContext) -> None:
         user_id, message_id = self.get_user_id(update, context), self.get_message_id(update, context)
-        args = context.args
+        parts = ALARM_CONDITION_PATTERN.split(" ".join(context.args), maxsplit=1)
 
-        if len(args) < 3:
+        if len(parts) < 3 or len(parts[0]) == 0 or len(parts[2]) == 0:
             update.message.reply_text(f"/{SET_TICKER_ALARM_COMMAND} usage: {SET_TICKER_ALARM_USAGE}")
             return
 
-        ticker = args[0]  # TODO: check if valid ticker
-
-        condition = args[1]
-        if condition not in ["<", ">"]:
-            update.message.reply_text(f"valid condition options: '<', '>'")
+        left, condition, rest = parts
+        # the target ends where the options start
+        args = rest.split()
+        options_at = next((i for i, arg in enumerate(args) if arg.lower() in ["once", "repeat"]), len(args))
+        right, options = " ".join(args[:options_at]), args[options_at:]
+        if len(right) == 0:
+            update.message.reply_text(f"/{SET_TICKER_ALARM_COMMAND} usage: {SET_TICKER_ALARM_USAGE}")
             return
 
+        alarm_type = options[0].lower() if len(options) > 0 else "once"
+
         try:
-            target = float(args[2])
+            hysteresis = float(options[1]) if len(options) > 1 else 0.0
+            cooldown = float(options[2]) if len(options) > 2 else 0.0
         except ValueError:
-            update.message.reply_text(f"target should be int or float (e.g. 43, 65.1, 4.09)")
+            update.message.reply_text(f"hysteresis and cooldown_seconds should be int or float (e.g. 0.5, 600)")
+            return
+        if hysteresis < 0 or cooldown < 0:
+            update.message.reply_text(f"hysteresis and cooldown_seconds should not be negative")
             return
 
-        alarm_type = args[3].lower() if len(args) > 3 else "once"
-        if alarm_type not in ["once", "repeat"]:
-            update.message.reply_text(f"valid alarm_type options: 'once', 'repeat'")
+        try:
+            alarm = self.make_alarm(TickerAlarm.make_alarm_id(user_id, message_id), left, condition, right, alarm_type, hysteresis, cooldown)
+        except ValueError as e:
+            # ExpressionError as well
+            update.message.reply_text(f"invalid alarm: {e}")
             return
 
-        alarm = TickerAlarm(TickerAlarm.make_alarm_id(user_id, message_id), ticker, condition, target, alarm_type)
         self.db.insert_ticker_alarm(user_id, alarm)
-        callback_func = partial(TickerAlarm.run, alarm=alarm, db=self.db)
-        context.job_queue.run_repeating(callback_func, interval=10, first=1, last=None, context={"user_id": user_id}, name=alarm.name)
+        self.poller.subscribe(user_id, alarm)
         update.message.reply_text(alarm.get_ticker_alarm_set_message_text())
 
+    @staticmethod
+    def make_alarm(alarm_id: str, left: str, condition: str, right: str, alarm_type: str, hysteresis: float, cooldown: float) -> Union[TickerAlarm, ExpressionAlarm, WindowAlarm]:
+        # a ticker followed by a signal is a window alarm
+        words = left.split()
+        if len(words) == 2 and words[1].lower() in [signal.value for signal in Signal]:
+            if np is None:
+                raise ValueError("window alarms are not available, numpy is not installed")
+            return WindowAlarm.parse(alarm_id, words[0], words[1], condition, right.split(), alarm_type, hysteresis, cooldown)
+        # a ticker against a number stays a plain alarm served by the threshold index, anything else is an expression
+        left_expression, right_expression = CompiledExpression.compile(left), CompiledExpression.compile(right)
+        if left_expression.is_constant and right_expression.is_constant:
+            raise ExpressionError("at least one side should have a ticker")
+        if left_expression.program == [("ticker", left.upper())] and right_expression.is_constant and len(right_expression.program) == 1:
+            return TickerAlarm(alarm_id, left.upper(), condition, right_expression.program[0][1], alarm_type, hysteresis=hysteresis, cooldown=cooldown)
+        return ExpressionAlarm(alarm_id, left_expression, condition, right_expression, alarm_type, hysteresis=hysteresis, cooldown=cooldown)
+
     def unset_ticker_alarm(self, update: Update, context: CallbackContext) -> None:
         args = context.args
 
@@ -176,16 +354,16 @@ class Bot:
             return
         
         alarm_id = args[0]
-        is_removed, message = TickerAlarm.remove_alarm_from_jobs(self.db, context, alarm_id, modification="unset")
+        is_removed, message = TickerAlarm.remove_alarm_from_poller(self.db, self.poller, alarm_id, modification="unset", user_id=self.get_user_id(update, context))
         update.message.reply_text(message)
 
     def unset_all_ticker_alarms(self, update: Update, context: CallbackContext) -> None:
-        is_removed, message = TickerAlarm.remove_all_alarms_from_jobs(self.db, context, modification="unset")
+        is_removed, message = TickerAlarm.remove_all_alarms_from_poller(self.db, self.poller, self.get_user_id(update, context), modification="unset")
         update.message.reply_text(message)
 
     def list_ticker_alarms(self, update: Update, context: CallbackContext) -> None:
         user_id = self.get_user_id(update, context)
-        alarms = [TickerAlarm(**doc["alarm"]) for doc in self.db.find_active_ticker_alarms_of_user(user_id)]
+        alarms = self.poller.alarms_of_user(user_id)
         texts = [str(alarm) for alarm in alarms]
         update.message.reply_text("\n\n".join(texts) if len(texts) > 0 else "no alarm")
 
@@ -198,7 +376,7 @@ class Bot:
         ticker = args[0]
 
         ticker_query = TickerQuery(ticker)
-        reply, parse_mode = TickerQuery.run_and_get_reply(ticker_query, user_id, self.db, reply_mode=self.reply_mode)
+        reply, parse_mode = TickerQuery.run_and_get_reply(ticker_query, user_id, self.db, self.quote_cache, reply_mode=self.reply_mode)
         update.message.reply_text(reply, parse_mode=parse_mode)
 
     def get_ticker_prices(self, update: Update, context: CallbackContext) -> None:
@@ -209,6 +387,80 @@ class Bot:
             return
         tickers = args  # TODO: check if valid ticker
 
+        ack = update.message.reply_text(f"fetching {len(tickers)} tickers...") if len(tickers) >= LONG_QUERY_MIN_TICKERS else None
         ticker_query_lst = [TickerQuery(ticker) for ticker in tickers]
-        reply, parse_mode = TickerQuery.run_multiple_and_get_reply(ticker_query_lst, user_id, self.db, reply_mode=self.reply_mode)
-        update.message.reply_text(reply, parse_mode=parse_mode)
+        reply, parse_mode = TickerQuery.run_multiple_and_get_reply(ticker_query_lst, user_id, self.db, self.quote_cache, reply_mode=self.reply_mode)
+        if ack is not None:
+            ack.edit_text(reply, parse_mode=parse_mode)
+        else:
+            update.message.reply_text(reply, parse_mode=parse_mode)
+
+    def watch(self, update: Update, context: CallbackContext) -> None:
+        args = context.args
+        if len(args) == 0:
+            self.list_watchlists(update, context)
+        elif args[0].lower() == "add":
+            self.add_to_watchlist(update, context, args[1:])
+        elif args[0].lower() == "remove":
+            self.remove_from_watchlist(update, context, args[1:])
+        else:
+            self.get_watchlist(update, context, args[0].lower())
+
+    def list_watchlists(self, update: Update, context: CallbackContext) -> None:
+        docs = self.db.find_watchlists_of_user(self.get_user_id(update, context))
+        texts = [f"{doc['name']}: {' '.join(doc['tickers'])}" for doc in docs]
+        update.message.reply_text("\n".join(texts) if len(texts) > 0 else "no watchlist")
+
+    def add_to_watchlist(self, update: Update, context: CallbackContext, args: List[str]) -> None:
+        if len(args) < 2:
+            update.message.reply_text(f"/{WATCH_COMMAND} usage: {WATCH_USAGE}")
+            return
+        user_id = self.get_user_id(update, context)
+        name, tickers = args[0].lower(), list(dict.fromkeys(ticker.upper() for ticker in args[1:]))
+
+        doc = self.db.find_watchlist(user_id, name)
+        tickers = list(dict.fromkeys((doc["tickers"] if doc is not None else []) + tickers))
+        if len(tickers) > MAX_WATCHLIST_TICKERS:
+            update.message.reply_text(f"a watchlist can have at most {MAX_WATCHLIST_TICKERS} tickers")
+            return
+
+        self.db.add_to_watchlist(user_id, name, tickers)
+        update.message.reply_text(f"{name}: {' '.join(tickers)}")
+
+    def remove_from_watchlist(self, update: Update, context: CallbackContext, args: List[str]) -> None:
+        if len(args) < 1:
+            update.message.reply_text(f"/{WATCH_COMMAND} usage: {WATCH_USAGE}")
+            return
+        user_id = self.get_user_id(update, context)
+        name, tickers = args[0].lower(), [ticker.upper() for ticker in args[1:]]
+
+        # without tickers the whole watchlist is removed
+        is_removed = self.db.remove_from_watchlist(user_id, name, tickers) if len(tickers) > 0 else self.db.delete_watchlist(user_id, name)
+        if not is_removed:
+            update.message.reply_text(f"no watchlist named {name}")
+        elif len(tickers) > 0:
+            update.message.reply_text(f"removed {' '.join(tickers)} from {name}")
+        else:
+            update.message.reply_text(f"removed watchlist {name}")
+
+    def get_watchlist(self, update: Update, context: CallbackContext, name: str) -> None:
+        user_id = self.get_user_id(update, context)
+        doc = self.db.find_watchlist(user_id, name)
+        if doc is None or len(doc["tickers"]) == 0:
+            update.message.reply_text(f"no watchlist named {name}" if doc is None else f"{name} is empty")
+            return
+        tickers = doc["tickers"]
+
+        ack = update.message.reply_text(f"fetching {len(tickers)} tickers...") if len(tickers) >= LONG_QUERY_MIN_TICKERS else None
+        ticker_query_lst = [TickerQuery(ticker) for ticker in tickers]
+        price_dicts = TickerQuery.run_multiple(ticker_query_lst, user_id, self.db, self.quote_cache)
+        if self.reply_mode == "text":
+            reply, parse_mode = TickerQuery.get_reply_multiple(ticker_query_lst, price_dicts, self.reply_mode)
+        else:
+            # rendered only when a quote of the watchlist changed since it was last rendered
+            versions = self.quote_cache.get_versions(tickers, price_dicts)
+            reply, parse_mode = self.table_cache.get_table_reply(tickers, price_dicts, versions, self.reply_mode), TickerQuery.get_parse_mode(self.reply_mode)
+        if ack is not None:
+            ack.edit_text(reply, parse_mode=parse_mode)
+        else:
+            update.message.reply_text(reply, parse_mode=parse_mode)
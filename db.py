@@ -1,29 +1,353 @@
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from collections import deque
 from ticker_query import TickerQuery
 import pymongo
 import datetime
-from ticker_alarm import TickerAlarm
+import threading
+import time
+import zlib
+import metrics
+from ticker_alarm import ExpressionAlarm, TickerAlarm, WindowAlarm
+
+
+MONGO_OPERATION_SECONDS = {operation: metrics.registry.histogram("mongo_operation_seconds", "Latency of Mongo operations", {"operation": operation}) for operation in ("insert_alarm", "find_alarms", "insert_queries", "update_alarms", "append_quotes", "find_quotes", "update_watchlist", "find_watchlists")}
+
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def get_write_errors(e: pymongo.errors.BulkWriteError) -> List[Dict[str, Any]]:
+    return e.details.get("writeErrors", [])
+
+
+class WriteBehindBuffer:
+    # flush_func returns the items of the batch to retry, a batch whose flush raised is retried whole, so that
+    # flush_func must be safe to apply twice
+    MAX_CLOSE_ATTEMPTS = 3
+
+    def __init__(self, name: str, flush_func: Callable[[List[Any]], List[Any]], max_batch_size: int, flush_interval: float, max_pending: int, drop_when_full: bool) -> None:
+        self.name = name
+        self.flush_func = flush_func
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # when full, either the oldest pending write is dropped or the writer blocks until a flush makes room
+        self.drop_when_full = drop_when_full
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+        metrics.registry.gauge("write_behind_pending", "Writes waiting to be flushed to Mongo", {"buffer": name}).set_function(self.__len__)
+        metrics.registry.gauge("write_behind_dropped", "Writes dropped because Mongo fell behind", {"buffer": name}).set_function(lambda: self.dropped)
+        self.thread = threading.Thread(target=self.run, name=f"write_behind_{name}", daemon=True)
+        self.thread.start()
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.items)
+
+    def put(self, item: Any) -> None:
+        with self.condition:
+            while not self.closed and len(self.items) >= self.max_pending:
+                if self.drop_when_full:
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    self.condition.wait()
+            if self.closed:
+                raise RuntimeError("Cannot write to a closed WriteBehindBuffer")
+            self.items.append(item)
+            if len(self.items) >= self.max_batch_size:
+                self.condition.notify_all()
+
+    def run(self) -> None:
+        close_attempts = 0
+        while True:
+            with self.condition:
+                deadline = time.monotonic() + self.flush_interval
+                while not self.closed and len(self.items) < self.max_batch_size and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                batch = [self.items.popleft() for _ in range(min(len(self.items), self.max_batch_size))]
+                closed = self.closed
+                self.condition.notify_all()
+
+            failed = self.flush(batch) if len(batch) > 0 else []
+            if len(failed) > 0:
+                with self.condition:
+                    if closed:
+                        # after close the flushes are retried MAX_CLOSE_ATTEMPTS times in all, then the writes still
+                        # pending are given up and counted as dropped, and the writers blocked on a full buffer woken
+                        close_attempts += 1
+                        if close_attempts >= self.MAX_CLOSE_ATTEMPTS:
+                            num_lost = len(failed) + len(self.items)
+                            self.dropped += num_lost
+                            self.items.clear()
+                            self.condition.notify_all()
+                            print(f"Dropped {num_lost} writes of the {self.name} buffer on close")
+                            return
+                    # failed writes are retried first, droppable ones only as far as they still fit
+                    if self.drop_when_full:
+                        room = max(self.max_pending - len(self.items), 0)
+                        self.dropped += max(len(failed) - room, 0)
+                        failed = failed[:room]
+                    self.items.extendleft(reversed(failed))
+                    self.condition.wait(self.flush_interval)
+            elif closed and len(batch) == 0:
+                return
+
+    def flush(self, batch: List[Any]) -> List[Any]:
+        try:
+            return self.flush_func(batch)
+        except Exception as e:
+            print(e)
+            return batch
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
 
 
 class Database:
     DB_NAME = "telegram_ticker_alarm_bot"
     TICKER_ALARM_COLLECTION_NAME = "alarm"
     TICKER_QUERY_COLLECTION_NAME = "query"
+    QUOTE_COLLECTION_NAME = "quote"
+    LEASE_COLLECTION_NAME = "lease"
+    WORKER_COLLECTION_NAME = "worker"
+    WATCHLIST_COLLECTION_NAME = "watchlist"
+    MONGO_URI = "mongodb://localhost:27017/"
+    CURSOR_BATCH_SIZE = 1000
+    WRITE_BATCH_SIZE = 500
+    WRITE_FLUSH_INTERVAL = 1.0
+    MAX_PENDING_WRITES = 10000
+    # alarms are partitioned by ticker for the workers, changing it requires reassigning the partitions of stored alarms
+    NUM_PARTITIONS = 64
 
-    def __init__(self) -> None:
-        self.client = pymongo.MongoClient("mongodb://localhost:27017/")
+    def __init__(self, uri: str = MONGO_URI, client: Optional[pymongo.MongoClient] = None) -> None:
+        self.client = pymongo.MongoClient(uri) if client is None else client
         self.db = self.client[self.DB_NAME]
+        self.create_indexes()
+        # query logs may be dropped when Mongo falls behind, alarm state changes may not
+        self.query_buffer = WriteBehindBuffer("query", self.flush_ticker_queries, self.WRITE_BATCH_SIZE, self.WRITE_FLUSH_INTERVAL, self.MAX_PENDING_WRITES, drop_when_full=True)
+        self.alarm_update_buffer = WriteBehindBuffer("alarm", self.flush_alarm_updates, self.WRITE_BATCH_SIZE, self.WRITE_FLUSH_INTERVAL, self.MAX_PENDING_WRITES, drop_when_full=False)
+
+    def create_indexes(self) -> None:
+        self.db[self.TICKER_ALARM_COLLECTION_NAME].create_index("active")
+        self.db[self.TICKER_ALARM_COLLECTION_NAME].create_index([("user_id", pymongo.ASCENDING), ("active", pymongo.ASCENDING)])
+        self.db[self.TICKER_ALARM_COLLECTION_NAME].create_index("alarm.alarm_id")
+        self.db[self.TICKER_ALARM_COLLECTION_NAME].create_index([("partition", pymongo.ASCENDING), ("active", pymongo.ASCENDING)])
+        self.db[self.TICKER_ALARM_COLLECTION_NAME].create_index([("partition", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+        self.db[self.TICKER_ALARM_COLLECTION_NAME].create_index([("partition", pymongo.ASCENDING), ("modified_at", pymongo.ASCENDING)])
+        self.db[self.QUOTE_COLLECTION_NAME].create_index([("ticker", pymongo.ASCENDING), ("resolution", pymongo.ASCENDING), ("start", pymongo.ASCENDING)], unique=True)
+        self.db[self.QUOTE_COLLECTION_NAME].create_index([("ticker", pymongo.ASCENDING), ("start", pymongo.ASCENDING)])
+        self.db[self.QUOTE_COLLECTION_NAME].create_index([("resolution", pymongo.ASCENDING), ("last", pymongo.ASCENDING)])
+        self.db[self.WATCHLIST_COLLECTION_NAME].create_index([("user_id", pymongo.ASCENDING), ("name", pymongo.ASCENDING)], unique=True)
+
+    def close(self) -> None:
+        self.query_buffer.close()
+        self.alarm_update_buffer.close()
+
+    @classmethod
+    def get_partition(cls, alarm: Union[TickerAlarm, ExpressionAlarm, WindowAlarm]) -> int:
+        # an expression alarm goes with its first ticker, the worker evaluating it polls its other tickers as well
+        ticker = alarm.tickers[0] if isinstance(alarm, ExpressionAlarm) else alarm.ticker
+        return zlib.crc32(ticker.upper().encode()) % cls.NUM_PARTITIONS
+
+    def insert_ticker_alarm(self, user_id: int, alarm: Union[TickerAlarm, ExpressionAlarm, WindowAlarm]) -> None:
+        start = time.perf_counter()
+        self.db[self.TICKER_ALARM_COLLECTION_NAME].insert_one({"created_at": datetime.datetime.utcnow(), "user_id": user_id, "alarm": alarm.serialize(), "active": True, "partition": self.get_partition(alarm)})
+        MONGO_OPERATION_SECONDS["insert_alarm"].observe(time.perf_counter() - start)
+
+    def assign_partitions(self) -> int:
+        # alarms stored before partitioning, or after NUM_PARTITIONS changed
+        ids_by_partition: Dict[int, List[Any]] = {}
+        for doc in self.db[self.TICKER_ALARM_COLLECTION_NAME].find({"active": True, "partition": {"$exists": False}}, {"alarm": 1}).batch_size(self.CURSOR_BATCH_SIZE):
+            ids_by_partition.setdefault(self.get_partition(TickerAlarm.deserialize(doc["alarm"])), []).append(doc["_id"])
+        for partition, ids in ids_by_partition.items():
+            self.db[self.TICKER_ALARM_COLLECTION_NAME].update_many({"_id": {"$in": ids}}, {"$set": {"partition": partition}})
+        return sum(len(ids) for ids in ids_by_partition.values())
+
+    def deactivate_ticker_alarm(self, alarm_id: str, user_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        # written at once instead of through the write-behind buffer, returns the alarm only to the caller that deactivated it
+        q = {"alarm.alarm_id": alarm_id, "active": True} if user_id is None else {"alarm.alarm_id": alarm_id, "active": True, "user_id": user_id}
+        vals = {"$set": {"active": False, "modified_at": datetime.datetime.utcnow()}}
+        return self.db[self.TICKER_ALARM_COLLECTION_NAME].find_one_and_update(q, vals, {"user_id": 1, "alarm": 1, "_id": 0})
+
+    def find_active_ticker_alarms_of_user(self, user_id: int) -> List[Dict[str, Any]]:
+        # read at once, a cursor would only hit Mongo when iterated
+        start = time.perf_counter()
+        docs = list(self.db[self.TICKER_ALARM_COLLECTION_NAME].find({"user_id": user_id, "active": True}, {"alarm": 1, "_id": 0}))
+        MONGO_OPERATION_SECONDS["find_alarms"].observe(time.perf_counter() - start)
+        return docs
+
+    def find_active_ticker_alarms(self, partitions: Optional[List[int]] = None) -> pymongo.cursor.Cursor:
+        q = {"active": True} if partitions is None else {"active": True, "partition": {"$in": partitions}}
+        return self.db[self.TICKER_ALARM_COLLECTION_NAME].find(q, {"user_id": 1, "alarm": 1, "partition": 1, "_id": 0}).batch_size(self.CURSOR_BATCH_SIZE)
 
-    def insert_ticker_alarm(self, user_id: int, alarm: TickerAlarm) -> None:
-        self.db[self.TICKER_ALARM_COLLECTION_NAME].insert_one({"created_at": datetime.datetime.utcnow(), "user_id": user_id, "alarm": alarm.serialize(), "active": True})
-    
-    def find_active_ticker_alarms_of_user(self, user_id: int) -> None:
-        return self.db[self.TICKER_ALARM_COLLECTION_NAME].find({"user_id": user_id, "active": True}, {"alarm": 1, "_id": 0})
+    def find_ticker_alarm_changes(self, partitions: List[int], since: datetime.datetime) -> List[Dict[str, Any]]:
+        # alarms set or removed since the given time
+        q = {"partition": {"$in": partitions}, "$or": [{"created_at": {"$gte": since}}, {"modified_at": {"$gte": since}}]}
+        return list(self.db[self.TICKER_ALARM_COLLECTION_NAME].find(q, {"user_id": 1, "alarm": 1, "active": 1, "partition": 1, "_id": 0}))
+
+    def heartbeat_worker(self, worker_id: str, ttl: float) -> None:
+        self.db[self.WORKER_COLLECTION_NAME].update_one({"_id": worker_id}, {"$set": {"expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)}}, upsert=True)
+
+    def remove_worker(self, worker_id: str) -> None:
+        self.db[self.WORKER_COLLECTION_NAME].delete_one({"_id": worker_id})
+
+    def find_live_worker_ids(self) -> List[str]:
+        return sorted(doc["_id"] for doc in self.db[self.WORKER_COLLECTION_NAME].find({"expires_at": {"$gte": datetime.datetime.utcnow()}}, {"_id": 1}))
+
+    def find_free_partitions(self) -> List[int]:
+        # partitions without a lease, or whose owner did not renew it in time
+        now = datetime.datetime.utcnow()
+        taken = {doc["_id"] for doc in self.db[self.LEASE_COLLECTION_NAME].find({"expires_at": {"$gte": now}}, {"_id": 1})}
+        return [partition for partition in range(self.NUM_PARTITIONS) if partition not in taken]
+
+    def acquire_lease(self, partition: int, owner: str, ttl: float) -> bool:
+        now = datetime.datetime.utcnow()
+        q = {"_id": partition, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]}
+        try:
+            # the upsert fails on the unique _id when another owner holds a valid lease
+            self.db[self.LEASE_COLLECTION_NAME].update_one(q, {"$set": {"owner": owner, "expires_at": now + datetime.timedelta(seconds=ttl)}}, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    def renew_leases(self, owner: str, partitions: List[int], ttl: float) -> List[int]:
+        # returns the partitions still held, a lease that expired may have been taken over by another owner
+        q = {"_id": {"$in": partitions}, "owner": owner}
+        self.db[self.LEASE_COLLECTION_NAME].update_many(q, {"$set": {"expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)}})
+        return [doc["_id"] for doc in self.db[self.LEASE_COLLECTION_NAME].find(q, {"_id": 1})]
+
+    def release_leases(self, owner: str, partitions: List[int]) -> None:
+        q = {"_id": {"$in": partitions}, "owner": owner}
+        self.db[self.LEASE_COLLECTION_NAME].update_many(q, {"$set": {"owner": None, "expires_at": datetime.datetime.utcnow()}})
 
     def insert_ticker_query(self, user_id: int, query: TickerQuery, price_dict: Optional[Dict[str, Any]]) -> None:
-        self.db[self.TICKER_QUERY_COLLECTION_NAME].insert_one({"created_at": datetime.datetime.utcnow(), "user_id": user_id, "query": query.serialize(), "price_dict": price_dict})
+        # the quote itself is in the quote store, the query only keeps its time (None when it could not be fetched)
+        quote_time = price_dict["last_update_datetime"] if price_dict is not None else None
+        self.query_buffer.put({"created_at": datetime.datetime.utcnow(), "user_id": user_id, "query": query.serialize(), "quote_time": quote_time})
+
+    def flush_ticker_queries(self, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # unordered, every doc is tried; the docs got their _id on the first try, so a doc written before a retry
+        # fails on its _id and is done, any other write error would fail again and the doc is dropped
+        start = time.perf_counter()
+        try:
+            self.db[self.TICKER_QUERY_COLLECTION_NAME].insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = [error for error in get_write_errors(e) if error["code"] != DUPLICATE_KEY_ERROR]
+            if len(errors) > 0:
+                print(f"Dropped {len(errors)} queries: {errors[0]['errmsg']}")
+        MONGO_OPERATION_SECONDS["insert_queries"].observe(time.perf_counter() - start)
+        return []
 
     def update_alarm(self, alarm_id: str, modification: str) -> None:
         q = {"alarm.alarm_id": alarm_id}
         vals = {"$set": {"active": False, "modification": modification, "modified_at": datetime.datetime.utcnow()}}
-        self.db[self.TICKER_ALARM_COLLECTION_NAME].find_one_and_update(q, vals)
\ No newline at end of file
+        self.alarm_update_buffer.put(pymongo.UpdateOne(q, vals))
+
+    def update_alarm_state(self, alarm_id: str, armed: bool, last_triggered_at: Optional[float]) -> None:
+        q = {"alarm.alarm_id": alarm_id}
+        vals = {"$set": {"alarm.armed": armed, "alarm.last_triggered_at": last_triggered_at}}
+        self.alarm_update_buffer.put(pymongo.UpdateOne(q, vals))
+
+    def flush_alarm_updates(self, updates: List[pymongo.UpdateOne]) -> List[pymongo.UpdateOne]:
+        # ordered, so that successive changes of the same alarm are applied in order; the updates are $sets, applying
+        # one twice is harmless. The write stops at the first error: the updates before it are done, the failed one
+        # would fail again and is dropped, the ones after it are retried
+        start = time.perf_counter()
+        try:
+            self.db[self.TICKER_ALARM_COLLECTION_NAME].bulk_write(updates, ordered=True)
+        except pymongo.errors.BulkWriteError as e:
+            errors = get_write_errors(e)
+            if len(errors) == 0:
+                raise
+            print(f"Dropped an alarm update: {errors[0]['errmsg']}")
+            return updates[errors[0]["index"] + 1:]
+        finally:
+            MONGO_OPERATION_SECONDS["update_alarms"].observe(time.perf_counter() - start)
+        return []
+
+    def append_quote_samples(self, buckets: Dict[Tuple[str, int, datetime.datetime], Tuple[List[int], List[float]]]) -> List[Tuple[str, int, datetime.datetime]]:
+        # (ticker, resolution, bucket start) -> (times in ms, prices), added as {t, p} samples with $addToSet so that
+        # processes storing quotes of the same ticker do not overwrite each other, and a retried or repeated sample is
+        # stored once. Returns the buckets to retry
+        updates, keys = [], list(buckets)
+        for ticker, resolution, start in keys:
+            times, prices = buckets[(ticker, resolution, start)]
+            q = {"ticker": ticker, "resolution": resolution, "start": start}
+            vals = {"$addToSet": {"s": {"$each": [{"t": time_ms, "p": price} for time_ms, price in zip(times, prices)]}}, "$max": {"last": datetime.datetime.utcfromtimestamp(max(times) / 1000)}}
+            updates.append(pymongo.UpdateOne(q, vals, upsert=True))
+        try:
+            self.flush_quote_updates(updates)
+        except pymongo.errors.BulkWriteError as e:
+            # an upsert racing the one of another process fails on the unique bucket key and matches the bucket on a
+            # retry, any other write error would fail again and the bucket is dropped
+            errors = get_write_errors(e)
+            if len(errors) == 0:
+                raise
+            dropped = [error for error in errors if error["code"] != DUPLICATE_KEY_ERROR]
+            if len(dropped) > 0:
+                print(f"Dropped {len(dropped)} quote buckets: {dropped[0]['errmsg']}")
+            return [keys[error["index"]] for error in errors if error["code"] == DUPLICATE_KEY_ERROR]
+        return []
+
+    def flush_quote_updates(self, updates: List[pymongo.UpdateOne]) -> None:
+        start = time.perf_counter()
+        try:
+            self.db[self.QUOTE_COLLECTION_NAME].bulk_write(updates, ordered=False)
+        finally:
+            MONGO_OPERATION_SECONDS["append_quotes"].observe(time.perf_counter() - start)
+
+    def find_quote_buckets(self, ticker: str, start: datetime.datetime, end: datetime.datetime) -> List[Dict[str, Any]]:
+        started_at = time.perf_counter()
+        docs = list(self.db[self.QUOTE_COLLECTION_NAME].find({"ticker": ticker, "start": {"$lte": end}, "last": {"$gte": start}}, {"s": 1, "_id": 0}))
+        MONGO_OPERATION_SECONDS["find_quotes"].observe(time.perf_counter() - started_at)
+        return docs
+
+    def find_expired_quote_bucket_ids(self, resolution: int, before: datetime.datetime) -> List[Any]:
+        return [doc["_id"] for doc in self.db[self.QUOTE_COLLECTION_NAME].find({"resolution": resolution, "last": {"$lt": before}}, {"_id": 1})]
+
+    def take_quote_bucket(self, bucket_id: Any) -> Optional[Dict[str, Any]]:
+        # deleted as it is read, so that a bucket is downsampled once even when several processes compact
+        return self.db[self.QUOTE_COLLECTION_NAME].find_one_and_delete({"_id": bucket_id})
+
+    def delete_expired_quote_buckets(self, resolution: int, before: datetime.datetime) -> int:
+        return self.db[self.QUOTE_COLLECTION_NAME].delete_many({"resolution": resolution, "last": {"$lt": before}}).deleted_count
+
+    def add_to_watchlist(self, user_id: int, name: str, tickers: List[str]) -> None:
+        # creates the watchlist if needed, tickers already in it keep their place
+        start = time.perf_counter()
+        q = {"user_id": user_id, "name": name}
+        vals = {"$addToSet": {"tickers": {"$each": tickers}}, "$set": {"modified_at": datetime.datetime.utcnow()}, "$setOnInsert": {"created_at": datetime.datetime.utcnow()}}
+        self.db[self.WATCHLIST_COLLECTION_NAME].update_one(q, vals, upsert=True)
+        MONGO_OPERATION_SECONDS["update_watchlist"].observe(time.perf_counter() - start)
+
+    def remove_from_watchlist(self, user_id: int, name: str, tickers: List[str]) -> bool:
+        start = time.perf_counter()
+        q = {"user_id": user_id, "name": name}
+        vals = {"$pullAll": {"tickers": tickers}, "$set": {"modified_at": datetime.datetime.utcnow()}}
+        matched_count = self.db[self.WATCHLIST_COLLECTION_NAME].update_one(q, vals).matched_count
+        MONGO_OPERATION_SECONDS["update_watchlist"].observe(time.perf_counter() - start)
+        return matched_count > 0
+
+    def delete_watchlist(self, user_id: int, name: str) -> bool:
+        start = time.perf_counter()
+        deleted_count = self.db[self.WATCHLIST_COLLECTION_NAME].delete_one({"user_id": user_id, "name": name}).deleted_count
+        MONGO_OPERATION_SECONDS["update_watchlist"].observe(time.perf_counter() - start)
+        return deleted_count > 0
+
+    def find_watchlists_of_user(self, user_id: int) -> List[Dict[str, Any]]:
+        start = time.perf_counter()
+        docs = list(self.db[self.WATCHLIST_COLLECTION_NAME].find({"user_id": user_id}, {"name": 1, "tickers": 1, "_id": 0}).sort("created_at", pymongo.ASCENDING))
+        MONGO_OPERATION_SECONDS["find_watchlists"].observe(time.perf_counter() - start)
+        return docs
+
+    def find_watchlist(self, user_id: int, name: str) -> Optional[Dict[str, Any]]:
+        start = time.perf_counter()
+        doc = self.db[self.WATCHLIST_COLLECTION_NAME].find_one({"user_id": user_id, "name": name}, {"name": 1, "tickers": 1, "_id": 0})
+        MONGO_OPERATION_SECONDS["find_watchlists"].observe(time.perf_counter() - start)
+        return doc
@@ -0,0 +1,149 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
+import operator
+import re
+
+
+# tickers may contain '.', '-', '=' and '^' (e.g. EREGL.IS, BTC-USD, EURUSD=X, ^GSPC, 0700.HK), so a minus between tickers needs spaces
+TOKEN_PATTERN = re.compile(r"\s*(?:(?P<ticker>\d+\.[A-Za-z][A-Za-z0-9]*|[A-Za-z^][A-Za-z0-9.\-=^]*)|(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|(?P<op>[-+*/()]))")
+
+BINARY_OPERATORS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+}
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+def tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens, i = [], 0
+    text = text.rstrip()
+    while i < len(text):
+        match = TOKEN_PATTERN.match(text, i)
+        if match is None or match.end() == i:
+            raise ExpressionError(f"unexpected character {text[i:].lstrip()[:1]!r} at position {i}")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind).upper() if kind == "ticker" else match.group(kind)))
+        i = match.end()
+    return tokens
+
+
+class Parser:
+    # recursive descent over the usual precedence, emitting postfix instructions
+    def __init__(self, tokens: List[Tuple[str, str]]) -> None:
+        self.tokens = tokens
+        self.i = 0
+        self.program: List[Tuple[str, Any]] = []
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def take(self) -> Tuple[str, str]:
+        token = self.peek()
+        if token is None:
+            raise ExpressionError("unexpected end of expression")
+        self.i += 1
+        return token
+
+    def parse(self) -> List[Tuple[str, Any]]:
+        self.parse_sum()
+        if self.peek() is not None:
+            raise ExpressionError(f"unexpected {self.peek()[1]!r}")
+        return self.program
+
+    def parse_sum(self) -> None:
+        self.parse_product()
+        while self.peek() in (("op", "+"), ("op", "-")):
+            _, op = self.take()
+            self.parse_product()
+            self.program.append(("op", op))
+
+    def parse_product(self) -> None:
+        self.parse_unary()
+        while self.peek() in (("op", "*"), ("op", "/")):
+            _, op = self.take()
+            self.parse_unary()
+            self.program.append(("op", op))
+
+    def parse_unary(self) -> None:
+        if self.peek() == ("op", "-"):
+            self.take()
+            self.parse_unary()
+            self.program.append(("neg", None))
+        elif self.peek() == ("op", "+"):
+            self.take()
+            self.parse_unary()
+        else:
+            self.parse_atom()
+
+    def parse_atom(self) -> None:
+        kind, value = self.take()
+        if kind == "number":
+            self.program.append(("const", float(value)))
+        elif kind == "ticker":
+            self.program.append(("ticker", value))
+        elif value == "(":
+            self.parse_sum()
+            if self.take() != ("op", ")"):
+                raise ExpressionError("missing ')'")
+        else:
+            raise ExpressionError(f"unexpected {value!r}")
+
+
+class CompiledExpression:
+    __slots__ = ("source", "program", "tickers")
+
+    def __init__(self, source: str, program: List[Tuple[str, Any]]) -> None:
+        self.source = source
+        # postfix instructions: ("const", value), ("ticker", symbol), ("neg", None), ("op", "+" | "-" | "*" | "/")
+        self.program = [(kind, arg) for kind, arg in program]
+        self.tickers = list(dict.fromkeys(arg for kind, arg in self.program if kind == "ticker"))
+
+    @classmethod
+    def compile(cls, text: str) -> CompiledExpression:
+        tokens = tokenize(text)
+        if len(tokens) == 0:
+            raise ExpressionError("empty expression")
+        program = Parser(tokens).parse()
+        source = " ".join(value for _, value in tokens).replace("( ", "(").replace(" )", ")")
+        return cls(source, program)
+
+    def __str__(self) -> str:
+        return self.source
+
+    @property
+    def is_constant(self) -> bool:
+        return len(self.tickers) == 0
+
+    def evaluate(self, prices: Dict[str, float]) -> Optional[float]:
+        # None while a ticker has no price yet, or on division by zero
+        stack: List[float] = []
+        for kind, arg in self.program:
+            if kind == "const":
+                stack.append(arg)
+            elif kind == "ticker":
+                price = prices.get(arg)
+                if price is None:
+                    return None
+                stack.append(price)
+            elif kind == "neg":
+                stack[-1] = -stack[-1]
+            else:
+                right = stack.pop()
+                try:
+                    stack[-1] = BINARY_OPERATORS[arg](stack[-1], right)
+                except ZeroDivisionError:
+                    return None
+        return stack[0]
+
+    def serialize(self) -> Dict[str, Any]:
+        return {"source": self.source, "program": [[kind, arg] for kind, arg in self.program]}
+
+    @classmethod
+    def deserialize(cls, dct: Dict[str, Any]) -> CompiledExpression:
+        # the stored program is used as is, without parsing the source again
+        return cls(dct["source"], [(kind, arg) for kind, arg in dct["program"]])
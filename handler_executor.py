@@ -0,0 +1,109 @@
+from typing import Any, Callable, Deque, Dict, List, Tuple
+from collections import deque
+import threading
+import time
+import metrics
+
+
+HANDLER_QUEUE_WAIT_SECONDS = metrics.registry.histogram("handler_queue_wait_seconds", "Time a command waited for an executor worker")
+HANDLER_SECONDS = metrics.registry.histogram("handler_seconds", "Time to handle a command")
+HANDLER_REJECTED = metrics.registry.counter("handler_rejected_total", "Commands rejected because the user had too many pending")
+
+
+class FairExecutor:
+    # runs command handlers off the dispatcher threads, users take turns and each has a bounded number running and
+    # waiting, so one user's slow commands delay only that user's other commands
+    WORKERS = 8
+    MAX_RUNNING_PER_USER = 1
+    MAX_PENDING_PER_USER = 5
+
+    def __init__(self, workers: int = WORKERS, max_running_per_user: int = MAX_RUNNING_PER_USER, max_pending_per_user: int = MAX_PENDING_PER_USER) -> None:
+        self.num_workers = workers
+        self.max_running_per_user = max_running_per_user
+        self.max_pending_per_user = max_pending_per_user
+        self.condition = threading.Condition()
+        # user_id -> tasks (submitted_at, func, args) waiting
+        self.pending: Dict[int, Deque[Tuple[float, Callable, Tuple[Any, ...]]]] = {}
+        self.running: Dict[int, int] = {}
+        # users with pending tasks below their running cap, served round-robin
+        self.ready: Deque[int] = deque()
+        self.workers: List[threading.Thread] = []
+        self.stopped = False
+        metrics.registry.gauge("handler_queue_depth", "Commands waiting for an executor worker").set_function(self.__len__)
+
+    def __len__(self) -> int:
+        with self.condition:
+            return sum(len(tasks) for tasks in self.pending.values())
+
+    def start(self) -> None:
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self.run, name=f"handler_{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self) -> None:
+        # pending commands are still handled
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def submit(self, user_id: int, func: Callable, *args: Any) -> bool:
+        # False when the user already has too many commands waiting
+        with self.condition:
+            tasks = self.pending.setdefault(user_id, deque())
+            if len(tasks) >= self.max_pending_per_user:
+                HANDLER_REJECTED.inc()
+                return False
+            tasks.append((time.monotonic(), func, args))
+            if len(tasks) == 1 and self.running.get(user_id, 0) < self.max_running_per_user:
+                self.ready.append(user_id)
+                self.condition.notify()
+            return True
+
+    def take_next(self) -> Any:
+        # must be called with the condition held, blocks until a task may run
+        while len(self.ready) == 0:
+            if self.stopped and len(self.pending) == 0:
+                return None
+            self.condition.wait()
+        user_id = self.ready.popleft()
+        tasks = self.pending[user_id]
+        task = tasks.popleft()
+        if len(tasks) == 0:
+            del self.pending[user_id]
+        self.running[user_id] = self.running.get(user_id, 0) + 1
+        if user_id in self.pending and self.running[user_id] < self.max_running_per_user:
+            # back of the line, the other users go first
+            self.ready.append(user_id)
+        return user_id, task
+
+    def finish(self, user_id: int) -> None:
+        with self.condition:
+            self.running[user_id] -= 1
+            if self.running[user_id] == 0:
+                del self.running[user_id]
+            if user_id in self.pending and user_id not in self.ready:
+                self.ready.append(user_id)
+                self.condition.notify()
+            elif self.stopped and len(self.pending) == 0:
+                # the idle workers are waiting for the last tasks to finish
+                self.condition.notify_all()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                item = self.take_next()
+            if item is None:
+                return
+            user_id, (submitted_at, func, args) = item
+            started_at = time.monotonic()
+            HANDLER_QUEUE_WAIT_SECONDS.observe(started_at - submitted_at)
+            try:
+                func(*args)
+            except Exception as e:
+                print(e)
+            HANDLER_SECONDS.observe(time.monotonic() - started_at)
+            self.finish(user_id)
@@ -0,0 +1,234 @@
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+
+# seconds, from a cached quote to a slow Telegram send
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+
+class Counter:
+    type_name = "counter"
+
+    def __init__(self, name: str, labels: Tuple[Tuple[str, str], ...]) -> None:
+        self.name = name
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels)} {self.value}"]
+
+    def summarize(self) -> str:
+        return str(self.value)
+
+
+class Gauge:
+    type_name = "gauge"
+
+    def __init__(self, name: str, labels: Tuple[Tuple[str, str], ...]) -> None:
+        self.name = name
+        self.labels = labels
+        self.value = 0.0
+        # read when scraped, so that the hot path does not have to keep the gauge up to date
+        self.func: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, func: Callable[[], float]) -> None:
+        self.func = func
+
+    def get(self) -> float:
+        if self.func is None:
+            return self.value
+        try:
+            return self.func()
+        except Exception as e:
+            print(e)
+            return float("nan")
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels)} {self.get()}"]
+
+    def summarize(self) -> str:
+        return str(self.get())
+
+
+class Histogram:
+    type_name = "histogram"
+
+    def __init__(self, name: str, labels: Tuple[Tuple[str, str], ...], buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # the last count is the +Inf bucket, counts are not cumulative until rendered
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def get_snapshot(self) -> Tuple[List[int], float, int]:
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def get_quantile(self, quantile: float) -> Optional[float]:
+        # upper bound of the bucket the quantile falls in
+        counts, _, count = self.get_snapshot()
+        if count == 0:
+            return None
+        rank, cumulative = quantile * count, 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> List[str]:
+        counts, total, count = self.get_snapshot()
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            le_label = f'le="{le}"'
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, le_label)} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labels)} {total}")
+        lines.append(f"{self.name}_count{format_labels(self.labels)} {count}")
+        return lines
+
+    def summarize(self) -> str:
+        _, total, count = self.get_snapshot()
+        mean = total / count if count > 0 else 0.0
+        return f"count={count} mean={mean:.4f} p50<={self.get_quantile(0.5)} p99<={self.get_quantile(0.99)}"
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # name -> (help, labels -> metric), in registration order
+        self.families: Dict[str, Tuple[str, Dict[Tuple[Tuple[str, str], ...], Metric]]] = {}
+
+    def _get_or_create(self, metric_class: type, name: str, help: str, labels: Optional[Dict[str, str]], **kwargs) -> Metric:
+        label_items = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            _, metrics = self.families.setdefault(name, (help, {}))
+            if label_items not in metrics:
+                metrics[label_items] = metric_class(name, label_items, **kwargs)
+            metric = metrics[label_items]
+        if not isinstance(metric, metric_class):
+            raise ValueError(f"metric {name} is already registered as a {metric.type_name}")
+        return metric
+
+    def counter(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Optional[Dict[str, str]] = None, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def get_metrics(self) -> List[Tuple[str, str, List[Metric]]]:
+        with self.lock:
+            return [(name, help, list(metrics.values())) for name, (help, metrics) in self.families.items()]
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        for name, help, metrics in self.get_metrics():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metrics[0].type_name}")
+            for metric in metrics:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summarize(self) -> str:
+        lines = []
+        for name, _, metrics in self.get_metrics():
+            for metric in metrics:
+                lines.append(f"{name}{format_labels(metric.labels)} {metric.summarize()}")
+        return "\n".join(lines)
+
+
+# shared by all modules, like a Prometheus client's default registry
+registry = MetricsRegistry()
+
+
+class MetricsServer:
+    PORT = 9100
+
+    def __init__(self, metrics_registry: MetricsRegistry = registry, host: str = "0.0.0.0", port: int = PORT) -> None:
+        self.registry = metrics_registry
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    def make_handler(self) -> type:
+        metrics_registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                content = metrics_registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics_server", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsLogger:
+    def __init__(self, interval: float, metrics_registry: MetricsRegistry = registry) -> None:
+        self.interval = interval
+        self.registry = metrics_registry
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics_logger", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            print(f"metrics at {time.strftime('%Y-%m-%d %H:%M:%S')}\n{self.registry.summarize()}")
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
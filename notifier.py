@@ -0,0 +1,224 @@
+from typing import Dict, List, Optional, Set, Tuple
+from enum import IntEnum
+import heapq
+import itertools
+import threading
+import time
+import telegram
+import metrics
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+
+TELEGRAM_SEND_SECONDS = metrics.registry.histogram("telegram_send_seconds", "Latency of Telegram sendMessage calls")
+TELEGRAM_RETRY_AFTER = metrics.registry.counter("telegram_retry_after_total", "Telegram sendMessage calls answered with 429 Too Many Requests")
+TELEGRAM_SEND_ERRORS = metrics.registry.counter("telegram_send_errors_total", "Telegram sendMessage calls failed for other reasons")
+
+
+class Priority(IntEnum):
+    # lower values are sent first
+    TRIGGER = 0
+    INFO = 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def get_wait_time(self, now: float) -> float:
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self.refill(now)
+        self.tokens -= 1
+
+
+class Notification:
+    __slots__ = ("chat_id", "texts", "priority", "seq", "attempts")
+
+    def __init__(self, chat_id: int, text: str, priority: Priority, seq: int) -> None:
+        self.chat_id = chat_id
+        self.texts = [text]
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+
+    @property
+    def text(self) -> str:
+        return "\n\n".join(self.texts)
+
+
+class Notifier:
+    # Telegram allows about 30 messages per second per bot and 1 per second per chat
+    GLOBAL_RATE = 30.0
+    CHAT_RATE = 1.0
+    CHAT_BURST = 1.0
+    WORKERS = 4
+    MAX_ATTEMPTS = 5
+    MAX_MESSAGE_LENGTH = 4096
+
+    def __init__(self, bot: telegram.Bot, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST, workers: int = WORKERS) -> None:
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.num_workers = workers
+        self.condition = threading.Condition()
+        self.queue: List[Tuple[int, int, Notification]] = []
+        self.seq = itertools.count()
+        # no bursts, Telegram counts messages in sliding one second windows
+        self.global_bucket = TokenBucket(global_rate, 1.0)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.chat_blocked_until: Dict[int, float] = {}
+        self.blocked_until = 0.0
+        # queued trigger notification of each chat, later triggers are appended to it
+        self.pending_triggers: Dict[int, Notification] = {}
+        # one message in flight per chat keeps the messages of a chat in order
+        self.in_flight_chats: Set[int] = set()
+        self.workers: List[threading.Thread] = []
+        self.stopped = False
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        metrics.registry.gauge("notifier_queue_depth", "Notifications waiting to be sent").set_function(self.__len__)
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.queue)
+
+    def start(self) -> None:
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self.run, name=f"notifier_{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self) -> None:
+        # queued notifications are still sent
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def send(self, chat_id: int, text: str, priority: Priority = Priority.INFO) -> None:
+        with self.condition:
+            pending = self.pending_triggers.get(chat_id) if priority == Priority.TRIGGER else None
+            if pending is not None and len(pending.text) + len(text) + 2 <= self.MAX_MESSAGE_LENGTH:
+                pending.texts.append(text)
+                self.coalesced += 1
+                return
+            notification = Notification(chat_id, text, priority, next(self.seq))
+            if priority == Priority.TRIGGER:
+                self.pending_triggers[chat_id] = notification
+            heapq.heappush(self.queue, (notification.priority, notification.seq, notification))
+            self.condition.notify()
+
+    def get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chat_buckets[chat_id]
+
+    def get_chat_wait_time(self, chat_id: int, now: float) -> float:
+        if chat_id in self.in_flight_chats:
+            return float("inf")
+        return max(self.get_chat_bucket(chat_id).get_wait_time(now), self.chat_blocked_until.get(chat_id, 0.0) - now)
+
+    def take_next(self) -> Optional[Notification]:
+        # must be called with the condition held, blocks until a notification may be sent
+        while True:
+            if len(self.queue) == 0:
+                if self.stopped:
+                    return None
+                self.condition.wait()
+                continue
+
+            now = time.monotonic()
+            global_wait_time = max(self.global_bucket.get_wait_time(now), self.blocked_until - now)
+            if global_wait_time > 0:
+                self.condition.wait(global_wait_time)
+                continue
+
+            skipped, notification, min_wait_time = [], None, None
+            while len(self.queue) > 0:
+                item = heapq.heappop(self.queue)
+                wait_time = self.get_chat_wait_time(item[2].chat_id, now)
+                if wait_time <= 0:
+                    notification = item[2]
+                    break
+                skipped.append(item)
+                min_wait_time = wait_time if min_wait_time is None else min(min_wait_time, wait_time)
+            for item in skipped:
+                heapq.heappush(self.queue, item)
+
+            if notification is not None:
+                self.global_bucket.consume(now)
+                self.get_chat_bucket(notification.chat_id).consume(now)
+                self.in_flight_chats.add(notification.chat_id)
+                if self.pending_triggers.get(notification.chat_id) is notification:
+                    del self.pending_triggers[notification.chat_id]
+                return notification
+            # every queued chat is rate limited or has a message in flight
+            self.condition.wait(None if min_wait_time == float("inf") else min_wait_time)
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                notification = self.take_next()
+            if notification is None:
+                return
+
+            retry_after, flood_controlled = None, False
+            start = time.perf_counter()
+            try:
+                self.bot.send_message(notification.chat_id, text=notification.text)
+            except RetryAfter as e:
+                # the chat is within its own limit, so flood control applies to the whole bot
+                retry_after, flood_controlled = e.retry_after, True
+                TELEGRAM_RETRY_AFTER.inc()
+            except BadRequest as e:
+                print(e)
+                notification.attempts = self.MAX_ATTEMPTS
+                TELEGRAM_SEND_ERRORS.inc()
+            except NetworkError as e:
+                # includes TimedOut, retried with exponential backoff
+                print(e)
+                retry_after = 2 ** notification.attempts
+                TELEGRAM_SEND_ERRORS.inc()
+            except Exception as e:
+                print(e)
+                notification.attempts = self.MAX_ATTEMPTS
+                TELEGRAM_SEND_ERRORS.inc()
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - start)
+
+            with self.condition:
+                self.in_flight_chats.discard(notification.chat_id)
+                if retry_after is None and notification.attempts < self.MAX_ATTEMPTS:
+                    self.sent += 1
+                elif retry_after is not None and notification.attempts + 1 < self.MAX_ATTEMPTS:
+                    notification.attempts += 1
+                    self.retried += 1
+                    self.chat_blocked_until[notification.chat_id] = time.monotonic() + retry_after
+                    if flood_controlled:
+                        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                    heapq.heappush(self.queue, (notification.priority, notification.seq, notification))
+                else:
+                    self.failed += 1
+                self.condition.notify_all()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.condition:
+            return {
+                "queued": len(self.queue),
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "retried": self.retried,
+                "failed": self.failed,
+            }
@@ -0,0 +1,73 @@
+from typing import Any, Dict, FrozenSet, Optional
+import datetime as dt
+import math
+import pytz
+
+
+class MarketSession:
+    def __init__(self, time_zone_name: str, open_time: dt.time, close_time: dt.time, weekdays: FrozenSet[int] = frozenset(range(5))) -> None:
+        self.time_zone = pytz.timezone(time_zone_name)
+        self.open_time = open_time
+        self.close_time = close_time
+        self.weekdays = weekdays
+
+    def get_seconds_until_open(self, now: dt.datetime) -> float:
+        # 0 while the market is open, holidays are not known and are polled as open days
+        local_now = now.astimezone(self.time_zone)
+        for day_offset in range(8):
+            day = local_now.date() + dt.timedelta(days=day_offset)
+            if day.weekday() not in self.weekdays:
+                continue
+            open_datetime = self.time_zone.localize(dt.datetime.combine(day, self.open_time))
+            close_datetime = self.time_zone.localize(dt.datetime.combine(day, self.close_time))
+            if local_now < close_datetime:
+                return max((open_datetime - local_now).total_seconds(), 0.0)
+        return 0.0
+
+
+# regular sessions by Yahoo's exchangeTimezoneName, tickers of other time zones (e.g. crypto in UTC) are always polled
+MARKET_SESSIONS: Dict[str, MarketSession] = {
+    "Europe/Istanbul": MarketSession("Europe/Istanbul", dt.time(10, 0), dt.time(18, 10)),
+    "America/New_York": MarketSession("America/New_York", dt.time(9, 30), dt.time(16, 0)),
+    "Europe/London": MarketSession("Europe/London", dt.time(8, 0), dt.time(16, 35)),
+    "Europe/Berlin": MarketSession("Europe/Berlin", dt.time(9, 0), dt.time(17, 35)),
+    "Europe/Paris": MarketSession("Europe/Paris", dt.time(9, 0), dt.time(17, 35)),
+    "Asia/Tokyo": MarketSession("Asia/Tokyo", dt.time(9, 0), dt.time(15, 0)),
+}
+
+
+class TickerPollSchedule:
+    VOLATILITY_DECAY = 0.1
+    # polls are spaced so that reaching the nearest target takes at least this many standard deviations
+    DISTANCE_IN_DEVIATIONS = 4.0
+    MAX_POLL_INTERVAL = 300.0
+    MAX_CLOSED_POLL_INTERVAL = 1800.0
+
+    def __init__(self) -> None:
+        self.last_price: Optional[float] = None
+        self.last_polled_at: Optional[float] = None
+        # exponentially weighted variance of log returns per second
+        self.variance: Optional[float] = None
+        self.market_session: Optional[MarketSession] = None
+
+    def update(self, price_dict: Dict[str, Any], polled_at: float) -> None:
+        price = price_dict["current_price"]
+        if self.last_price is not None and polled_at > self.last_polled_at and price > 0 and self.last_price > 0:
+            sample = math.log(price / self.last_price) ** 2 / (polled_at - self.last_polled_at)
+            self.variance = sample if self.variance is None else (1 - self.VOLATILITY_DECAY) * self.variance + self.VOLATILITY_DECAY * sample
+        self.last_price, self.last_polled_at = price, polled_at
+
+        time_zone_name = getattr(price_dict["last_update_datetime"].tzinfo, "zone", None)
+        self.market_session = MARKET_SESSIONS.get(time_zone_name)
+
+    def get_poll_interval(self, relative_distance: Optional[float], min_interval: float, now: dt.datetime) -> float:
+        if self.market_session is not None:
+            seconds_until_open = self.market_session.get_seconds_until_open(now)
+            if seconds_until_open > 0:
+                return min(max(seconds_until_open, min_interval), self.MAX_CLOSED_POLL_INTERVAL)
+
+        if relative_distance is None or not self.variance:
+            return min_interval
+        # a random walk needs about (distance / deviation) ** 2 seconds to cover the distance
+        interval = (relative_distance / self.DISTANCE_IN_DEVIATIONS) ** 2 / self.variance
+        return min(max(interval, min_interval), self.MAX_POLL_INTERVAL)
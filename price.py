@@ -1,43 +1,99 @@
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import abc
 import datetime as dt
+import threading
+import time
 import pytz
 import tzlocal
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import lxml.html
+import metrics
 from telegram import message
 
 
-def get_current_ticker_info(ticker: str) -> Optional[Dict[str, Any]]:
-    url = f"https://query1.finance.yahoo.com/v8/finance/chart/{ticker}?region=US&lang=en-US&includePrePost=false&interval=2m&useYfid=true&range=1d&corsDomain=finance.yahoo.com&.tsrc=finance"
+YAHOO_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart"
+YAHOO_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+YAHOO_QUOTE_MAX_SYMBOLS = 50
+HTTP_POOL_SIZE = 16
+HTTP_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.3
+HTTP_USER_AGENT = "Mozilla/5.0"
+
+
+def make_http_session(pool_size: int = HTTP_POOL_SIZE, retries: int = HTTP_RETRIES, backoff_factor: float = HTTP_BACKOFF_FACTOR) -> requests.Session:
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.headers["User-Agent"] = HTTP_USER_AGENT
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# shared by all fetches so that connections are kept alive and reused
+http_session = make_http_session()
+fetch_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="price_fetch")
+
+
+def make_ticker_info(current_price: float, previous_close_price: float, market_timestamp: int, exchange_timezone_name: str) -> Dict[str, Any]:
+    local_time_zone = tzlocal.get_localzone()
+    market_time_zone = pytz.timezone(exchange_timezone_name)
+    last_update_datetime = dt.datetime.fromtimestamp(market_timestamp, tz=local_time_zone).astimezone(tz=market_time_zone)
+    absolute_price_change = current_price - previous_close_price
+    percentage_price_change = 100 * absolute_price_change / previous_close_price
+    return {
+        "current_price": current_price,
+        "absolute_price_change": absolute_price_change,
+        "percentage_price_change": percentage_price_change,
+        "last_update_datetime": last_update_datetime,
+    }
+
+
+def fetch_chart_ticker_info(ticker: str) -> Optional[Dict[str, Any]]:
+    # raises when Yahoo cannot be reached, None when it has no quote for the ticker
+    url = f"{YAHOO_CHART_URL}/{ticker}?region=US&lang=en-US&includePrePost=false&interval=2m&useYfid=true&range=1d&corsDomain=finance.yahoo.com&.tsrc=finance"
+    r = http_session.get(url, timeout=HTTP_TIMEOUT)
+    if r.status_code != 404:
+        r.raise_for_status()
     try:
-        r = requests.get(url)
         meta = r.json()["chart"]["result"][0]["meta"]
-        local_time_zone = tzlocal.get_localzone()
-        market_time_zone = pytz.timezone(meta["exchangeTimezoneName"])
-        last_update_datetime = dt.datetime.fromtimestamp(meta["regularMarketTime"], tz=local_time_zone).astimezone(tz=market_time_zone)
-        current_price = meta["regularMarketPrice"]
-        previous_close_price = meta["previousClose"]
-        absolute_price_change = current_price - previous_close_price
-        percentage_price_change = 100 * absolute_price_change / previous_close_price
-        return {
-            "current_price": current_price,
-            "absolute_price_change": absolute_price_change,
-            "percentage_price_change": percentage_price_change,
-            "last_update_datetime": last_update_datetime,
-        }
+        return make_ticker_info(meta["regularMarketPrice"], meta["previousClose"], meta["regularMarketTime"], meta["exchangeTimezoneName"])
     except Exception as e:
         print(e)
         return None
 
 
-def get_current_ticker_price_from_yahoo_finance(ticker: str) -> Optional[Dict[str, float]]:
+def fetch_quote_ticker_infos(symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+    # raises when Yahoo cannot be reached, symbols without a quote are left out
+    url = f"{YAHOO_QUOTE_URL}?region=US&lang=en-US&symbols={','.join(symbols)}"
+    r = http_session.get(url, timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+    results = r.json()["quoteResponse"]["result"]
+
+    infos = {}
+    for quote in results:
+        try:
+            infos[quote["symbol"].upper()] = make_ticker_info(quote["regularMarketPrice"], quote["regularMarketPreviousClose"], quote["regularMarketTime"], quote["exchangeTimezoneName"])
+        except Exception as e:
+            print(e)
+    return infos
+
+
+def fetch_yahoo_finance_page_ticker_info(ticker: str) -> Optional[Dict[str, Any]]:
     BASE_URL = "https://finance.yahoo.com/quote"
     CURRENT_PRICE_XPATH = "/html/body/div[1]/div/div/div[1]/div/div[2]/div/div/div[4]/div/div/div/div[3]/div[1]/div/span[1]/text()"
     PRICE_CHANGE_XPATH = "/html/body/div[1]/div/div/div[1]/div/div[2]/div/div/div[4]/div/div/div/div[3]/div[1]/div/span[2]/text()"
     url = f"{BASE_URL}/{ticker}"
 
+    r = http_session.get(url, timeout=HTTP_TIMEOUT)
+    if r.status_code != 404:
+        r.raise_for_status()
     try:
-        r = requests.get(url)
         root = lxml.html.fromstring(r.content)
         current_price_text = root.xpath(CURRENT_PRICE_XPATH)[0].translate({ord(c): None for c in ","})
         price_change_texts = root.xpath(PRICE_CHANGE_XPATH)[0].translate({ord(c): None for c in ",()%"}).split()
@@ -47,7 +103,392 @@ def get_current_ticker_price_from_yahoo_finance(ticker: str) -> Optional[Dict[st
             "current_price": current_price,
             "absolute_price_change": absolute_price_change,
             "percentage_price_change": percentage_price_change,
+            # the page does not show the quote time, the fetch time stands in for it
+            "last_update_datetime": dt.datetime.now(pytz.utc),
         }
     except Exception as e:
         print(e)
         return None
+
+
+def get_current_ticker_info(ticker: str) -> Optional[Dict[str, Any]]:
+    try:
+        return fetch_chart_ticker_info(ticker)
+    except Exception as e:
+        print(e)
+        return None
+
+
+def get_current_ticker_price_from_yahoo_finance(ticker: str) -> Optional[Dict[str, Any]]:
+    try:
+        return fetch_yahoo_finance_page_ticker_info(ticker)
+    except Exception as e:
+        print(e)
+        return None
+
+
+class CircuitBreaker:
+    FAILURE_THRESHOLD = 5
+    RESET_TIMEOUT = 30.0
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "open" if time.monotonic() - self.opened_at < self.reset_timeout else "half_open"
+
+    def allow_request(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            # once the reset timeout has passed, a single trial request decides whether the breaker closes again
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class PriceProvider(abc.ABC):
+    name = "provider"
+    LATENCY_WINDOW = 200
+    MIN_LATENCY_SAMPLES = 20
+
+    def __init__(self, breaker: Optional[CircuitBreaker] = None) -> None:
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self.fetch_seconds = metrics.registry.histogram("quote_fetch_seconds", "Latency of quote fetches by provider", {"provider": self.name})
+        self.fetch_errors = metrics.registry.counter("quote_fetch_errors_total", "Quote fetches that failed by provider", {"provider": self.name})
+        self.short_circuited = metrics.registry.counter("quote_fetch_short_circuited_total", "Quote fetches skipped by an open circuit breaker by provider", {"provider": self.name})
+
+    @abc.abstractmethod
+    def fetch(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        # raises when the provider cannot be reached at all, symbols it has no quote for are left out
+        ...
+
+    def fetch_measured(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        start = time.monotonic()
+        try:
+            infos = self.fetch(symbols)
+        except Exception:
+            self.breaker.record_failure()
+            self.fetch_errors.inc()
+            raise
+        self.breaker.record_success()
+        latency = time.monotonic() - start
+        self.fetch_seconds.observe(latency)
+        with self.lock:
+            self.latencies.append(latency)
+        return infos
+
+    def get_latency_percentile(self, percentile: float) -> Optional[float]:
+        with self.lock:
+            if len(self.latencies) < self.MIN_LATENCY_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+
+class PerSymbolPriceProvider(PriceProvider):
+    @abc.abstractmethod
+    def fetch_one(self, symbol: str) -> Optional[Dict[str, Any]]:
+        # raises when the provider cannot be reached, None when it has no quote for the symbol
+        ...
+
+    def fetch(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        futures = [fetch_executor.submit(self.fetch_one, symbol) for symbol in symbols]
+        infos, errors = {}, []
+        for symbol, future in zip(symbols, futures):
+            try:
+                info = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if info is not None:
+                infos[symbol] = info
+        # a provider that reached Yahoo for some of the symbols is up
+        if len(errors) > 0 and len(errors) == len(futures):
+            raise errors[0]
+        return infos
+
+
+class YahooQuoteProvider(PriceProvider):
+    name = "yahoo_quote"
+
+    def fetch(self, symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+        chunks = [symbols[i:i + YAHOO_QUOTE_MAX_SYMBOLS] for i in range(0, len(symbols), YAHOO_QUOTE_MAX_SYMBOLS)]
+        futures = [fetch_executor.submit(fetch_quote_ticker_infos, chunk) for chunk in chunks]
+        infos, errors = {}, []
+        for future in futures:
+            try:
+                infos.update(future.result())
+            except Exception as e:
+                errors.append(e)
+        if len(errors) > 0 and len(errors) == len(futures):
+            raise errors[0]
+        return infos
+
+
+class YahooChartProvider(PerSymbolPriceProvider):
+    name = "yahoo_chart"
+
+    def fetch_one(self, symbol: str) -> Optional[Dict[str, Any]]:
+        return fetch_chart_ticker_info(symbol)
+
+
+class YahooFinancePageProvider(PerSymbolPriceProvider):
+    name = "yahoo_finance_page"
+
+    def fetch_one(self, symbol: str) -> Optional[Dict[str, Any]]:
+        return fetch_yahoo_finance_page_ticker_info(symbol)
+
+
+class PriceProviderChain:
+    # a request slower than this percentile of the provider's recent latencies is hedged on the next provider, None never hedges
+    HEDGE_PERCENTILE = 95.0
+    WORKERS = 8
+
+    def __init__(self, providers: List[PriceProvider], hedge_percentile: Optional[float] = HEDGE_PERCENTILE, workers: int = WORKERS) -> None:
+        self.providers = providers
+        self.hedge_percentile = hedge_percentile
+        # separate from fetch_executor, which the providers fan out on
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="price_provider")
+        self.lock = threading.Lock()
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.short_circuited = 0
+        self.failed = 0
+
+    def get_ticker_infos(self, tickers: List[str]) -> List[Optional[Dict[str, Any]]]:
+        symbols = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+        infos: Dict[str, Dict[str, Any]] = {}
+        tried: Set[PriceProvider] = set()
+        # symbols a provider has no quote for, or could not fetch, fall through to the next provider
+        for i, provider in enumerate(self.providers):
+            missing_symbols = [symbol for symbol in symbols if symbol not in infos]
+            if len(missing_symbols) == 0:
+                break
+            if provider in tried:
+                continue
+            if not provider.breaker.allow_request():
+                provider.short_circuited.inc()
+                with self.lock:
+                    self.short_circuited += 1
+                continue
+            infos.update(self.fetch_hedged(provider, self.providers[i + 1:], missing_symbols, tried))
+        return [infos.get(ticker.upper()) for ticker in tickers]
+
+    def fetch_hedged(self, provider: PriceProvider, fallback_providers: List[PriceProvider], symbols: List[str], tried: Set[PriceProvider]) -> Dict[str, Dict[str, Any]]:
+        futures = {self.executor.submit(provider.fetch_measured, symbols): provider}
+        hedge_after = None if self.hedge_percentile is None else provider.get_latency_percentile(self.hedge_percentile)
+        if hedge_after is not None and len(wait(futures, timeout=hedge_after).done) == 0:
+            hedge_provider = next((p for p in fallback_providers if p not in tried and p.breaker.allow_request()), None)
+            if hedge_provider is not None:
+                with self.lock:
+                    self.hedged += 1
+                futures[self.executor.submit(hedge_provider.fetch_measured, symbols)] = hedge_provider
+
+        # the first answer wins, the slower request is only waited for while symbols are still missing
+        infos: Dict[str, Dict[str, Any]] = {}
+        pending = set(futures)
+        while len(pending) > 0 and any(symbol not in infos for symbol in symbols):
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tried.add(futures[future])
+                try:
+                    fetched = future.result()
+                except Exception as e:
+                    print(f"{futures[future].name}: {e}")
+                    with self.lock:
+                        self.failed += 1
+                    continue
+                if futures[future] is not provider and len(fetched) > 0 and len(infos) == 0:
+                    with self.lock:
+                        self.hedge_wins += 1
+                for symbol, info in fetched.items():
+                    infos.setdefault(symbol, info)
+        return infos
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = {
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "short_circuited": self.short_circuited,
+                "failed": self.failed,
+            }
+        for provider in self.providers:
+            stats[f"{provider.name}_breaker"] = provider.breaker.state
+        return stats
+
+
+# the batched quote endpoint first, then the chart endpoint one symbol at a time, then the quote page
+price_provider_chain = PriceProviderChain([YahooQuoteProvider(), YahooChartProvider(), YahooFinancePageProvider()])
+
+
+def get_current_ticker_infos(tickers: List[str]) -> List[Optional[Dict[str, Any]]]:
+    return price_provider_chain.get_ticker_infos(tickers)
+
+
+class QuoteCache:
+    def __init__(self, ttl: float = 5.0, stale_ttl: float = 30.0, max_size: int = 1024, fetch_func: Callable[[List[str]], List[Optional[Dict[str, Any]]]] = get_current_ticker_infos) -> None:
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.fetch_func = fetch_func
+        self.lock = threading.Lock()
+        # ticker -> (fetched_at, ticker info), least recently used first
+        self.entries: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self.in_flight: Dict[str, Future] = {}
+        # ticker -> version of its cached quote, a new number whenever the quote changes, so anything derived
+        # from a quote can be cached by (ticker, version)
+        self.versions: Dict[str, int] = {}
+        self.version = 0
+        self.revalidation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="quote_cache")
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # called with each new quote, fetched or put
+        self.quote_listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+        metrics.registry.gauge("quote_cache_size", "Quotes in the cache").set_function(lambda: len(self.entries))
+
+    @staticmethod
+    def make_key(ticker: str) -> str:
+        return ticker.upper()
+
+    def get(self, ticker: str, allow_stale: bool = True) -> Optional[Dict[str, Any]]:
+        return self.get_many([ticker], allow_stale=allow_stale)[0]
+
+    def get_many(self, tickers: List[str], allow_stale: bool = True) -> List[Optional[Dict[str, Any]]]:
+        now = time.monotonic()
+        infos: Dict[str, Optional[Dict[str, Any]]] = {}
+        waits: Dict[str, Future] = {}
+        to_fetch, to_revalidate = [], []
+
+        with self.lock:
+            for key in dict.fromkeys(self.make_key(ticker) for ticker in tickers):
+                entry = self.entries.get(key)
+                age = None if entry is None else now - entry[0]
+                if age is not None and age <= self.ttl:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    infos[key] = entry[1]
+                elif age is not None and allow_stale and age <= self.ttl + self.stale_ttl:
+                    # serve the stale quote now, refresh it in the background
+                    self.stale_hits += 1
+                    self.entries.move_to_end(key)
+                    infos[key] = entry[1]
+                    if key not in self.in_flight:
+                        self.in_flight[key] = Future()
+                        to_revalidate.append(key)
+                elif key in self.in_flight:
+                    self.coalesced += 1
+                    waits[key] = self.in_flight[key]
+                else:
+                    self.misses += 1
+                    self.in_flight[key] = Future()
+                    to_fetch.append(key)
+
+        if len(to_revalidate) > 0:
+            self.revalidation_executor.submit(self.fetch, to_revalidate)
+        if len(to_fetch) > 0:
+            infos.update(self.fetch(to_fetch))
+        for key, future in waits.items():
+            infos[key] = future.result()
+
+        return [infos[self.make_key(ticker)] for ticker in tickers]
+
+    def add_quote_listener(self, listener: Callable[[str, Dict[str, Any]], None]) -> None:
+        self.quote_listeners.append(listener)
+
+    def notify_quote_listeners(self, infos: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        for listener in self.quote_listeners:
+            for key, info in infos.items():
+                if info is None:
+                    continue
+                try:
+                    listener(key, info)
+                except Exception as e:
+                    print(e)
+
+    def get_versions(self, tickers: List[str], infos: List[Optional[Dict[str, Any]]]) -> List[Optional[int]]:
+        # the versions of quotes returned by get_many, None for a quote that is not the cached one anymore
+        with self.lock:
+            versions = []
+            for ticker, info in zip(tickers, infos):
+                key = self.make_key(ticker)
+                entry = self.entries.get(key)
+                versions.append(self.versions[key] if entry is not None and entry[1] is info else None)
+            return versions
+
+    def store(self, key: str, fetched_at: float, info: Dict[str, Any]) -> None:
+        # must be called with the lock held
+        entry = self.entries.get(key)
+        if entry is None or entry[1] != info:
+            self.version += 1
+            self.versions[key] = self.version
+        self.entries[key] = (fetched_at, info)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            del self.versions[evicted]
+
+    def put(self, ticker: str, info: Dict[str, Any]) -> None:
+        # quotes pushed by a price stream, served like fetched ones
+        key = self.make_key(ticker)
+        with self.lock:
+            self.store(key, time.monotonic(), info)
+        self.notify_quote_listeners({key: info})
+
+    def fetch(self, keys: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        try:
+            infos = dict(zip(keys, self.fetch_func(keys)))
+        except Exception as e:
+            print(e)
+            infos = {}
+
+        fetched_at = time.monotonic()
+        with self.lock:
+            futures = [self.in_flight.pop(key) for key in keys]
+            for key in keys:
+                # failed fetches are not cached, the next request retries them
+                if infos.get(key) is not None:
+                    self.store(key, fetched_at, infos[key])
+
+        for key, future in zip(keys, futures):
+            future.set_result(infos.get(key))
+        self.notify_quote_listeners(infos)
+        return {key: infos.get(key) for key in keys}
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "size": len(self.entries),
+            }
@@ -0,0 +1,303 @@
+from __future__ import annotations
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from collections import OrderedDict
+from enum import Enum
+import base64
+import datetime as dt
+import json
+import random
+import struct
+import threading
+import time
+import pytz
+import metrics
+
+try:
+    import websocket
+except ImportError:
+    # optional, only needed when a price stream is configured
+    websocket = None
+
+
+YAHOO_STREAMER_URL = "wss://streamer.finance.yahoo.com/"
+
+STREAM_TICKS = metrics.registry.counter("price_stream_ticks_total", "Ticks received from the price stream")
+STREAM_CONFLATED = metrics.registry.counter("price_stream_conflated_total", "Ticks replaced by a newer tick of the same ticker before being evaluated")
+STREAM_RECONNECTS = metrics.registry.counter("price_stream_reconnects_total", "Reconnects to the price stream")
+STREAM_DECODE_ERRORS = metrics.registry.counter("price_stream_decode_errors_total", "Price stream messages that could not be decoded")
+
+
+class StreamFormat(Enum):
+    YAHOO = "yahoo"
+    JSON = "json"
+
+
+def read_varint(data: bytes, i: int) -> Tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, i
+        shift += 7
+
+
+def decode_protobuf_fields(data: bytes) -> Dict[int, Any]:
+    # just enough of the wire format for flat messages, the last value of a repeated field wins
+    fields, i = {}, 0
+    while i < len(data):
+        key, i = read_varint(data, i)
+        field_number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, i = read_varint(data, i)
+        elif wire_type == 1:
+            value, i = data[i:i + 8], i + 8
+        elif wire_type == 2:
+            length, i = read_varint(data, i)
+            value, i = data[i:i + length], i + length
+        elif wire_type == 5:
+            value, i = data[i:i + 4], i + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        fields[field_number] = value
+    return fields
+
+
+def decode_zigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+def make_stream_price_dict(current_price: float, absolute_price_change: float, percentage_price_change: float, timestamp: Optional[float]) -> Dict[str, Any]:
+    # the stream does not tell the exchange time zone, quote times are kept in UTC
+    last_update_datetime = dt.datetime.fromtimestamp(timestamp, tz=pytz.utc) if timestamp is not None else dt.datetime.now(pytz.utc)
+    return {
+        "current_price": current_price,
+        "absolute_price_change": absolute_price_change,
+        "percentage_price_change": percentage_price_change,
+        "last_update_datetime": last_update_datetime,
+    }
+
+
+def decode_yahoo_message(message: str) -> List[Tuple[str, Dict[str, Any]]]:
+    # base64 encoded PricingData protobuf, newer streamers wrap it in {"type": "pricing", "message": ...}
+    if message.startswith("{"):
+        message = json.loads(message).get("message")
+        if message is None:
+            return []
+    fields = decode_protobuf_fields(base64.b64decode(message))
+    if 1 not in fields or 2 not in fields:
+        return []
+    symbol = fields[1].decode()
+    current_price = struct.unpack("<f", fields[2])[0]
+    percentage_price_change = struct.unpack("<f", fields[8])[0] if 8 in fields else 0.0
+    absolute_price_change = struct.unpack("<f", fields[12])[0] if 12 in fields else 0.0
+    timestamp = decode_zigzag(fields[3]) / 1000 if 3 in fields else None
+    return [(symbol.upper(), make_stream_price_dict(current_price, absolute_price_change, percentage_price_change, timestamp))]
+
+
+def decode_json_message(message: str) -> List[Tuple[str, Dict[str, Any]]]:
+    # {"symbol": ..., "price": ..., "change": ..., "change_percent": ..., "time": <epoch seconds>}, or a list of them
+    ticks = json.loads(message)
+    ticks = ticks if isinstance(ticks, list) else [ticks]
+    return [(tick["symbol"].upper(), make_stream_price_dict(float(tick["price"]), float(tick.get("change", 0.0)), float(tick.get("change_percent", 0.0)), tick.get("time"))) for tick in ticks if "symbol" in tick and "price" in tick]
+
+
+DECODERS: Dict[StreamFormat, Callable[[str], List[Tuple[str, Dict[str, Any]]]]] = {
+    StreamFormat.YAHOO: decode_yahoo_message,
+    StreamFormat.JSON: decode_json_message,
+}
+
+
+class ConflatingQueue:
+    # keeps only the latest tick of each ticker, so a slow consumer evaluates fresh prices instead of a backlog
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.condition = threading.Condition()
+        self.items: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self.conflated = 0
+        self.dropped = 0
+        self.closed = False
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.items)
+
+    def put(self, key: str, item: Dict[str, Any]) -> None:
+        with self.condition:
+            if key in self.items:
+                # the ticker keeps its place in the queue, only its price is replaced
+                self.items[key] = item
+                self.conflated += 1
+                STREAM_CONFLATED.inc()
+                return
+            if len(self.items) >= self.max_size:
+                self.items.popitem(last=False)
+                self.dropped += 1
+            self.items[key] = item
+            self.condition.notify()
+
+    def get(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        # blocks until an item is available, None once the queue is closed
+        with self.condition:
+            while len(self.items) == 0 and not self.closed:
+                self.condition.wait()
+            if len(self.items) == 0:
+                return None
+            return self.items.popitem(last=False)
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class PriceStream:
+    CONNECT_TIMEOUT = 10.0
+    # without a message for this long the connection is pinged, twice and it is considered dead
+    IDLE_TIMEOUT = 30.0
+    MIN_RECONNECT_DELAY = 1.0
+    MAX_RECONNECT_DELAY = 60.0
+    MAX_PENDING_TICKS = 10000
+
+    def __init__(self, on_tick: Callable[[str, Dict[str, Any]], None], url: str = YAHOO_STREAMER_URL, stream_format: str = StreamFormat.YAHOO.value, max_pending_ticks: int = MAX_PENDING_TICKS) -> None:
+        if websocket is None:
+            raise ImportError("websocket-client is required for the price stream, pip install websocket-client")
+        self.on_tick = on_tick
+        self.url = url
+        self.stream_format = self._make_stream_format(stream_format)
+        self.decode = DECODERS[self.stream_format]
+        self.queue = ConflatingQueue(max_pending_ticks)
+        self.lock = threading.Lock()
+        # stream symbol -> tickers as the alarms spell them
+        self.symbols: Dict[str, Set[str]] = {}
+        self.ws: Optional[websocket.WebSocket] = None
+        self.stopped = threading.Event()
+        self.reader: Optional[threading.Thread] = None
+        self.consumer: Optional[threading.Thread] = None
+        self.connects = 0
+        metrics.registry.gauge("price_stream_pending_ticks", "Ticks waiting to be evaluated").set_function(self.queue.__len__)
+        metrics.registry.gauge("price_stream_connected", "1 while the price stream is connected").set_function(lambda: int(self.ws is not None))
+
+    def _make_stream_format(self, stream_format: str) -> StreamFormat:
+        try:
+            return StreamFormat(stream_format)
+        except ValueError:
+            raise ValueError(f"stream_format = {stream_format} is unknown, expected StreamFormat.")
+
+    def start(self) -> None:
+        self.reader = threading.Thread(target=self.run_reader, name="price_stream_reader", daemon=True)
+        self.consumer = threading.Thread(target=self.run_consumer, name="price_stream_consumer", daemon=True)
+        self.reader.start()
+        self.consumer.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        with self.lock:
+            ws = self.ws
+        if ws is not None:
+            ws.close()
+        self.queue.close()
+        self.reader.join()
+        self.consumer.join()
+
+    def on_tickers_changed(self, added: Iterable[str], removed: Iterable[str]) -> None:
+        # follows the tickers of the poller, (un)subscribes only when a stream symbol gains its first or loses its last ticker
+        to_subscribe, to_unsubscribe = [], []
+        with self.lock:
+            for ticker in added:
+                tickers = self.symbols.setdefault(ticker.upper(), set())
+                if len(tickers) == 0:
+                    to_subscribe.append(ticker.upper())
+                tickers.add(ticker)
+            for ticker in removed:
+                tickers = self.symbols.get(ticker.upper(), set())
+                tickers.discard(ticker)
+                if len(tickers) == 0 and self.symbols.pop(ticker.upper(), None) is not None:
+                    to_unsubscribe.append(ticker.upper())
+        self.send({"subscribe": to_subscribe})
+        self.send({"unsubscribe": to_unsubscribe})
+
+    def send(self, message: Dict[str, List[str]]) -> None:
+        # while disconnected nothing is sent, the next connection subscribes to every symbol
+        if len(next(iter(message.values()))) == 0:
+            return
+        with self.lock:
+            ws = self.ws
+        if ws is None:
+            return
+        try:
+            ws.send(json.dumps(message))
+        except Exception as e:
+            print(e)
+
+    def connect(self) -> websocket.WebSocket:
+        ws = websocket.create_connection(self.url, timeout=self.CONNECT_TIMEOUT)
+        ws.settimeout(self.IDLE_TIMEOUT)
+        with self.lock:
+            self.ws = ws
+            symbols = list(self.symbols)
+        self.connects += 1
+        if self.connects > 1:
+            STREAM_RECONNECTS.inc()
+        if len(symbols) > 0:
+            ws.send(json.dumps({"subscribe": symbols}))
+        return ws
+
+    def run_reader(self) -> None:
+        reconnect_delay = self.MIN_RECONNECT_DELAY
+        while not self.stopped.is_set():
+            try:
+                ws = self.connect()
+                reconnect_delay = self.MIN_RECONNECT_DELAY
+                self.read(ws)
+            except Exception as e:
+                if not self.stopped.is_set():
+                    print(e)
+            with self.lock:
+                ws, self.ws = self.ws, None
+            if ws is not None:
+                ws.close()
+            # exponential backoff with jitter, so that many bots do not reconnect in lockstep
+            self.stopped.wait(reconnect_delay * random.uniform(0.5, 1.0))
+            reconnect_delay = min(2 * reconnect_delay, self.MAX_RECONNECT_DELAY)
+
+    def read(self, ws: websocket.WebSocket) -> None:
+        idle = False
+        while not self.stopped.is_set():
+            try:
+                message = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                if idle:
+                    raise
+                idle = True
+                ws.ping()
+                continue
+            idle = False
+            if isinstance(message, bytes):
+                message = message.decode()
+            if not message:
+                continue
+            try:
+                ticks = self.decode(message)
+            except Exception as e:
+                print(e)
+                STREAM_DECODE_ERRORS.inc()
+                continue
+            for symbol, price_dict in ticks:
+                STREAM_TICKS.inc()
+                self.queue.put(symbol, price_dict)
+
+    def run_consumer(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            symbol, price_dict = item
+            with self.lock:
+                tickers = list(self.symbols.get(symbol, ()))
+            for ticker in tickers:
+                try:
+                    self.on_tick(ticker, price_dict)
+                except Exception as e:
+                    print(e)
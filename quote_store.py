@@ -0,0 +1,133 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
+import datetime as dt
+import threading
+import pytz
+import metrics
+from db import Database, WriteBehindBuffer
+
+
+QUOTES_STORED = metrics.registry.counter("quote_store_samples_total", "Quote samples written to the quote store")
+QUOTES_DEDUPLICATED = metrics.registry.counter("quote_store_duplicates_total", "Quotes not stored again because their market time was already stored")
+
+
+def to_milliseconds(datetime: dt.datetime) -> int:
+    return int(datetime.timestamp() * 1000)
+
+
+def downsample(times: List[int], prices: List[float], interval_ms: int) -> Tuple[List[int], List[float]]:
+    # sorted and deduplicated, the last price of each interval stamped with the start of the interval
+    samples: Dict[int, float] = {}
+    for time_ms, price in sorted(zip(times, prices)):
+        samples[time_ms - time_ms % interval_ms if interval_ms > 0 else time_ms] = price
+    return list(samples), list(samples.values())
+
+
+class QuoteStore:
+    # every fetched or streamed quote in bucketed documents of {t, p} samples, one document per
+    # ticker, resolution and bucket span; older buckets are downsampled to the next resolution, then dropped
+    # (resolution in seconds, 0 for every sample; bucket span in seconds)
+    RESOLUTIONS = ((0, 3600), (60, 86400), (3600, 30 * 86400))
+    RETENTIONS = (2 * 86400, 30 * 86400, None)
+    FLUSH_INTERVAL = 1.0
+    MAX_BATCH_SIZE = 2000
+    MAX_PENDING_SAMPLES = 100000
+    COMPACT_INTERVAL = 3600
+    MAX_COMPACT_ATTEMPTS = 3
+
+    def __init__(self, db: Database, raw_retention: float = RETENTIONS[0], minute_retention: float = RETENTIONS[1], hour_retention: Optional[float] = RETENTIONS[2], flush_interval: float = FLUSH_INTERVAL, compact_interval: float = COMPACT_INTERVAL) -> None:
+        self.db = db
+        self.retentions = (raw_retention, minute_retention, hour_retention)
+        self.compact_interval = compact_interval
+        self.lock = threading.Lock()
+        # ticker -> market time (ms) of the last stored quote, the cache serves the same quote many times
+        self.last_times: Dict[str, int] = {}
+        # samples are dropped rather than slowing down the pollers when Mongo falls behind
+        self.buffer = WriteBehindBuffer("quote", self.flush, self.MAX_BATCH_SIZE, flush_interval, self.MAX_PENDING_SAMPLES, drop_when_full=True)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="quote_store_compactor", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.buffer.close()
+
+    def add(self, ticker: str, price_dict: Dict[str, Any]) -> None:
+        ticker = ticker.upper()
+        time_ms = to_milliseconds(price_dict["last_update_datetime"])
+        with self.lock:
+            if time_ms <= self.last_times.get(ticker, -1):
+                QUOTES_DEDUPLICATED.inc()
+                return
+            self.last_times[ticker] = time_ms
+        self.buffer.put((ticker, time_ms, float(price_dict["current_price"])))
+
+    @staticmethod
+    def get_bucket_start(time_ms: int, span: int) -> dt.datetime:
+        return dt.datetime.utcfromtimestamp(time_ms // 1000 - time_ms // 1000 % span)
+
+    def flush(self, samples: List[Tuple[str, int, float]]) -> List[Tuple[str, int, float]]:
+        # returns the samples of the buckets to retry
+        resolution, span = self.RESOLUTIONS[0]
+        buckets: Dict[Tuple[str, int, dt.datetime], Tuple[List[int], List[float]]] = {}
+        for ticker, time_ms, price in samples:
+            times, prices = buckets.setdefault((ticker, resolution, self.get_bucket_start(time_ms, span)), ([], []))
+            times.append(time_ms)
+            prices.append(price)
+        failed = [(key[0], time_ms, price) for key in self.db.append_quote_samples(buckets) for time_ms, price in zip(*buckets[key])]
+        QUOTES_STORED.inc(len(samples) - len(failed))
+        return failed
+
+    def get_quotes(self, ticker: str, start: dt.datetime, end: dt.datetime, interval: Optional[float] = None) -> List[Tuple[dt.datetime, float]]:
+        # the samples of a ticker between start and end at the finest resolution stored, or the last price of each interval
+        start_ms, end_ms = to_milliseconds(start), to_milliseconds(end)
+        times, prices = [], []
+        for doc in self.db.find_quote_buckets(ticker.upper(), start.astimezone(pytz.utc).replace(tzinfo=None), end.astimezone(pytz.utc).replace(tzinfo=None)):
+            for sample in doc["s"]:
+                time_ms, price = sample["t"], sample["p"]
+                if start_ms <= time_ms <= end_ms:
+                    times.append(time_ms)
+                    prices.append(price)
+        times, prices = downsample(times, prices, int(1000 * interval) if interval is not None else 0)
+        return [(dt.datetime.fromtimestamp(time_ms / 1000, tz=pytz.utc), price) for time_ms, price in zip(times, prices)]
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.compact_interval):
+            try:
+                self.compact(dt.datetime.utcnow())
+            except Exception as e:
+                print(e)
+
+    def compact(self, now: dt.datetime) -> int:
+        # buckets past the retention of their resolution are moved to the next one, the last one is just dropped
+        num_compacted = 0
+        for i, ((resolution, _), retention) in enumerate(zip(self.RESOLUTIONS, self.retentions)):
+            if retention is None:
+                continue
+            before = now - dt.timedelta(seconds=retention)
+            if i + 1 == len(self.RESOLUTIONS):
+                num_compacted += self.db.delete_expired_quote_buckets(resolution, before)
+                continue
+            next_resolution, next_span = self.RESOLUTIONS[i + 1]
+            for bucket_id in self.db.find_expired_quote_bucket_ids(resolution, before):
+                doc = self.db.take_quote_bucket(bucket_id)
+                if doc is None:
+                    continue
+                times, prices = downsample([sample["t"] for sample in doc["s"]], [sample["p"] for sample in doc["s"]], 1000 * next_resolution)
+                buckets: Dict[Tuple[str, int, dt.datetime], Tuple[List[int], List[float]]] = {}
+                for time_ms, price in zip(times, prices):
+                    bucket_times, bucket_prices = buckets.setdefault((doc["ticker"], next_resolution, self.get_bucket_start(time_ms, next_span)), ([], []))
+                    bucket_times.append(time_ms)
+                    bucket_prices.append(price)
+                # the bucket is already taken, a bucket racing another process is retried at once
+                for _ in range(self.MAX_COMPACT_ATTEMPTS):
+                    failed = self.db.append_quote_samples(buckets)
+                    if len(failed) == 0:
+                        break
+                    buckets = {key: buckets[key] for key in failed}
+                num_compacted += 1
+        return num_compacted
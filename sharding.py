@@ -0,0 +1,190 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Set, Union
+import datetime
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from telegram.ext import JobQueue
+import metrics
+from db import Database
+from ticker_alarm import ExpressionAlarm, TickerAlarm, WindowAlarm
+from ticker_poller import TickerPoller
+
+
+LEASES_ACQUIRED = metrics.registry.counter("partition_leases_acquired_total", "Partitions taken over by this worker")
+LEASES_LOST = metrics.registry.counter("partition_leases_lost_total", "Partitions given up by this worker, released or expired")
+
+
+class ShardCoordinator:
+    # a worker holds leases on a share of the partitions and evaluates only their alarms, a worker that stops
+    # renewing its leases has them taken over by the others once they expire
+    LEASE_TTL = 15.0
+    RENEW_INTERVAL = 5.0
+    SYNC_INTERVAL = 2.0
+    # alarm changes are looked up since a bit before the last sync, the clocks of the bot and worker hosts may differ
+    MAX_CLOCK_SKEW = 5.0
+
+    def __init__(self, db: Database, poller: TickerPoller, worker_id: Optional[str] = None, lease_ttl: float = LEASE_TTL, renew_interval: float = RENEW_INTERVAL, sync_interval: float = SYNC_INTERVAL) -> None:
+        self.db = db
+        self.poller = poller
+        self.worker_id = worker_id if worker_id is not None else f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+        self.sync_interval = sync_interval
+        # owned partition -> ids of the alarms subscribed for it
+        self.partitions: Dict[int, Set[str]] = {}
+        # monotonic time until which the leases are known to be held, after it the partitions are dropped
+        self.valid_until = 0.0
+        self.renewed_at = float("-inf")
+        self.synced_at: Optional[datetime.datetime] = None
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        metrics.registry.gauge("owned_partitions", "Partitions whose alarms this worker evaluates").set_function(lambda: len(self.partitions))
+
+    def start(self) -> None:
+        self.db.assign_partitions()
+        self.thread = threading.Thread(target=self.run, name="shard_coordinator", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        # releases the leases so that the other workers take over without waiting for them to expire
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        partitions = list(self.partitions)
+        for partition in partitions:
+            self.drop_partition(partition)
+        try:
+            self.db.release_leases(self.worker_id, partitions)
+            self.db.remove_worker(self.worker_id)
+        except Exception as e:
+            print(e)
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                if time.monotonic() - self.renewed_at >= self.renew_interval:
+                    self.rebalance()
+                self.sync()
+            except Exception as e:
+                print(e)
+            if time.monotonic() > self.valid_until:
+                # the leases could not be renewed, another worker may own the partitions by now
+                for partition in list(self.partitions):
+                    self.drop_partition(partition)
+            self.stopped.wait(self.sync_interval)
+
+    def get_target_num_partitions(self) -> int:
+        # the partitions are split as evenly as they divide, the workers first by id take the one left over
+        worker_ids = self.db.find_live_worker_ids()
+        if self.worker_id not in worker_ids:
+            worker_ids.append(self.worker_id)
+        num_partitions, num_left_over = divmod(self.db.NUM_PARTITIONS, len(worker_ids))
+        return num_partitions + (1 if worker_ids.index(self.worker_id) < num_left_over else 0)
+
+    def renew(self) -> None:
+        started_at = time.monotonic()
+        self.db.heartbeat_worker(self.worker_id, self.lease_ttl)
+        held = set(self.db.renew_leases(self.worker_id, list(self.partitions), self.lease_ttl))
+        self.renewed_at = started_at
+        self.valid_until = started_at + self.lease_ttl - self.renew_interval
+        for partition in set(self.partitions) - held:
+            self.drop_partition(partition)
+
+    def rebalance(self) -> None:
+        self.renew()
+        # a worker above its share releases partitions for the workers that joined, one below it takes free ones
+        target = self.get_target_num_partitions()
+        extra = sorted(self.partitions)[target:]
+        if len(extra) > 0:
+            for partition in extra:
+                self.drop_partition(partition)
+            self.db.release_leases(self.worker_id, extra)
+        free = self.db.find_free_partitions()
+        random.shuffle(free)
+        acquired = []
+        for partition in free:
+            if len(self.partitions) + len(acquired) >= target or self.stopped.is_set():
+                break
+            if self.db.acquire_lease(partition, self.worker_id, self.lease_ttl):
+                acquired.append(partition)
+        if len(acquired) > 0:
+            self.load_partitions(acquired)
+        # loading many partitions may take longer than the leases last
+        if time.monotonic() - self.renewed_at >= self.renew_interval:
+            self.renew()
+
+    def load_partitions(self, partitions: List[int]) -> None:
+        # the alarms of all the partitions taken in one rebalance are read in one query
+        if self.synced_at is None:
+            self.synced_at = datetime.datetime.utcnow()
+        subscriptions, alarm_ids = [], {partition: set() for partition in partitions}
+        for doc in self.db.find_active_ticker_alarms(partitions):
+            alarm = TickerAlarm.deserialize(doc["alarm"])
+            subscriptions.append((doc["user_id"], alarm))
+            alarm_ids[doc["partition"]].add(alarm.alarm_id)
+        self.partitions.update(alarm_ids)
+        self.poller.subscribe_many(subscriptions)
+        LEASES_ACQUIRED.inc(len(partitions))
+
+    def drop_partition(self, partition: int) -> None:
+        # only stops evaluating the alarms, they stay active for the next owner
+        for alarm_id in self.partitions.pop(partition, ()):
+            self.poller.unsubscribe(alarm_id)
+        LEASES_LOST.inc()
+
+    def sync(self) -> None:
+        # picks up the alarms set and unset through the bot process since the last sync
+        if len(self.partitions) == 0 or self.synced_at is None:
+            return
+        since = self.synced_at - datetime.timedelta(seconds=self.MAX_CLOCK_SKEW)
+        self.synced_at = datetime.datetime.utcnow()
+        for doc in self.db.find_ticker_alarm_changes(list(self.partitions), since):
+            alarm_ids = self.partitions.get(doc["partition"])
+            if alarm_ids is None:
+                continue
+            alarm_id = doc["alarm"]["alarm_id"]
+            if not doc["active"]:
+                self.poller.unsubscribe(alarm_id)
+                alarm_ids.discard(alarm_id)
+            elif alarm_id not in alarm_ids:
+                # an alarm this worker triggered stays in alarm_ids, so it is not subscribed again before its removal is written
+                alarm_ids.add(alarm_id)
+                self.poller.subscribe(doc["user_id"], TickerAlarm.deserialize(doc["alarm"]))
+
+
+class RemotePoller:
+    # stands in for the poller of a bot process that only handles commands, the alarms set through it are stored
+    # in Mongo and evaluated by the worker holding the lease of their partition
+    def __init__(self, db: Database) -> None:
+        self.db = db
+
+    def start(self, job_queue: Optional[JobQueue] = None) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def rehydrate(self) -> int:
+        return 0
+
+    def subscribe(self, user_id: int, alarm: Union[TickerAlarm, ExpressionAlarm, WindowAlarm]) -> None:
+        pass
+
+    def unsubscribe(self, alarm_id: str, user_id: Optional[int] = None) -> Optional[Union[TickerAlarm, ExpressionAlarm, WindowAlarm]]:
+        # the owning worker picks up that the alarm is inactive on its next sync
+        doc = self.db.deactivate_ticker_alarm(alarm_id, user_id)
+        return TickerAlarm.deserialize(doc["alarm"]) if doc is not None else None
+
+    def alarm_ids(self) -> List[str]:
+        return [doc["alarm"]["alarm_id"] for doc in self.db.find_active_ticker_alarms()]
+
+    def alarm_ids_of_user(self, user_id: int) -> List[str]:
+        return [alarm.alarm_id for alarm in self.alarms_of_user(user_id)]
+
+    def alarms_of_user(self, user_id: int) -> List[Union[TickerAlarm, ExpressionAlarm, WindowAlarm]]:
+        # the alarms are only held in memory by the workers
+        return [TickerAlarm.deserialize(doc["alarm"]) for doc in self.db.find_active_ticker_alarms_of_user(user_id)]
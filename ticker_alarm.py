@@ -1,11 +1,12 @@
 from __future__ import annotations
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 from enum import Enum
 from functools import partialmethod
-from copy import deepcopy
 import pymongo
-from telegram.ext import CallbackContext
-from price import get_current_ticker_info
+from expression import CompiledExpression
+from notifier import Notifier, Priority
+if TYPE_CHECKING:
+    from ticker_poller import TickerPoller
 
 
 class Condition(Enum):
@@ -18,14 +19,32 @@ class AlarmType(Enum):
     REPEAT = "repeat"
 
 
+class Signal(Enum):
+    MOVE = "move"
+    CROSS = "cross"
+    BREAKOUT = "breakout"
+
+
+# window lengths are given in seconds or with one of these units, e.g. 90s, 20m, 1h, 1d
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
 class TickerAlarm:
-    def __init__(self, alarm_id: str, ticker: str, condition: Union[Condition, str], target: float, alarm_type: Union[AlarmType, str], description: Optional[str] = None) -> None:
+    __slots__ = ("alarm_id", "ticker", "condition", "target", "alarm_type", "description", "hysteresis", "cooldown", "armed", "last_triggered_at")
+
+    def __init__(self, alarm_id: str, ticker: str, condition: Union[Condition, str], target: float, alarm_type: Union[AlarmType, str], description: Optional[str] = None, hysteresis: float = 0.0, cooldown: float = 0.0, armed: bool = True, last_triggered_at: Optional[float] = None) -> None:
         self.alarm_id = alarm_id
         self.ticker = ticker
         self.condition = self._parse_condition(condition)
         self.target = target
         self.alarm_type = self._parse_alarm_type(alarm_type)
         self.description = description
+        # a triggered repeat alarm is disarmed until the price is back beyond target by hysteresis,
+        # and does not trigger again within cooldown seconds
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.armed = armed
+        self.last_triggered_at = last_triggered_at
 
     def _parse_condition(self, condition: Union[Condition, str]) -> None:
         if isinstance(condition, Condition):
@@ -51,8 +70,7 @@ class TickerAlarm:
     def make_alarm_id(user_id: str, message_id: str) -> str:
         return f"{user_id}-{message_id}"
 
-    def check_alarm_condition(self) -> Optional[bool]:
-        price_dict = get_current_ticker_info(self.ticker)
+    def check_alarm_condition(self, price_dict: Optional[Dict[str, Any]]) -> Optional[bool]:
         if price_dict is not None:
             current_price = price_dict["current_price"]
             if self.condition == Condition.GREATER_THAN:
@@ -61,9 +79,22 @@ class TickerAlarm:
                 return current_price < self.target
         return None
 
+    def get_rearm_condition_and_target(self) -> Tuple[Condition, float]:
+        if self.condition == Condition.GREATER_THAN:
+            return Condition.LESS_THAN, self.target - self.hysteresis
+        elif self.condition == Condition.LESS_THAN:
+            return Condition.GREATER_THAN, self.target + self.hysteresis
+        else:
+            raise ValueError(f"Unknown condition {self.condition}")
+
+    def is_cooling_down(self, now: float) -> bool:
+        return self.last_triggered_at is not None and now - self.last_triggered_at < self.cooldown
+
     def __str__(self) -> str:
         text = f"[alarm_id = {self.alarm_id}, alarm_type = {self.alarm_type.value}]"
         text += f"\n{self.ticker} {self.condition.value} {self.target}"
+        if self.alarm_type == AlarmType.REPEAT and (self.hysteresis or self.cooldown):
+            text += f"\nhysteresis = {self.hysteresis}, cooldown = {self.cooldown}s"
         if self.description:
             text += f"\ndesc = {self.description}"
         return text
@@ -80,53 +111,291 @@ class TickerAlarm:
     def get_ticker_alarm_price_error_text(self) -> str:
         return f"price cannot be retrieved for ticker {self.ticker}, unsetting alarm"
 
-    @staticmethod
-    def run(callback_context: CallbackContext, alarm: TickerAlarm, db: pymongo.database.Database) -> None:
-        job_context = callback_context.job.context
-        user_id = job_context["user_id"]
-
-        alarm_condition = alarm.check_alarm_condition()
+    def evaluate(self, price_dict: Optional[Dict[str, Any]]) -> Tuple[Optional[str], Optional[str]]:
+        # returns the message to send (if any) and the modification to remove the alarm with (if any)
+        alarm_condition = self.check_alarm_condition(price_dict)
         if alarm_condition is None:
-            callback_context.bot.send_message(user_id, text=alarm.get_ticker_alarm_price_error_text())
-            TickerAlarm.remove_alarm_from_jobs(db, callback_context, alarm.alarm_id, modification="error")
+            return self.get_ticker_alarm_price_error_text(), "error"
         elif alarm_condition:
-            callback_context.bot.send_message(user_id, text=alarm.get_ticker_alarm_triggered_message_text())
-            if alarm.alarm_type == AlarmType.ONCE:
-                TickerAlarm.remove_alarm_from_jobs(db, callback_context, alarm.alarm_id, modification="trigger")
+            return self.get_ticker_alarm_triggered_message_text(), "trigger" if self.alarm_type == AlarmType.ONCE else None
+        return None, None
 
     @staticmethod
-    def remove_alarm_from_jobs(db: pymongo.database.Database, context: CallbackContext, alarm_id: str, modification: str) -> Tuple[bool, str]:
-        jobs = context.job_queue.get_jobs_by_name(alarm_id)
+    def run(notifier: Notifier, alarm: TickerAlarm, user_id: int, price_dict: Optional[Dict[str, Any]]) -> None:
+        # the poller has already removed the alarms the quote ends
+        text, modification = alarm.evaluate(price_dict)
+        if text is not None:
+            notifier.send(user_id, text, priority=Priority.INFO if modification == "error" else Priority.TRIGGER)
 
-        if len(jobs) == 0:
-            return False, f"no alarm with alarm_id {alarm_id}"
+    @staticmethod
+    def remove_alarm_from_poller(db: pymongo.database.Database, poller: TickerPoller, alarm_id: str, modification: str, user_id: Optional[int] = None) -> Tuple[bool, str]:
+        alarm = poller.unsubscribe(alarm_id, user_id)
 
-        for job in jobs:
-            db.update_alarm(alarm_id, modification)
-            job.schedule_removal()
+        if alarm is None:
+            return False, f"no alarm with alarm_id {alarm_id}"
 
+        db.update_alarm(alarm_id, modification)
         return True, f"removed alarm with alarm_id {alarm_id}"
 
     @staticmethod
-    def remove_all_alarms_from_jobs(db: pymongo.database.Database, context: CallbackContext, modification: str) -> Tuple[bool, str]:
-        jobs = context.job_queue.jobs()
+    def remove_all_alarms_from_poller(db: pymongo.database.Database, poller: TickerPoller, user_id: int, modification: str) -> Tuple[bool, str]:
+        alarm_ids = poller.alarm_ids_of_user(user_id)
 
-        if len(jobs) == 0:
+        if len(alarm_ids) == 0:
             return False, f"no alarm to unset"
 
-        for job in jobs:
-            alarm_id = job.name
-            db.update_alarm(alarm_id, modification)
-            job.schedule_removal()
+        for alarm_id in alarm_ids:
+            if poller.unsubscribe(alarm_id, user_id) is not None:
+                db.update_alarm(alarm_id, modification)
 
         return True, f"all alarms unset"
 
     def serialize(self) -> Dict[str, Any]:
-        dct = deepcopy(self.__dict__)
+        dct = {name: getattr(self, name) for name in self.__slots__}
         dct["condition"] = dct["condition"].value
         dct["alarm_type"] = dct["alarm_type"].value
         return dct
 
     @classmethod
-    def deserialize(cls, dct: Dict[str, Any]) -> TickerAlarm:
+    def deserialize(cls, dct: Dict[str, Any]) -> Union[TickerAlarm, ExpressionAlarm, WindowAlarm]:
+        if dct.get("kind") == ExpressionAlarm.KIND:
+            return ExpressionAlarm.deserialize(dct)
+        if dct.get("kind") == WindowAlarm.KIND:
+            return WindowAlarm.deserialize(dct)
+        return cls(**dct)
+
+
+class ExpressionAlarm:
+    # compares two arithmetic expressions over tickers, e.g. EREGL.IS > 2.07 * KRDMDM.IS
+    KIND = "expression"
+    __slots__ = ("alarm_id", "left", "condition", "right", "alarm_type", "description", "hysteresis", "cooldown", "armed", "last_triggered_at", "last_values")
+
+    def __init__(self, alarm_id: str, left: Union[CompiledExpression, str], condition: Union[Condition, str], right: Union[CompiledExpression, str], alarm_type: Union[AlarmType, str], description: Optional[str] = None, hysteresis: float = 0.0, cooldown: float = 0.0, armed: bool = True, last_triggered_at: Optional[float] = None) -> None:
+        self.alarm_id = alarm_id
+        self.left = left if isinstance(left, CompiledExpression) else CompiledExpression.compile(left)
+        self.condition = condition if isinstance(condition, Condition) else Condition(condition)
+        self.right = right if isinstance(right, CompiledExpression) else CompiledExpression.compile(right)
+        self.alarm_type = alarm_type if isinstance(alarm_type, AlarmType) else AlarmType(alarm_type)
+        self.description = description
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.armed = armed
+        self.last_triggered_at = last_triggered_at
+        # values of both sides at the last evaluation, shown in the triggered message
+        self.last_values: Optional[Tuple[float, float]] = None
+
+    @property
+    def name(self) -> str:
+        return self.alarm_id
+
+    @property
+    def tickers(self) -> List[str]:
+        return list(dict.fromkeys(self.left.tickers + self.right.tickers))
+
+    def get_values(self, prices: Dict[str, float]) -> Optional[Tuple[float, float]]:
+        left_value, right_value = self.left.evaluate(prices), self.right.evaluate(prices)
+        if left_value is None or right_value is None:
+            return None
+        self.last_values = (left_value, right_value)
+        return self.last_values
+
+    def check_values(self, values: Tuple[float, float]) -> bool:
+        left_value, right_value = values
+        if self.condition == Condition.GREATER_THAN:
+            return left_value > right_value
+        elif self.condition == Condition.LESS_THAN:
+            return left_value < right_value
+        else:
+            raise ValueError(f"Unknown condition {self.condition}")
+
+    def check_rearm_values(self, values: Tuple[float, float]) -> bool:
+        left_value, right_value = values
+        if self.condition == Condition.GREATER_THAN:
+            return left_value < right_value - self.hysteresis
+        elif self.condition == Condition.LESS_THAN:
+            return left_value > right_value + self.hysteresis
+        else:
+            raise ValueError(f"Unknown condition {self.condition}")
+
+    def is_cooling_down(self, now: float) -> bool:
+        return self.last_triggered_at is not None and now - self.last_triggered_at < self.cooldown
+
+    def __str__(self) -> str:
+        text = f"[alarm_id = {self.alarm_id}, alarm_type = {self.alarm_type.value}]"
+        text += f"\n{self.left} {self.condition.value} {self.right}"
+        if self.alarm_type == AlarmType.REPEAT and (self.hysteresis or self.cooldown):
+            text += f"\nhysteresis = {self.hysteresis}, cooldown = {self.cooldown}s"
+        if self.description:
+            text += f"\ndesc = {self.description}"
+        return text
+
+    def get_ticker_alarm_triggered_message_text(self) -> str:
+        text = f"alarm triggered\n{self}"
+        if self.last_values is not None:
+            text += f"\n{self.last_values[0]:.6g} {self.condition.value} {self.last_values[1]:.6g}"
+        return text
+
+    def get_ticker_alarm_set_message_text(self) -> str:
+        return f"alarm set\n{self}"
+
+    def get_ticker_alarm_unset_message_text(self) -> str:
+        return f"alarm unset\n{self}"
+
+    def get_ticker_alarm_price_error_text(self) -> str:
+        return f"price cannot be retrieved for a ticker of {self.left} {self.condition.value} {self.right}, unsetting alarm"
+
+    def evaluate(self, price_dict: Optional[Dict[str, Any]]) -> Tuple[Optional[str], Optional[str]]:
+        # the poller only returns an expression alarm when a quote failed or its condition holds
+        if price_dict is None:
+            return self.get_ticker_alarm_price_error_text(), "error"
+        return self.get_ticker_alarm_triggered_message_text(), "trigger" if self.alarm_type == AlarmType.ONCE else None
+
+    def serialize(self) -> Dict[str, Any]:
+        return {
+            "kind": self.KIND,
+            "alarm_id": self.alarm_id,
+            "left": self.left.serialize(),
+            "condition": self.condition.value,
+            "right": self.right.serialize(),
+            "alarm_type": self.alarm_type.value,
+            "description": self.description,
+            "hysteresis": self.hysteresis,
+            "cooldown": self.cooldown,
+            "armed": self.armed,
+            "last_triggered_at": self.last_triggered_at,
+        }
+
+    @classmethod
+    def deserialize(cls, dct: Dict[str, Any]) -> ExpressionAlarm:
+        dct = {key: value for key, value in dct.items() if key != "kind"}
+        dct["left"], dct["right"] = CompiledExpression.deserialize(dct["left"]), CompiledExpression.deserialize(dct["right"])
         return cls(**dct)
+
+
+class WindowAlarm:
+    # a signal over the recent quotes of a ticker compared to a threshold in percent: the move since the start of the
+    # window, the short moving average against the long one, or the price against the high (>) or low (<) of the window
+    KIND = "window"
+    MAX_WINDOW = 7 * 86400
+    __slots__ = ("alarm_id", "ticker", "signal", "condition", "threshold", "window", "long_window", "alarm_type", "description", "hysteresis", "cooldown", "armed", "last_triggered_at", "last_value")
+
+    def __init__(self, alarm_id: str, ticker: str, signal: Union[Signal, str], condition: Union[Condition, str], threshold: float, window: float, long_window: Optional[float], alarm_type: Union[AlarmType, str], description: Optional[str] = None, hysteresis: float = 0.0, cooldown: float = 0.0, armed: Optional[bool] = None, last_triggered_at: Optional[float] = None) -> None:
+        self.alarm_id = alarm_id
+        self.ticker = ticker
+        self.signal = signal if isinstance(signal, Signal) else Signal(signal)
+        self.condition = condition if isinstance(condition, Condition) else Condition(condition)
+        self.threshold = threshold
+        self.window = window
+        self.long_window = long_window
+        self.alarm_type = alarm_type if isinstance(alarm_type, AlarmType) else AlarmType(alarm_type)
+        self.description = description
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        # a crossover only counts once the short average has been on the other side of the long one
+        self.armed = armed if armed is not None else self.signal != Signal.CROSS
+        self.last_triggered_at = last_triggered_at
+        # the signal at the last trigger, shown in the triggered message
+        self.last_value: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return self.alarm_id
+
+    @property
+    def longest_window(self) -> float:
+        return self.long_window if self.long_window is not None else self.window
+
+    @staticmethod
+    def parse_window(text: str) -> float:
+        unit = WINDOW_UNITS.get(text[-1:].lower())
+        try:
+            seconds = float(text[:-1]) * unit if unit is not None else float(text)
+        except ValueError:
+            raise ValueError(f"window {text} should be seconds or end with one of {', '.join(WINDOW_UNITS)} (e.g. 90s, 20m, 1h, 1d)")
+        if not 0 < seconds <= WindowAlarm.MAX_WINDOW:
+            raise ValueError(f"window {text} should be longer than 0 and at most {WindowAlarm.format_window(WindowAlarm.MAX_WINDOW)}")
+        return seconds
+
+    @staticmethod
+    def format_window(seconds: float) -> str:
+        for unit, unit_seconds in sorted(WINDOW_UNITS.items(), key=lambda item: -item[1]):
+            if seconds % unit_seconds == 0:
+                return f"{int(seconds // unit_seconds)}{unit}"
+        return f"{seconds:g}s"
+
+    @classmethod
+    def parse(cls, alarm_id: str, ticker: str, signal: str, condition: str, args: List[str], alarm_type: str, hysteresis: float, cooldown: float) -> WindowAlarm:
+        # move takes <percent> <window>, cross takes <short_window> <long_window>, breakout takes <window>
+        signal = Signal(signal.lower())
+        if signal == Signal.MOVE:
+            if len(args) != 2:
+                raise ValueError("move should be followed by a percent and a window (e.g. AAPL move > 5 1h)")
+            try:
+                threshold = float(args[0].rstrip("%"))
+            except ValueError:
+                raise ValueError(f"percent {args[0]} should be int or float (e.g. 5, -2.5)")
+            return cls(alarm_id, ticker, signal, condition, threshold, cls.parse_window(args[1]), None, alarm_type, hysteresis=hysteresis, cooldown=cooldown)
+        elif signal == Signal.CROSS:
+            if len(args) != 2:
+                raise ValueError("cross should be followed by a short and a long window (e.g. AAPL cross > 20m 1h)")
+            window, long_window = cls.parse_window(args[0]), cls.parse_window(args[1])
+            if window >= long_window:
+                raise ValueError("the short window should be shorter than the long window")
+            return cls(alarm_id, ticker, signal, condition, 0.0, window, long_window, alarm_type, hysteresis=hysteresis, cooldown=cooldown)
+        else:
+            if len(args) != 1:
+                raise ValueError("breakout should be followed by a window (e.g. AAPL breakout > 1d)")
+            return cls(alarm_id, ticker, signal, condition, 0.0, cls.parse_window(args[0]), None, alarm_type, hysteresis=hysteresis, cooldown=cooldown)
+
+    def is_cooling_down(self, now: float) -> bool:
+        return self.last_triggered_at is not None and now - self.last_triggered_at < self.cooldown
+
+    def get_signal_text(self) -> str:
+        if self.signal == Signal.MOVE:
+            return f"{self.ticker} move {self.condition.value} {self.threshold:g}% in {self.format_window(self.window)}"
+        elif self.signal == Signal.CROSS:
+            return f"{self.ticker} {self.format_window(self.window)} average {self.condition.value} {self.format_window(self.long_window)} average"
+        extreme = "high" if self.condition == Condition.GREATER_THAN else "low"
+        return f"{self.ticker} {self.condition.value} {self.format_window(self.window)} {extreme}"
+
+    def __str__(self) -> str:
+        text = f"[alarm_id = {self.alarm_id}, alarm_type = {self.alarm_type.value}]"
+        text += f"\n{self.get_signal_text()}"
+        if self.alarm_type == AlarmType.REPEAT and (self.hysteresis or self.cooldown):
+            text += f"\nhysteresis = {self.hysteresis}%, cooldown = {self.cooldown}s"
+        if self.description:
+            text += f"\ndesc = {self.description}"
+        return text
+
+    def get_ticker_alarm_triggered_message_text(self) -> str:
+        text = f"alarm triggered\n{self}"
+        if self.last_value is not None:
+            text += f"\nsignal = {self.last_value:+.2f}%"
+        return text
+
+    def get_ticker_alarm_set_message_text(self) -> str:
+        return f"alarm set\n{self}"
+
+    def get_ticker_alarm_unset_message_text(self) -> str:
+        return f"alarm unset\n{self}"
+
+    def get_ticker_alarm_price_error_text(self) -> str:
+        return f"price cannot be retrieved for ticker {self.ticker}, unsetting alarm"
+
+    def evaluate(self, price_dict: Optional[Dict[str, Any]]) -> Tuple[Optional[str], Optional[str]]:
+        # the poller only returns a window alarm when a quote failed or its signal crossed the threshold
+        if price_dict is None:
+            return self.get_ticker_alarm_price_error_text(), "error"
+        return self.get_ticker_alarm_triggered_message_text(), "trigger" if self.alarm_type == AlarmType.ONCE else None
+
+    def serialize(self) -> Dict[str, Any]:
+        dct = {name: getattr(self, name) for name in self.__slots__ if name != "last_value"}
+        dct["kind"] = self.KIND
+        dct["signal"] = self.signal.value
+        dct["condition"] = self.condition.value
+        dct["alarm_type"] = self.alarm_type.value
+        return dct
+
+    @classmethod
+    def deserialize(cls, dct: Dict[str, Any]) -> WindowAlarm:
+        return cls(**{key: value for key, value in dct.items() if key != "kind"})
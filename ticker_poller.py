@@ -0,0 +1,395 @@
+from __future__ import annotations
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+import datetime as dt
+import threading
+import time
+import zlib
+import pytz
+from telegram.ext import CallbackContext, Job, JobQueue
+import metrics
+from alarm_index import ThresholdIndex
+from alarm_registry import AlarmRegistry
+from db import Database
+from notifier import Notifier
+from poll_schedule import TickerPollSchedule
+from price import QuoteCache
+from ticker_alarm import AlarmType, Condition, ExpressionAlarm, TickerAlarm, WindowAlarm
+from window_index import WindowIndex
+
+
+ALARM_EVALUATION_SECONDS = metrics.registry.histogram("alarm_evaluation_seconds", "Time to evaluate the alarms of a ticker against a new quote", buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1))
+POLL_LAG_SECONDS = metrics.registry.histogram("poll_scheduling_lag_seconds", "Delay between the scheduled and the actual poll of a ticker")
+
+
+class TickerPoller:
+    TICK_INTERVAL = 1
+    POLL_INTERVAL = 10
+    # a failing fetch unsets the alarms of a ticker only when it keeps failing, a ticker that was
+    # never quoted is most likely unknown to Yahoo and is given up on after a few polls
+    ERROR_GRACE_PERIOD = 3600
+    MAX_ERRORS_OF_UNQUOTED_TICKER = 3
+
+    def __init__(self, db: Database, quote_cache: QuoteCache, notifier: Notifier, interval: float = POLL_INTERVAL) -> None:
+        self.db = db
+        self.quote_cache = quote_cache
+        self.notifier = notifier
+        self.interval = interval
+        self.lock = threading.Lock()
+        # (user_id, alarm) by alarm_id, user and ticker
+        self.alarms = AlarmRegistry()
+        # armed alarms by their own condition, disarmed repeat alarms by their re-arm condition
+        self.indexes: Dict[str, ThresholdIndex] = {}
+        self.rearm_indexes: Dict[str, ThresholdIndex] = {}
+        # expression alarms by each ticker they reference, and the latest price of those tickers,
+        # a quote re-evaluates only the expressions depending on its ticker
+        self.dependents: Dict[str, Set[str]] = {}
+        self.latest_prices: Dict[str, float] = {}
+        # window alarms and the recent quotes of their tickers, seeded from the quote history when given
+        self.window_indexes: Dict[str, WindowIndex] = {}
+        self.quote_history: Optional[Callable[[str, dt.datetime, dt.datetime], List[Tuple[dt.datetime, float]]]] = None
+        # each ticker keeps its own schedule, the tickers due on a tick are fetched in one batch
+        self.next_poll_at: Dict[str, float] = {}
+        self.schedules: Dict[str, TickerPollSchedule] = {}
+        # ticker -> (consecutive failed fetches, monotonic time of the first one)
+        self.errors: Dict[str, Tuple[int, float]] = {}
+        # tickers Yahoo is known to have quotes for, including the ones of stored alarms
+        self.quoted_tickers: Set[str] = set()
+        # called with the tickers added and removed, after the alarm that caused it is (un)subscribed
+        self.ticker_listeners: List[Callable[[List[str], List[str]], None]] = []
+        self.job: Optional[Job] = None
+        metrics.registry.gauge("active_alarms", "Alarms being polled").set_function(lambda: len(self.alarms))
+        metrics.registry.gauge("polled_tickers", "Distinct tickers being polled").set_function(lambda: len(self.next_poll_at))
+
+    def start(self, job_queue: JobQueue) -> None:
+        self.job = job_queue.run_repeating(self.poll, interval=self.TICK_INTERVAL, first=self.TICK_INTERVAL, last=None, name="ticker_poller")
+
+    def stop(self) -> None:
+        if self.job is not None:
+            self.job.schedule_removal()
+            self.job = None
+
+    def add_ticker_listener(self, listener: Callable[[List[str], List[str]], None]) -> None:
+        with self.lock:
+            self.ticker_listeners.append(listener)
+            tickers = list(self.next_poll_at)
+        listener(tickers, [])
+
+    def set_quote_history(self, quote_history: Callable[[str, dt.datetime, dt.datetime], List[Tuple[dt.datetime, float]]]) -> None:
+        self.quote_history = quote_history
+
+    def notify_ticker_listeners(self, added: List[str], removed: List[str]) -> None:
+        if len(added) == 0 and len(removed) == 0:
+            return
+        for listener in self.ticker_listeners:
+            listener(added, removed)
+
+    def _get_index_entry(self, alarm: TickerAlarm) -> Tuple[Dict[str, ThresholdIndex], Condition, float]:
+        if alarm.armed:
+            return self.indexes, alarm.condition, alarm.target
+        return (self.rearm_indexes, *alarm.get_rearm_condition_and_target())
+
+    def _insert_into_index(self, alarm: TickerAlarm) -> None:
+        indexes, condition, target = self._get_index_entry(alarm)
+        indexes.setdefault(alarm.ticker, ThresholdIndex()).insert(alarm.alarm_id, condition, target)
+
+    def _remove_from_index(self, alarm: TickerAlarm) -> None:
+        indexes, condition, target = self._get_index_entry(alarm)
+        indexes[alarm.ticker].remove(alarm.alarm_id, condition, target)
+        if len(indexes[alarm.ticker]) == 0:
+            del indexes[alarm.ticker]
+
+    def _set_armed(self, alarm: TickerAlarm, armed: bool) -> None:
+        self._remove_from_index(alarm)
+        alarm.armed = armed
+        self._insert_into_index(alarm)
+
+    def _insert_into_dependents(self, alarm: ExpressionAlarm) -> None:
+        for ticker in alarm.tickers:
+            self.dependents.setdefault(ticker, set()).add(alarm.alarm_id)
+
+    def _remove_from_dependents(self, alarm: ExpressionAlarm) -> None:
+        for ticker in alarm.tickers:
+            self.dependents[ticker].discard(alarm.alarm_id)
+            if len(self.dependents[ticker]) == 0:
+                del self.dependents[ticker]
+                self.latest_prices.pop(ticker, None)
+
+    def _load_window_history(self, alarms: Iterable[Union[TickerAlarm, ExpressionAlarm, WindowAlarm]]) -> Dict[str, List[Tuple[float, float]]]:
+        # the quotes a new window index starts with, loaded before taking the lock
+        windows: Dict[str, float] = {}
+        for alarm in alarms:
+            if isinstance(alarm, WindowAlarm) and alarm.ticker not in self.window_indexes:
+                windows[alarm.ticker] = max(windows.get(alarm.ticker, 0.0), alarm.longest_window)
+        if self.quote_history is None or len(windows) == 0:
+            return {}
+        history = {}
+        end = dt.datetime.now(pytz.utc)
+        for ticker, window in windows.items():
+            try:
+                # one more resolution for the price at the start of the window
+                quotes = self.quote_history(ticker, end - dt.timedelta(seconds=window + WindowIndex.RESOLUTION), end)
+            except Exception as e:
+                print(e)
+                continue
+            history[ticker] = [(quote_time.timestamp(), price) for quote_time, price in quotes]
+        return history
+
+    def _insert_into_window_index(self, alarm: WindowAlarm, history: Dict[str, List[Tuple[float, float]]]) -> None:
+        index = self.window_indexes.get(alarm.ticker)
+        if index is None:
+            index = self.window_indexes[alarm.ticker] = WindowIndex()
+            index.insert(alarm)
+            for quote_time, price in history.get(alarm.ticker, ()):
+                index.add_sample(quote_time, price)
+        else:
+            index.insert(alarm)
+
+    def _remove_from_window_index(self, alarm: WindowAlarm) -> None:
+        self.window_indexes[alarm.ticker].remove(alarm.alarm_id)
+        if len(self.window_indexes[alarm.ticker]) == 0:
+            del self.window_indexes[alarm.ticker]
+
+    def subscribe(self, user_id: int, alarm: Union[TickerAlarm, ExpressionAlarm, WindowAlarm]) -> None:
+        tickers = AlarmRegistry.get_tickers(alarm)
+        history = self._load_window_history([alarm])
+        with self.lock:
+            # an alarm subscribed again under the same alarm_id replaces the old one in every index
+            replaced_tickers = AlarmRegistry.get_tickers(self._remove_alarm(alarm.alarm_id)) if alarm.alarm_id in self.alarms else []
+            new_tickers = [ticker for ticker in tickers if ticker not in self.next_poll_at]
+            self.alarms.add(user_id, alarm)
+            if isinstance(alarm, ExpressionAlarm):
+                self._insert_into_dependents(alarm)
+            elif isinstance(alarm, WindowAlarm):
+                self._insert_into_window_index(alarm, history)
+            else:
+                self._insert_into_index(alarm)
+            for ticker in tickers:
+                self.schedules.setdefault(ticker, TickerPollSchedule())
+                # the new target may be closer than the ones the current schedule was based on
+                self.next_poll_at[ticker] = time.monotonic()
+            removed_tickers = self._remove_tickers_without_alarms(replaced_tickers)
+        self.notify_ticker_listeners(new_tickers, removed_tickers)
+
+    def subscribe_many(self, subscriptions: Iterable[Tuple[int, Union[TickerAlarm, ExpressionAlarm, WindowAlarm]]], stagger: bool = True) -> int:
+        # the last subscription of an alarm_id wins
+        subscriptions = list({alarm.alarm_id: (user_id, alarm) for user_id, alarm in subscriptions}.values())
+        entries: Dict[Tuple[bool, str], List[Tuple[str, Condition, float]]] = {}
+        history = self._load_window_history(alarm for _, alarm in subscriptions)
+        for _, alarm in subscriptions:
+            if isinstance(alarm, (ExpressionAlarm, WindowAlarm)):
+                continue
+            _, condition, target = self._get_index_entry(alarm)
+            entries.setdefault((alarm.armed, alarm.ticker), []).append((alarm.alarm_id, condition, target))
+
+        now = time.monotonic()
+        with self.lock:
+            replaced_tickers = [ticker for _, alarm in subscriptions if alarm.alarm_id in self.alarms for ticker in AlarmRegistry.get_tickers(self._remove_alarm(alarm.alarm_id))]
+            tickers = {ticker for _, alarm in subscriptions for ticker in AlarmRegistry.get_tickers(alarm)}
+            new_tickers = [ticker for ticker in tickers if ticker not in self.next_poll_at]
+            for user_id, alarm in subscriptions:
+                self.alarms.add(user_id, alarm)
+                if isinstance(alarm, ExpressionAlarm):
+                    self._insert_into_dependents(alarm)
+                elif isinstance(alarm, WindowAlarm):
+                    self._insert_into_window_index(alarm, history)
+            for (armed, ticker), ticker_entries in entries.items():
+                indexes = self.indexes if armed else self.rearm_indexes
+                indexes.setdefault(ticker, ThresholdIndex()).insert_many(ticker_entries)
+            for ticker in tickers:
+                self.schedules.setdefault(ticker, TickerPollSchedule())
+                # spread the first polls of new tickers over an interval instead of polling them all at once
+                offset = self.interval * (zlib.crc32(ticker.encode()) % 1000) / 1000 if stagger else 0.0
+                self.next_poll_at.setdefault(ticker, now + offset)
+                self.quoted_tickers.add(ticker)
+            removed_tickers = self._remove_tickers_without_alarms(replaced_tickers)
+        self.notify_ticker_listeners(new_tickers, removed_tickers)
+        return len(subscriptions)
+
+    def rehydrate(self) -> int:
+        subscriptions = ((doc["user_id"], TickerAlarm.deserialize(doc["alarm"])) for doc in self.db.find_active_ticker_alarms())
+        return self.subscribe_many(subscriptions)
+
+    def unsubscribe(self, alarm_id: str, user_id: Optional[int] = None) -> Optional[Union[TickerAlarm, ExpressionAlarm, WindowAlarm]]:
+        # with a user_id, only an alarm of that user is unsubscribed
+        with self.lock:
+            if alarm_id not in self.alarms or (user_id is not None and self.alarms.get_user_id(alarm_id) != user_id):
+                return None
+            alarm, removed_tickers = self._remove(alarm_id)
+        self.notify_ticker_listeners([], removed_tickers)
+        return alarm
+
+    def _remove(self, alarm_id: str) -> Tuple[Union[TickerAlarm, ExpressionAlarm, WindowAlarm], List[str]]:
+        # returns the alarm and the tickers left without alarms, which are no longer polled
+        alarm = self._remove_alarm(alarm_id)
+        return alarm, self._remove_tickers_without_alarms(AlarmRegistry.get_tickers(alarm))
+
+    def _remove_alarm(self, alarm_id: str) -> Union[TickerAlarm, ExpressionAlarm, WindowAlarm]:
+        _, alarm = self.alarms.remove(alarm_id)
+        if isinstance(alarm, ExpressionAlarm):
+            self._remove_from_dependents(alarm)
+        elif isinstance(alarm, WindowAlarm):
+            self._remove_from_window_index(alarm)
+        else:
+            self._remove_from_index(alarm)
+        return alarm
+
+    def _remove_tickers_without_alarms(self, tickers: Iterable[str]) -> List[str]:
+        removed_tickers = [ticker for ticker in dict.fromkeys(tickers) if ticker in self.next_poll_at and not self.alarms.has_ticker(ticker)]
+        for ticker in removed_tickers:
+            del self.next_poll_at[ticker]
+            del self.schedules[ticker]
+            self.errors.pop(ticker, None)
+            self.quoted_tickers.discard(ticker)
+        return removed_tickers
+
+    def alarm_ids(self) -> List[str]:
+        with self.lock:
+            return list(self.alarms)
+
+    def alarm_ids_of_user(self, user_id: int) -> List[str]:
+        with self.lock:
+            return self.alarms.alarm_ids_of_user(user_id)
+
+    def alarms_of_user(self, user_id: int) -> List[Union[TickerAlarm, ExpressionAlarm, WindowAlarm]]:
+        with self.lock:
+            return self.alarms.alarms_of_user(user_id)
+
+    def get_due_tickers(self, now: float) -> List[str]:
+        # tickers due before the middle of the next tick are polled on this one, so that ticks
+        # firing slightly early or late do not push a ticker to the tick after
+        deadline = now + self.TICK_INTERVAL / 2
+        with self.lock:
+            tickers = [ticker for ticker, poll_at in self.next_poll_at.items() if poll_at <= deadline]
+            for ticker in tickers:
+                POLL_LAG_SECONDS.observe(max(now - self.next_poll_at[ticker], 0.0))
+                self.next_poll_at[ticker] = max(self.next_poll_at[ticker] + self.interval, now)
+            return tickers
+
+    def poll(self, callback_context: CallbackContext) -> None:
+        tickers = self.get_due_tickers(time.monotonic())
+        if len(tickers) == 0:
+            return
+
+        price_dicts = self.quote_cache.get_many(tickers, allow_stale=False)
+        for ticker, price_dict in zip(tickers, price_dicts):
+            self.dispatch(ticker, price_dict)
+
+    def process_quote(self, ticker: str, price_dict: Optional[Dict[str, Any]]) -> List[Tuple[int, Union[TickerAlarm, ExpressionAlarm, WindowAlarm]]]:
+        # updates alarm states, reschedules the ticker and returns the subscriptions to run for the quote; the alarms
+        # the quote ends are unsubscribed while still holding the lock, so that a quote of the ticker processed
+        # concurrently does not return them again
+        state_changes = []
+        removed_tickers = []
+        started_at = time.perf_counter()
+        with self.lock:
+            subscriptions = self._evaluate_quote(ticker, price_dict, state_changes)
+            ended_alarm_ids = [alarm.alarm_id for _, alarm in subscriptions if price_dict is None or alarm.alarm_type == AlarmType.ONCE]
+            for alarm_id in ended_alarm_ids:
+                removed_tickers.extend(self._remove(alarm_id)[1])
+        ALARM_EVALUATION_SECONDS.observe(time.perf_counter() - started_at)
+
+        # persisted so that the edge-triggered state survives restarts
+        for alarm_id, armed, last_triggered_at in state_changes:
+            self.db.update_alarm_state(alarm_id, armed, last_triggered_at)
+        for alarm_id in ended_alarm_ids:
+            self.db.update_alarm(alarm_id, "error" if price_dict is None else "trigger")
+        self.notify_ticker_listeners([], removed_tickers)
+        return subscriptions
+
+    def _evaluate_quote(self, ticker: str, price_dict: Optional[Dict[str, Any]], state_changes: List[Tuple[str, bool, Optional[float]]]) -> List[Tuple[int, Union[TickerAlarm, ExpressionAlarm, WindowAlarm]]]:
+        if ticker not in self.next_poll_at:
+            return []
+        # once the fetch has failed for long enough every alarm of the ticker is notified, otherwise only the crossed ones
+        if price_dict is None:
+            num_errors, failing_since = self.errors.get(ticker, (0, time.monotonic()))
+            self.errors[ticker] = (num_errors + 1, failing_since)
+            if ticker not in self.quoted_tickers:
+                if num_errors + 1 < self.MAX_ERRORS_OF_UNQUOTED_TICKER:
+                    return []
+            elif time.monotonic() - failing_since < self.ERROR_GRACE_PERIOD:
+                return []
+            return [self.alarms[alarm_id] for alarm_id in self.alarms.alarm_ids_of_ticker(ticker)]
+
+        self.errors.pop(ticker, None)
+        self.quoted_tickers.add(ticker)
+        price = price_dict["current_price"]
+        now = time.time()
+        rearmed_alarm_ids = self.rearm_indexes[ticker].find_crossed(price) if ticker in self.rearm_indexes else []
+        for alarm_id in rearmed_alarm_ids:
+            _, alarm = self.alarms[alarm_id]
+            self._set_armed(alarm, True)
+            state_changes.append((alarm_id, True, alarm.last_triggered_at))
+
+        subscriptions = []
+        is_cooling_down = False
+        crossed_alarm_ids = self.indexes[ticker].find_crossed(price) if ticker in self.indexes else []
+        for alarm_id in crossed_alarm_ids:
+            user_id, alarm = self.alarms[alarm_id]
+            if alarm.alarm_type == AlarmType.REPEAT:
+                if alarm.is_cooling_down(now):
+                    is_cooling_down = True
+                    continue
+                alarm.last_triggered_at = now
+                self._set_armed(alarm, False)
+                state_changes.append((alarm_id, False, now))
+            subscriptions.append((user_id, alarm))
+        if ticker in self.dependents:
+            self.latest_prices[ticker] = price
+            subscriptions.extend(self._evaluate_dependents(ticker, now, state_changes))
+        if ticker in self.window_indexes:
+            subscriptions.extend(self._evaluate_window_index(ticker, price_dict, now, state_changes))
+
+        polled_at = time.monotonic()
+        schedule = self.schedules[ticker]
+        schedule.update(price_dict, polled_at)
+        # the nearest of the targets of armed alarms and the re-arm targets of disarmed ones
+        distances = [indexes[ticker].get_nearest_distance(price) for indexes in (self.indexes, self.rearm_indexes) if ticker in indexes]
+        distance = min((distance for distance in distances if distance is not None), default=None)
+        # expressions and window signals have no fixed target to be near to, and a crossed alarm cooling down triggers
+        # as soon as its cooldown ends, their tickers are polled at the base interval
+        relative_distance = None if distance is None or price <= 0 or is_cooling_down or ticker in self.dependents or ticker in self.window_indexes else distance / price
+        self.next_poll_at[ticker] = polled_at + schedule.get_poll_interval(relative_distance, self.interval, dt.datetime.now(pytz.utc))
+        return subscriptions
+
+    def _evaluate_dependents(self, ticker: str, now: float, state_changes: List[Tuple[str, bool, Optional[float]]]) -> List[Tuple[int, ExpressionAlarm]]:
+        # same edge-triggering as the indexed alarms, the values are only known once every ticker has a price
+        subscriptions = []
+        for alarm_id in self.dependents[ticker]:
+            user_id, alarm = self.alarms[alarm_id]
+            values = alarm.get_values(self.latest_prices)
+            if values is None:
+                continue
+            if not alarm.armed:
+                if alarm.check_rearm_values(values):
+                    alarm.armed = True
+                    state_changes.append((alarm_id, True, alarm.last_triggered_at))
+                continue
+            if not alarm.check_values(values):
+                continue
+            if alarm.alarm_type == AlarmType.REPEAT:
+                if alarm.is_cooling_down(now):
+                    continue
+                alarm.last_triggered_at = now
+                alarm.armed = False
+                state_changes.append((alarm_id, False, now))
+            subscriptions.append((user_id, alarm))
+        return subscriptions
+
+    def _evaluate_window_index(self, ticker: str, price_dict: Dict[str, Any], now: float, state_changes: List[Tuple[str, bool, Optional[float]]]) -> List[Tuple[int, WindowAlarm]]:
+        # windows are measured in market time, the same quote served again only replaces the latest sample
+        index = self.window_indexes[ticker]
+        quote_time = price_dict["last_update_datetime"].timestamp() if price_dict.get("last_update_datetime") is not None else now
+        index.add_sample(quote_time, price_dict["current_price"])
+        triggered, rearmed = index.evaluate(now)
+        for alarm in rearmed:
+            state_changes.append((alarm.alarm_id, True, alarm.last_triggered_at))
+        subscriptions = []
+        for alarm in triggered:
+            if alarm.alarm_type == AlarmType.REPEAT:
+                state_changes.append((alarm.alarm_id, False, now))
+            subscriptions.append((self.alarms.get_user_id(alarm.alarm_id), alarm))
+        return subscriptions
+
+    def dispatch(self, ticker: str, price_dict: Optional[Dict[str, Any]]) -> None:
+        for user_id, alarm in self.process_quote(ticker, price_dict):
+            TickerAlarm.run(self.notifier, alarm, user_id, price_dict)
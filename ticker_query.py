@@ -7,7 +7,7 @@ import prettytable as pt
 from telegram import ParseMode
 from html import escape as html_escape
 import pymongo
-from price import get_current_ticker_info
+from price import QuoteCache
 
 
 class TickerQuery:
@@ -25,14 +25,14 @@ class TickerQuery:
             return ParseMode.MARKDOWN_V2
 
     @staticmethod
-    def run_and_get_reply(query: TickerQuery, user_id: int, db: pymongo.database.Database, reply_mode: str = "MARKDOWN_V2") -> Tuple[str, Optional[ParseMode]]:
-        price_dict = query.run(user_id, db)
+    def run_and_get_reply(query: TickerQuery, user_id: int, db: pymongo.database.Database, quote_cache: QuoteCache, reply_mode: str = "MARKDOWN_V2") -> Tuple[str, Optional[ParseMode]]:
+        price_dict = query.run(user_id, db, quote_cache)
         reply, parse_mode = query.get_reply(price_dict, reply_mode)
         return reply, parse_mode
     
     @staticmethod
-    def run_multiple_and_get_reply(query_lst: List[TickerQuery], user_id: int, db: pymongo.database.Database, reply_mode: str = "MARKDOWN_V2") -> Tuple[str, Optional[ParseMode]]:
-        price_dicts = TickerQuery.run_multiple(query_lst, user_id, db)
+    def run_multiple_and_get_reply(query_lst: List[TickerQuery], user_id: int, db: pymongo.database.Database, quote_cache: QuoteCache, reply_mode: str = "MARKDOWN_V2") -> Tuple[str, Optional[ParseMode]]:
+        price_dicts = TickerQuery.run_multiple(query_lst, user_id, db, quote_cache)
         return TickerQuery.get_reply_multiple(query_lst, price_dicts, reply_mode)
 
     def get_reply(self, price_dict: Optional[Dict[str, Any]], reply_mode: str) -> Tuple[str, Optional[ParseMode]]:
@@ -53,14 +53,16 @@ class TickerQuery:
         else:
             return TickerQuery.get_table_reply([query.ticker for query in query_lst], price_dicts, reply_mode), TickerQuery.get_parse_mode(reply_mode)
 
-    def run(self, user_id: int, db: pymongo.database.Database) -> Optional[Dict[str, Any]]:
-        price_dict = get_current_ticker_info(self.ticker)
+    def run(self, user_id: int, db: pymongo.database.Database, quote_cache: QuoteCache) -> Optional[Dict[str, Any]]:
+        price_dict = quote_cache.get(self.ticker)
         db.insert_ticker_query(user_id, self, price_dict)
         return price_dict
         
     @staticmethod
-    def run_multiple(query_lst: List[TickerQuery], user_id: int, db: pymongo.database.Database) -> List[Optional[Dict[str, Any]]]:
-        price_dicts = [query.run(user_id, db) for query in query_lst]
+    def run_multiple(query_lst: List[TickerQuery], user_id: int, db: pymongo.database.Database, quote_cache: QuoteCache) -> List[Optional[Dict[str, Any]]]:
+        price_dicts = quote_cache.get_many([query.ticker for query in query_lst])
+        for query, price_dict in zip(query_lst, price_dicts):
+            db.insert_ticker_query(user_id, query, price_dict)
         return price_dicts
 
     def get_ticker_query_message_text(self, current_price: float, absolute_price_change: float, percentage_price_change: float, last_update_datetime: dt.datetime) -> str:
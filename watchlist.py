@@ -0,0 +1,99 @@
+from typing import Any, Dict, List, Optional, Tuple
+from collections import OrderedDict
+import threading
+import metrics
+
+
+TABLE_CACHE_HITS = metrics.registry.counter("watchlist_table_cache_hits_total", "Watchlist tables served without rendering")
+TABLE_CACHE_MISSES = metrics.registry.counter("watchlist_table_cache_misses_total", "Watchlist tables rendered")
+ROWS_RENDERED = metrics.registry.counter("watchlist_rows_rendered_total", "Watchlist rows rendered from a quote")
+
+Row = Tuple[str, ...]
+
+
+class TableCache:
+    # the tables of /watch, cached by the quote versions of their tickers; a table whose quotes changed is laid out
+    # again from its rows, which are rendered once per quote version and shared by every watchlist with the ticker.
+    # The layout is the one of the PrettyTable of TickerQuery.get_table_reply
+    HEADER = ("Ticker", "Price", "Change", "% Change", "Last Updated")
+    # ticker is left aligned, the other columns right aligned
+    LEFT_ALIGNED_COLUMNS = 1
+    MAX_TABLES = 1024
+    MAX_ROWS = 4096
+
+    def __init__(self, max_tables: int = MAX_TABLES, max_rows: int = MAX_ROWS) -> None:
+        self.max_tables = max_tables
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        # (tickers, versions, table_mode) -> table, least recently used first
+        self.tables: OrderedDict[Tuple[Tuple[str, ...], Tuple[Optional[int], ...], str], str] = OrderedDict()
+        # (ticker, version) -> cells of the row
+        self.rows: OrderedDict[Tuple[str, Optional[int]], Row] = OrderedDict()
+
+    @staticmethod
+    def render_row(ticker: str, price_dict: Optional[Dict[str, Any]]) -> Row:
+        if price_dict is None:
+            return (ticker, "-", "-", "-", "-")
+        price, abs_change, perc_change, last_updated = tuple(price_dict[f] for f in ["current_price", "absolute_price_change", "percentage_price_change", "last_update_datetime"])
+        return (ticker, f"{price:.2f}", f"{abs_change:.3f}", f"{perc_change:.3f}", f"{last_updated}")
+
+    def get_row(self, ticker: str, price_dict: Optional[Dict[str, Any]], version: Optional[int]) -> Row:
+        # a quote without a version is not the cached one anymore, its row is rendered but not kept
+        if version is None and price_dict is not None:
+            ROWS_RENDERED.inc()
+            return self.render_row(ticker, price_dict)
+        key = (ticker, version)
+        with self.lock:
+            row = self.rows.get(key)
+            if row is not None:
+                self.rows.move_to_end(key)
+                return row
+        ROWS_RENDERED.inc()
+        row = self.render_row(ticker, price_dict)
+        with self.lock:
+            self.rows[key] = row
+            while len(self.rows) > self.max_rows:
+                self.rows.popitem(last=False)
+        return row
+
+    @classmethod
+    def layout(cls, rows: List[Row]) -> str:
+        widths = [max(len(cell) for cell in column) for column in zip(cls.HEADER, *rows)]
+        border = "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+        lines = [border, cls.format_line(cls.HEADER, widths), border]
+        lines.extend(cls.format_line(row, widths) for row in rows)
+        lines.append(border)
+        return "\n".join(lines)
+
+    @classmethod
+    def format_line(cls, cells: Row, widths: List[int]) -> str:
+        cells = [cell.ljust(width) if i < cls.LEFT_ALIGNED_COLUMNS else cell.rjust(width) for i, (cell, width) in enumerate(zip(cells, widths))]
+        return "| " + " | ".join(cells) + " |"
+
+    def get_table_reply(self, tickers: List[str], price_dicts: List[Optional[Dict[str, Any]]], versions: List[Optional[int]], table_mode: str) -> str:
+        # a quote without a version makes the table uncacheable
+        key = (tuple(tickers), tuple(versions), table_mode)
+        cacheable = all(version is not None or price_dict is None for price_dict, version in zip(price_dicts, versions))
+        if cacheable:
+            with self.lock:
+                table = self.tables.get(key)
+                if table is not None:
+                    self.tables.move_to_end(key)
+                    TABLE_CACHE_HITS.inc()
+                    return table
+        TABLE_CACHE_MISSES.inc()
+
+        table = self.layout([self.get_row(ticker, price_dict, version) for ticker, price_dict, version in zip(tickers, price_dicts, versions)])
+        if table_mode == "HTML":
+            table = f"<pre>{table}</pre>"
+        elif table_mode == "MARKDOWN_V2":
+            table = f"```{table}```"
+        else:
+            raise ValueError(f"Unknown table mode {table_mode}, expected 'HTML' or 'MARKDOWN_V2'")
+
+        if cacheable:
+            with self.lock:
+                self.tables[key] = table
+                while len(self.tables) > self.max_tables:
+                    self.tables.popitem(last=False)
+        return table
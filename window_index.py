@@ -0,0 +1,189 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List, Tuple
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from ticker_alarm import AlarmType, Condition, Signal, WindowAlarm
+
+
+SIGNAL_CODES = {Signal.MOVE: 0, Signal.CROSS: 1, Signal.BREAKOUT: 2}
+
+
+class RingBuffer:
+    # the last quote of each resolution-long interval, the oldest one is overwritten once the buffer is full
+    def __init__(self, capacity: int, resolution: float) -> None:
+        self.resolution = resolution
+        self.times = np.empty(capacity)
+        self.prices = np.empty(capacity)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def capacity(self) -> int:
+        return len(self.times)
+
+    def append(self, time: float, price: float) -> None:
+        if self.size > 0:
+            last = (self.start + self.size - 1) % self.capacity
+            if time < self.times[last]:
+                return
+            if time // self.resolution == self.times[last] // self.resolution:
+                self.times[last], self.prices[last] = time, price
+                return
+        if self.size == self.capacity:
+            i = self.start
+            self.start = (self.start + 1) % self.capacity
+        else:
+            i = (self.start + self.size) % self.capacity
+            self.size += 1
+        self.times[i], self.prices[i] = time, price
+
+    def resize(self, capacity: int) -> None:
+        # only grows, the samples are kept
+        if capacity <= self.capacity:
+            return
+        times, prices = self.get_samples()
+        self.times, self.prices = np.empty(capacity), np.empty(capacity)
+        self.times[:self.size], self.prices[:self.size] = times, prices
+        self.start = 0
+
+    def get_samples(self) -> Tuple[np.ndarray, np.ndarray]:
+        # oldest first, views unless the samples wrap around
+        end = self.start + self.size
+        if end <= self.capacity:
+            return self.times[self.start:end], self.prices[self.start:end]
+        return np.concatenate((self.times[self.start:], self.times[:end - self.capacity])), np.concatenate((self.prices[self.start:], self.prices[:end - self.capacity]))
+
+
+class WindowIndex:
+    # the window alarms of a ticker over a ring buffer of its recent quotes, their parameters and states are kept in
+    # columns so that a new quote evaluates all of them in one pass of array operations
+    RESOLUTION = 10.0
+
+    def __init__(self, resolution: float = RESOLUTION) -> None:
+        if np is None:
+            raise ImportError("numpy is required for window alarms, pip install numpy")
+        self.resolution = resolution
+        self.buffer = RingBuffer(2, resolution)
+        self.alarms: List[WindowAlarm] = []
+        self.positions: Dict[str, int] = {}
+        # the columns are rebuilt on the first evaluation after alarms are added or removed
+        self.is_built = False
+
+    def __len__(self) -> int:
+        return len(self.alarms)
+
+    def get_capacity(self, window: float) -> int:
+        # every interval of the window, the one before it for the price at its start, and the current one
+        return int(window // self.resolution) + 3
+
+    def insert(self, alarm: WindowAlarm) -> None:
+        self.positions[alarm.alarm_id] = len(self.alarms)
+        self.alarms.append(alarm)
+        self.buffer.resize(self.get_capacity(alarm.longest_window))
+        self.is_built = False
+
+    def insert_many(self, alarms: Iterable[WindowAlarm]) -> None:
+        for alarm in alarms:
+            self.insert(alarm)
+
+    def remove(self, alarm_id: str) -> bool:
+        # the last alarm takes the place of the removed one
+        i = self.positions.pop(alarm_id, None)
+        if i is None:
+            return False
+        last = self.alarms.pop()
+        if i < len(self.alarms):
+            self.alarms[i] = last
+            self.positions[last.alarm_id] = i
+        self.is_built = False
+        return True
+
+    def alarm_ids(self) -> List[str]:
+        return [alarm.alarm_id for alarm in self.alarms]
+
+    def add_sample(self, time: float, price: float) -> None:
+        self.buffer.append(time, price)
+
+    def build(self) -> None:
+        alarms = self.alarms
+        self.signals = np.array([SIGNAL_CODES[alarm.signal] for alarm in alarms], dtype=np.int8)
+        self.signs = np.array([1.0 if alarm.condition == Condition.GREATER_THAN else -1.0 for alarm in alarms])
+        self.thresholds = np.array([alarm.threshold for alarm in alarms], dtype=float)
+        self.windows = np.array([alarm.window for alarm in alarms], dtype=float)
+        self.long_windows = np.array([alarm.longest_window for alarm in alarms], dtype=float)
+        self.hysteresis = np.array([alarm.hysteresis for alarm in alarms], dtype=float)
+        self.cooldowns = np.array([alarm.cooldown for alarm in alarms], dtype=float)
+        self.is_repeat = np.array([alarm.alarm_type == AlarmType.REPEAT for alarm in alarms], dtype=bool)
+        self.armed = np.array([alarm.armed for alarm in alarms], dtype=bool)
+        self.last_triggered_at = np.array([alarm.last_triggered_at if alarm.last_triggered_at is not None else np.nan for alarm in alarms], dtype=float)
+        # alarms share a few window lengths, the samples are looked up once per distinct length
+        self.distinct_windows, inverse = np.unique(np.concatenate((self.windows, self.long_windows)), return_inverse=True)
+        self.window_ids, self.long_window_ids = inverse[:len(alarms)], inverse[len(alarms):]
+        self.is_move = self.signals == SIGNAL_CODES[Signal.MOVE]
+        self.is_cross = self.signals == SIGNAL_CODES[Signal.CROSS]
+        self.is_breakout = self.signals == SIGNAL_CODES[Signal.BREAKOUT]
+        self.has_signal = {Signal.MOVE: bool(self.is_move.any()), Signal.CROSS: bool(self.is_cross.any()), Signal.BREAKOUT: bool(self.is_breakout.any())}
+        self.is_built = True
+
+    def get_values(self) -> np.ndarray:
+        # the signal of every alarm in percent, nan while the buffer does not span its window yet; each value only
+        # depends on the window lengths, so it is computed once per distinct length and gathered for the alarms
+        times, prices = self.buffer.get_samples()
+        n = len(times)
+        if n < 2:
+            return np.full(len(self.alarms), np.nan)
+        time, price = times[-1], prices[-1]
+        # the sample in effect at the start of each window, -1 when the buffer starts after it, and the first one inside it
+        starts = np.searchsorted(times, time - self.distinct_windows, side="right") - 1
+        froms = np.searchsorted(times, time - self.distinct_windows, side="left")
+        is_covered = starts >= 0
+        starts = np.maximum(starts, 0)
+        values = np.full(len(self.alarms), np.nan)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.has_signal[Signal.MOVE]:
+                moves = np.where(is_covered, (price / prices[starts] - 1) * 100, np.nan)
+                values = np.where(self.is_move, moves[self.window_ids], values)
+            if self.has_signal[Signal.CROSS]:
+                sums = np.concatenate(([0.0], np.cumsum(prices)))
+                averages = (sums[n] - sums[froms]) / (n - froms)
+                crosses = (averages[self.window_ids] / averages[self.long_window_ids] - 1) * 100
+                values = np.where(self.is_cross & is_covered[self.long_window_ids], crosses, values)
+            if self.has_signal[Signal.BREAKOUT]:
+                # the high and low from each sample up to the one before the current
+                highs = np.where(is_covered, np.maximum.accumulate(prices[-2::-1])[::-1][starts], np.nan)
+                lows = np.where(is_covered, np.minimum.accumulate(prices[-2::-1])[::-1][starts], np.nan)
+                extremes = np.where(self.signs > 0, highs[self.window_ids], lows[self.window_ids])
+                values = np.where(self.is_breakout, (price / extremes - 1) * 100, values)
+        return values
+
+    def evaluate(self, now: float) -> Tuple[List[WindowAlarm], List[WindowAlarm]]:
+        # returns the alarms triggered and the ones re-armed, a triggered repeat alarm is disarmed here
+        if len(self.alarms) == 0:
+            return [], []
+        if not self.is_built:
+            self.build()
+        values = self.get_values()
+        with np.errstate(invalid="ignore"):
+            distances = self.signs * (values - self.thresholds)
+            cooling_down = self.is_repeat & (now - self.last_triggered_at < self.cooldowns)
+            triggered = np.flatnonzero(self.armed & (distances > 0) & ~cooling_down)
+            rearmed = np.flatnonzero(~self.armed & (distances < -self.hysteresis))
+
+        triggered_alarms, rearmed_alarms = [], []
+        for i in rearmed:
+            alarm = self.alarms[i]
+            alarm.armed = self.armed[i] = True
+            rearmed_alarms.append(alarm)
+        for i in triggered:
+            alarm = self.alarms[i]
+            alarm.last_value = float(values[i])
+            if self.is_repeat[i]:
+                alarm.armed = self.armed[i] = False
+                alarm.last_triggered_at = self.last_triggered_at[i] = now
+            triggered_alarms.append(alarm)
+        return triggered_alarms, rearmed_alarms